@@ -1,14 +1,23 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+import sys
+
+# Profile the imports below before they happen (see --import-profile)
+if __name__ == '__main__' and '--import-profile' in sys.argv:
+    from core.import_profile import run_import_profile
+    sys.exit(run_import_profile('app', sys.argv[1:]))
+
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, redirect, url_for, stream_with_context
 from flask_cors import CORS
-from waitress import serve
 import os
-import sys
-import platform
-import subprocess
 import logging
-import psutil
 import signal
+import socket
+import subprocess
 import time
+import threading
+import json
+import functools
+import hmac
+import argparse
 from datetime import datetime
 from core.process_manager import process_manager
 from core.state_manager import state_manager
@@ -17,18 +26,39 @@ from core.utils import (
     find_ffmpeg_binaries,
     get_ffmpeg_architecture,
     backup_original_ffmpeg,
-    restore_original_ffmpeg,
     replace_ffmpeg_binaries,
-    force_single_architecture,
     setup_logging,
-    create_backup,
-    restore_from_backup,
     force_architecture_incompatibility,
     get_default_emby_path,
-    find_emby_servers,
-    check_ffmpeg_compatibility
+    check_ffmpeg_compatibility,
+    get_test_mode_info,
+    get_data_dir,
+    is_remote_address
 )
-import socket
+from core.response_cache import response_cache
+from core.admission import admission_controller
+from core.shared_store import shared_store
+from core.database import database
+from core.journal import journal
+from core.instance_lock import InstanceLock, find_running_instance
+from core.prefork import create_listen_socket
+from core.operations import fix_ffmpeg_compatibility, restore_original_ffmpeg, enter_test_mode
+from core.install_status import InstallInspection, collect_install_status, STATUS_FIELDS
+from core.warmup import warmup
+from core.directory_browser import directory_browser
+from core.discovery import discovery, find_emby_servers, get_search_roots
+from core.emby_processes import emby_process_monitor
+from core.emby_client import emby_clients, EmbyClientError
+from core.fleet import fleet_coordinator, decode_report
+from core.health_scheduler import health_scheduler
+from core import batch
+from core.fix_orchestrator import fix_orchestrator
+from core.inventory import inventory
+from core.fix_recipes import fix_recipes
+from core.fix_staging import fix_staging
+from core.install_watcher import install_watcher
+from core.log_analyzer import log_analyzer
+from core.metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_REQUESTS, HTTP_REQUEST_SECONDS
 
 def find_available_port(start_port=9876, max_port=9886):
     """Find an available port in the given range."""
@@ -55,6 +85,13 @@ app.config['EMBY_PATH'] = None  # Initialize EMBY_PATH config
 app.config['DEBUG'] = True  # Enable debug mode for development
 app.config['PROPAGATE_EXCEPTIONS'] = True  # Enable exception propagation
 
+# Pid of the pre-fork supervisor when running with several worker processes
+SUPERVISOR_PID = None
+
+# Lock held by the worker process that runs the background services
+BACKGROUND_LOCK = None
+BACKGROUND_STATUS_INTERVAL = 5  # Seconds between publications of the background services' status
+
 # Ensure logs directory exists
 if not os.path.exists('logs'):
     os.makedirs('logs')
@@ -69,19 +106,129 @@ logging.basicConfig(
     ]
 )
 
-def kill_existing_flask():
-    """Kill any existing Flask processes"""
-    try:
-        # More aggressive process killing
-        os.system('pkill -9 -f "python.*app.py"')
-        time.sleep(1)
-    except Exception as e:
-        logging.error("Error killing existing processes: {}".format(e))
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count each request and time it by route pattern, so install paths do not become labels."""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+    return response
+
+def cached_json_response(endpoint, emby_path, compute, variant=None, extra_paths=None):
+    """Serve a status response from the response cache with ETag revalidation.
 
-def is_port_in_use(port):
-    """Check if a port is in use"""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('127.0.0.1', port)) == 0
+    Clients that send a matching If-None-Match header get an empty 304.
+    """
+    entry = response_cache.get_or_compute(endpoint, emby_path, compute, variant, extra_paths)
+    if entry.status == 200 and request.if_none_match.contains(entry.etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(entry.body, status=entry.status, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def admission_limited(endpoint):
+    """Apply the endpoint's admission policy, answering 429 with Retry-After when over the limit."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            admission = admission_controller.try_acquire(endpoint, request.remote_addr)
+            if not admission.granted:
+                response = jsonify({
+                    'success': False,
+                    'message': 'Too many {} requests, retry in {} seconds'.format(endpoint, admission.retry_after),
+                    'reason': admission.reason
+                })
+                response.status_code = 429
+                response.headers['Retry-After'] = str(admission.retry_after)
+                return response
+            streamed = False
+            try:
+                response = app.make_response(view(*args, **kwargs))
+                if response.is_streamed:
+                    # Streamed bodies do their work after the view returns, so
+                    # the slot is held until the body is sent or the client leaves
+                    response.call_on_close(admission.release)
+                    streamed = True
+                return response
+            finally:
+                if not streamed:
+                    admission.release()
+        return wrapper
+    return decorator
+
+def install_locked(view):
+    """Serialize operations that modify an install, across threads and worker processes."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True) or {}
+        with shared_store.lock('install-{}'.format(data.get('path') or '')):
+            return view(*args, **kwargs)
+    return wrapper
+
+def transcodes_idle(view):
+    """Refuse to modify an install while it is transcoding, unless the request sets force."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True) or {}
+        if data.get('path') and not data.get('force'):
+            transcodes = emby_process_monitor.get_active_transcodes(data['path'])
+            if transcodes:
+                response = jsonify({
+                    'success': False,
+                    'message': 'Emby Server is running {} transcode(s), retry when they finish or set force'.format(
+                        len(transcodes)),
+                    'transcodes': transcodes
+                })
+                response.status_code = 409
+                return response
+        return view(*args, **kwargs)
+    return wrapper
+
+def recorded_operation(kind):
+    """Record an operation on an install, and its outcome, in the history."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            operation_id = database.start_operation(data.get('path'), kind)
+            success, message = False, None
+            try:
+                response = app.make_response(view(*args, **kwargs))
+                result = response.get_json(silent=True) or {}
+                success, message = result.get('success', False), result.get('message')
+                return response
+            except Exception as e:
+                message = str(e)
+                raise
+            finally:
+                database.finish_operation(operation_id, success, message)
+                if data.get('path'):
+                    # Check the modified install again soon
+                    health_scheduler.reset(data['path'])
+        return wrapper
+    return decorator
+
+def get_selected_emby_path():
+    """Get the Emby Server path selected in the UI."""
+    if shared_store.enabled:
+        return shared_store.get('config', 'emby_path', app.config['EMBY_PATH'])
+    return app.config['EMBY_PATH']
+
+def set_selected_emby_path(emby_path):
+    """Remember the Emby Server path selected in the UI, across restarts."""
+    app.config['EMBY_PATH'] = emby_path
+    if shared_store.enabled:
+        shared_store.set('config', 'emby_path', emby_path)
+    database.record_installs([emby_path])
+    database.set_setting('emby_path', emby_path)
 
 @app.route('/')
 def index():
@@ -111,13 +258,6 @@ def start_application():
     try:
         logging.info("Attempting to start main application")
         
-        # Check if another instance is running
-        if is_port_in_use(APP_PORT):
-            logging.info("Found existing Flask process, attempting to kill it")
-            kill_existing_flask()
-            # Give the process a moment to terminate
-            time.sleep(1)
-        
         # Start the main application
         state_manager.set_main_app_running(True)
         logging.info("Main application started successfully")
@@ -158,7 +298,7 @@ def select_emby():
             }), 404
         
         # Save the selected path
-        app.config['EMBY_PATH'] = emby_path
+        set_selected_emby_path(emby_path)
         
         return jsonify({
             'success': True,
@@ -174,6 +314,7 @@ def select_emby():
         }), 500
 
 @app.route('/api/check-compatibility', methods=['POST'])
+@admission_limited('check-compatibility')
 def check_compatibility():
     """Check FFMPEG compatibility."""
     try:
@@ -191,30 +332,13 @@ def check_compatibility():
                 'message': 'No path provided'
             }), 400
             
-        # Get the client's IP address to determine if it's a remote access
-        client_ip = request.remote_addr
-        is_remote_access = client_ip != '127.0.0.1' and client_ip != 'localhost'
+        # Determine from the client's address whether this is a remote access
+        is_remote_access = is_remote_address(request.remote_addr)
         
-        # Get system architecture
-        system_arch = get_system_architecture('remote' if is_remote_access else None)
-        
-        # Get FFMPEG architecture
-        ffmpeg_path = find_ffmpeg_binaries(emby_path)
-        ffmpeg_arch = get_ffmpeg_architecture(ffmpeg_path) if ffmpeg_path else None
-        
-        # Check compatibility
-        is_compatible = system_arch == ffmpeg_arch if system_arch and ffmpeg_arch else False
-        message = "FFMPEG is compatible with your system" if is_compatible else \
-                 "FFMPEG architecture ({}) does not match system architecture ({})".format(
-                     ffmpeg_arch or "Unknown", system_arch or "Unknown")
-        
-        return jsonify({
-            'success': True,
-            'is_compatible': is_compatible,
-            'message': message,
-            'system_architecture': system_arch or "Unknown",
-            'ffmpeg_architecture': ffmpeg_arch or "Unknown"
-        })
+        return cached_json_response(
+            'check-compatibility', emby_path,
+            lambda: compute_compatibility(emby_path, is_remote_access),
+            variant='remote' if is_remote_access else 'local')
     except Exception as e:
         error_msg = "Error checking compatibility: {}".format(str(e))
         logging.error(error_msg)
@@ -223,7 +347,18 @@ def check_compatibility():
             'message': error_msg
         }), 500
 
+def compute_compatibility(emby_path, is_remote_access):
+    """Compute the check-compatibility response payload."""
+    inspection = InstallInspection(emby_path, is_remote_access)
+    payload = inspection.compatibility()
+    inspection.record(is_compatible=payload['is_compatible'])
+    return payload, 200
+
 @app.route('/api/fix-ffmpeg', methods=['POST'])
+@admission_limited('fix-ffmpeg')
+@install_locked
+@transcodes_idle
+@recorded_operation('fix')
 def fix_ffmpeg():
     global CURRENT_PROCESS
     try:
@@ -236,14 +371,14 @@ def fix_ffmpeg():
         if not os.path.exists(emby_path):
             return jsonify({"success": False, "message": "Emby Server path does not exist"})
         
-        # Create backup if it doesn't exist
-        backup_result = create_backup(emby_path)
-        if not backup_result["success"]:
-            return jsonify(backup_result)
-        
-        # Fix FFMPEG compatibility
+        # Fix FFMPEG compatibility, backing the install up first unless the fix is rename-only
         logging.info("Starting FFMPEG compatibility fix...")
-        result = fix_ffmpeg_compatibility(emby_path)
+        try:
+            with batch.fix_slot():
+                result = fix_ffmpeg_compatibility(emby_path, backup=lambda: batch.backup_install(emby_path),
+                                                  confirm_external=bool(data.get('confirm_external')))
+        finally:
+            response_cache.invalidate(emby_path)
         
         if result["success"]:
             logging.info("FFMPEG compatibility fix completed successfully")
@@ -259,6 +394,10 @@ def fix_ffmpeg():
         CURRENT_PROCESS = None
 
 @app.route('/api/restore-ffmpeg', methods=['POST'])
+@admission_limited('restore-ffmpeg')
+@install_locked
+@transcodes_idle
+@recorded_operation('restore')
 def restore_ffmpeg():
     """Restore original FFMPEG binaries and clean up test mode"""
     try:
@@ -271,17 +410,14 @@ def restore_ffmpeg():
             })
         
         # Restore original FFMPEG binaries
-        success, message = restore_original_ffmpeg(emby_path)
+        try:
+            success, message = restore_original_ffmpeg(
+                emby_path, confirm_external=bool(request.json.get('confirm_external')))
+        finally:
+            response_cache.invalidate(emby_path)
         
         if success:
-            # Clean up test mode marker if it exists
-            test_marker = os.path.join(os.path.dirname(find_ffmpeg_binaries(emby_path)), "ffmpeg_test_mode")
-            if os.path.exists(test_marker):
-                try:
-                    os.remove(test_marker)
-                except OSError as e:
-                    logging.warning("Could not remove test marker file: {}".format(e))
-            
+            # The test mode marker is removed as part of the restore
             return jsonify({
                 'success': True,
                 'message': message,
@@ -306,6 +442,7 @@ def restore_ffmpeg():
         }), 500
 
 @app.route('/api/check-backup', methods=['POST'])
+@admission_limited('check-backup')
 def check_backup():
     emby_path = request.json.get('path')
     
@@ -316,21 +453,14 @@ def check_backup():
             'has_backup': False
         })
     
-    ffmpeg_path = find_ffmpeg_binaries(emby_path)
-    if not ffmpeg_path:
-        return jsonify({
-            'success': False,
-            'message': 'FFMPEG binaries not found in Emby Server',
-            'has_backup': False
-        })
-    
-    backup_dir = os.path.join(os.path.dirname(ffmpeg_path), "ffmpeg_backup_original")
-    has_backup = os.path.exists(backup_dir)
-    
-    return jsonify({
-        'success': True,
-        'has_backup': has_backup
-    })
+    return cached_json_response('check-backup', emby_path, lambda: compute_backup_status(emby_path))
+
+def compute_backup_status(emby_path):
+    """Compute the check-backup response payload."""
+    inspection = InstallInspection(emby_path)
+    payload = inspection.backup()
+    inspection.record(has_backup=payload['has_backup'])
+    return payload, 200
 
 @app.route('/api/get-logs', methods=['GET', 'OPTIONS'])
 def get_logs():
@@ -388,6 +518,10 @@ def download_log():
     return send_file(log_file, as_attachment=True)
 
 @app.route('/api/force-test-mode', methods=['POST'])
+@admission_limited('force-test-mode')
+@install_locked
+@transcodes_idle
+@recorded_operation('test-mode')
 def force_test_mode():
     """Force FFMPEG binaries to be single-architecture for testing"""
     try:
@@ -417,12 +551,15 @@ def force_test_mode():
             })
         
         # Force single architecture
-        message = force_single_architecture(find_ffmpeg_binaries(emby_path), target_arch)
+        message = enter_test_mode(emby_path, target_arch,
+                                  confirm_external=bool(request.json.get('confirm_external')))
         success = message.startswith('Success:')
         
         if success:
+            response_cache.invalidate(emby_path)
+            
             # Get test mode info
-            test_info = get_test_mode_info(emby_path)
+            test_info = get_test_mode_info(find_ffmpeg_binaries(emby_path))
             
             return jsonify({
                 'success': True,
@@ -450,6 +587,7 @@ def force_test_mode():
         }), 500
 
 @app.route('/api/check-test-mode', methods=['POST'])
+@admission_limited('check-test-mode')
 def check_test_mode():
     """Check if test mode is currently active and get its status"""
     try:
@@ -462,25 +600,7 @@ def check_test_mode():
                 'test_mode_active': False
             })
         
-        # Check if test mode is active
-        is_active = is_test_mode_active(emby_path)
-        test_info = get_test_mode_info(emby_path) if is_active else None
-        
-        # Get current FFMPEG architecture
-        ffmpeg_path = find_ffmpeg_binaries(emby_path)
-        current_arch = get_ffmpeg_architecture(ffmpeg_path) if ffmpeg_path else None
-        system_arch = get_system_architecture()
-        
-        return jsonify({
-            'success': True,
-            'test_mode_active': is_active,
-            'test_info': test_info,
-            'details': {
-                'system_architecture': system_arch,
-                'current_ffmpeg_architecture': current_arch,
-                'is_compatible': current_arch == system_arch if current_arch else None
-            }
-        })
+        return cached_json_response('check-test-mode', emby_path, lambda: compute_test_mode_status(emby_path))
         
     except Exception as e:
         error_msg = "Error checking test mode: {}".format(str(e))
@@ -491,6 +611,13 @@ def check_test_mode():
             'test_mode_active': False
         }), 500
 
+def compute_test_mode_status(emby_path):
+    """Compute the check-test-mode response payload."""
+    inspection = InstallInspection(emby_path)
+    payload = inspection.test_mode()
+    inspection.record(test_mode_active=payload['test_mode_active'])
+    return payload, 200
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
     """Shutdown the Flask server."""
@@ -506,7 +633,8 @@ def shutdown():
         
         def shutdown_server():
             time.sleep(1)  # Give time for response to be sent
-            os.kill(pid, signal.SIGTERM)
+            # With several workers, stop the supervisor so the worker is not restarted
+            os.kill(SUPERVISOR_PID or pid, signal.SIGTERM)
         
         # Start shutdown in a separate thread
         from threading import Thread
@@ -524,6 +652,10 @@ def shutdown():
         }), 500
 
 @app.route('/api/stop-process', methods=['POST'])
+@admission_limited('stop-process')
+@install_locked
+@transcodes_idle
+@recorded_operation('stop')
 def stop_process():
     """Stop any running process, restore initial state, and reset application state"""
     try:
@@ -544,7 +676,10 @@ def stop_process():
         logging.info("Process stop result: {}".format(process_stopped))
         
         # Then restore to initial state
-        restore_result = state_manager.restore_initial_state(emby_path)
+        try:
+            restore_result = state_manager.restore_initial_state(emby_path)
+        finally:
+            response_cache.invalidate(emby_path)
         logging.info("State restore result: {}".format(restore_result))
         
         if not restore_result["success"]:
@@ -612,42 +747,91 @@ def get_process_state():
             'message': str(e)
         }), 500
 
-@app.route('/api/browse-emby', methods=['GET'])
-def browse_emby():
-    """Open a native file dialog to select Emby Server application"""
+@app.route('/api/install-status', methods=['GET', 'POST'])
+@admission_limited('install-status')
+def install_status():
+    """Get the complete status of an install in a single request.
+
+    Accepts 'path' and a comma separated 'fields' list (any of STATUS_FIELDS)
+    as query parameters or JSON body; all fields are returned by default.
+    """
     try:
-        import tkinter as tk
-        from tkinter import filedialog
+        data = request.get_json(silent=True) or {}
+        emby_path = data.get('path') or request.args.get('path') or None
+        fields = data.get('fields') or request.args.get('fields')
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(',') if field.strip()]
+        fields = tuple(sorted(set(fields or STATUS_FIELDS)))
         
-        # Create and hide the root window
-        root = tk.Tk()
-        root.withdraw()
+        unknown = [field for field in fields if field not in STATUS_FIELDS]
+        if unknown:
+            return jsonify({
+                'success': False,
+                'message': 'Unknown status fields: {}'.format(', '.join(unknown))
+            }), 400
         
-        # Open file dialog
-        file_path = filedialog.askdirectory(
-            initialdir="/Applications",
-            title="Select Emby Server Application",
-            mustexist=True
-        )
+        is_remote_access = is_remote_address(request.remote_addr)
         
-        if file_path:
-            # Validate that it's an Emby Server application
-            if file_path.endswith('.app') and ('Emby' in file_path or 'emby' in file_path):
-                return jsonify({
-                    'success': True,
-                    'path': file_path
-                })
-            else:
-                return jsonify({
-                    'success': False,
-                    'message': 'Selected path is not an Emby Server application'
-                })
+        # Process state is not on disk, so make it part of the cache key instead
+        is_processing = process_manager.is_running if 'process_state' in fields else None
         
+        return cached_json_response(
+            'install-status', emby_path,
+            lambda: (collect_install_status(emby_path, fields, is_remote_access), 200),
+            variant=(fields, is_remote_access, is_processing, state_manager.is_main_app_running()),
+            extra_paths=discovery.get_watch_paths())
+    except Exception as e:
+        error_msg = "Error getting install status: {}".format(str(e))
+        logging.error(error_msg)
         return jsonify({
             'success': False,
-            'message': 'No path selected'
-        })
-        
+            'message': error_msg
+        }), 500
+
+@app.route('/api/admission-stats')
+def admission_stats():
+    """Get admission control counters, including rejected requests per endpoint"""
+    return jsonify({
+        'success': True,
+        'endpoints': admission_controller.get_stats()
+    })
+
+@app.route('/api/browse-emby', methods=['GET'])
+@admission_limited('browse-emby')
+def browse_emby():
+    """List the subdirectories of a directory for the install picker.
+
+    Accepts 'path' (defaults to the first search root), 'offset',
+    'limit' (at most 1000), 'filter' and 'hidden' query parameters.
+    Emby Server installs (macOS bundles, Linux and Windows install directories)
+    are listed first and flagged with 'is_emby'.
+    """
+    try:
+        search_roots = [root for root in get_search_roots() if os.path.isdir(root)]
+        path = request.args.get('path') or (search_roots[0] if search_roots else os.path.expanduser('~'))
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 200, type=int), 1), 1000)
+        listing = directory_browser.list_directory(
+            path, offset, limit,
+            name_filter=request.args.get('filter'),
+            show_hidden=request.args.get('hidden') in ('1', 'true'))
+        listing['success'] = True
+        return jsonify(listing)
+    except FileNotFoundError:
+        return jsonify({
+            'success': False,
+            'message': 'Directory does not exist: {}'.format(path)
+        }), 404
+    except NotADirectoryError:
+        return jsonify({
+            'success': False,
+            'message': 'Not a directory: {}'.format(path)
+        }), 400
+    except PermissionError:
+        return jsonify({
+            'success': False,
+            'message': 'Permission denied: {}'.format(path)
+        }), 403
     except Exception as e:
         error_msg = "Error browsing for Emby Server: {}".format(str(e))
         logging.error(error_msg)
@@ -657,20 +841,314 @@ def browse_emby():
         }), 500
 
 @app.route('/api/list-emby-servers')
+@admission_limited('list-emby-servers')
 def list_emby_servers():
     """Get a list of all detected Emby Server installations."""
     try:
-        servers = find_emby_servers()
-        return jsonify({
-            "success": True,
-            "servers": servers
-        })
+        return cached_json_response('list-emby-servers', None, compute_emby_servers)
     except Exception as e:
         return jsonify({
             "success": False,
             "message": str(e)
         }), 500
 
+def compute_emby_servers():
+    """Compute the list-emby-servers response payload."""
+    servers = find_emby_servers()
+    database.record_installs(servers)
+    return {
+        "success": True,
+        "servers": servers
+    }, 200
+
+@app.route('/api/emby-processes')
+def emby_processes():
+    """Get the running Emby Servers, their active transcodes and the ffmpeg binaries in use"""
+    try:
+        snapshot = emby_process_monitor.get_snapshot()
+        return jsonify(dict(snapshot, success=True))
+    except Exception as e:
+        logging.error(f"Error listing Emby processes: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/health-schedule')
+def health_schedule():
+    """Get when each install is checked next, and the health scheduler's lag metrics"""
+    return jsonify(dict(background_status('health-schedule', health_scheduler.get_schedule()), success=True))
+
+@app.route('/api/fix-recipes')
+def get_fix_recipes():
+    """Get the fix recipes cached per Emby version and host architecture"""
+    return jsonify(dict(fix_recipes.get_recipes(), success=True))
+
+@app.route('/api/fix-staging')
+def get_fix_staging():
+    """Get the installs with staged replacements and the staging budget used"""
+    return jsonify(dict(background_status('fix-staging', fix_staging.get_status()), success=True))
+
+@app.route('/api/watch-status')
+def watch_status():
+    """Get the watched installs and the watcher's recent checks and fixes"""
+    return jsonify(dict(background_status('watch-status', install_watcher.get_status()), success=True))
+
+@app.route('/api/log-failures')
+def log_failures():
+    """Get the FFMPEG failures found in Emby's logs, per install and hour"""
+    try:
+        hours = max(1, int(request.args.get('hours', 24)))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'hours must be an integer'}), 400
+    return jsonify(dict(background_status('log-analyzer', log_analyzer.get_summary(hours)), success=True))
+
+def batch_response(run_target, max_parallelism=batch.MAX_PARALLELISM):
+    """Run a batch request's targets and stream one NDJSON line per result."""
+    data = request.get_json(silent=True) or {}
+    try:
+        targets = batch.get_targets(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        parallelism = int(data.get('parallelism') or batch.DEFAULT_PARALLELISM)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'parallelism must be an integer'}), 400
+    results = batch.run_batch(targets, run_target, parallelism, max_parallelism)
+    return Response(stream_with_context(batch.to_ndjson(results)), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/batch/check', methods=['POST'])
+@admission_limited('batch')
+def batch_check():
+    """Check many installs or fleet hosts, streaming NDJSON results as they finish.
+
+    Accepts 'paths', 'host_ids' and 'parallelism' in the JSON body.
+    """
+    return batch_response(lambda kind, value: batch.check_install(value) if kind == 'path'
+                          else batch.check_host(value))
+
+@app.route('/api/batch/fix', methods=['POST'])
+@admission_limited('batch')
+def batch_fix():
+    """Fix many installs, or queue fixes on fleet hosts, streaming NDJSON results.
+
+    Accepts 'paths', 'host_ids', 'parallelism' and 'force' in the JSON body.
+    """
+    force = bool((request.get_json(silent=True) or {}).get('force'))
+    return batch_response(lambda kind, value: batch.fix_install(value, force) if kind == 'path'
+                          else batch.fix_host(value), batch.MAX_FIX_PARALLELISM)
+
+@app.route('/api/fix-rollouts', methods=['POST'])
+@admission_limited('batch')
+def start_fix_rollout():
+    """Start fixing many installs or fleet hosts in verified waves.
+
+    Accepts 'paths', 'host_ids', 'wave_size', 'parallelism', 'failure_threshold'
+    (0 to 1) and 'force' in the JSON body.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        targets = batch.get_targets(data)
+        wave_size = int(data.get('wave_size') or 10)
+        parallelism = min(int(data.get('parallelism') or 4), batch.MAX_FIX_PARALLELISM)
+        failure_threshold = float(data.get('failure_threshold', 0.2))
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if not 0 <= failure_threshold <= 1:
+        return jsonify({'success': False, 'message': 'failure_threshold must be between 0 and 1'}), 400
+    try:
+        rollout_id = fix_orchestrator.start(targets, wave_size, parallelism, failure_threshold,
+                                            bool(data.get('force')))
+    except RuntimeError as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    return jsonify({'success': True, 'id': rollout_id}), 202
+
+@app.route('/api/fix-rollouts')
+def list_fix_rollouts():
+    """Get the most recent fix rollouts"""
+    return jsonify({'success': True, 'rollouts': database.get_rollouts()})
+
+@app.route('/api/fix-rollouts/<int(signed=True):rollout_id>')
+def get_fix_rollout(rollout_id):
+    """Get a fix rollout's progress with per-wave throughput and latency"""
+    rollout = fix_orchestrator.get_rollout(rollout_id)
+    if rollout is None:
+        return jsonify({'success': False, 'message': 'Unknown rollout'}), 404
+    return jsonify(dict(rollout, success=True))
+
+@app.route('/api/fix-rollouts/<int(signed=True):rollout_id>/cancel', methods=['POST'])
+def cancel_fix_rollout(rollout_id):
+    """Stop a fix rollout before its next wave"""
+    if not fix_orchestrator.cancel(rollout_id):
+        return jsonify({'success': False, 'message': 'Rollout is not running'}), 409
+    return jsonify({'success': True, 'message': 'Rollout will stop before its next wave'})
+
+@app.route('/api/inventory')
+@admission_limited('inventory')
+def export_inventory():
+    """Stream the install inventory as NDJSON or CSV.
+
+    Accepts 'format' (ndjson or csv) and 'since', the X-Inventory-Token of a
+    previous export, to get only the rows that changed after it.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        token, chunks = inventory.export(request.args.get('since'), fmt)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return Response(stream_with_context(chunks),
+                    mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={'X-Inventory-Token': token, 'Cache-Control': 'no-cache'})
+
+@app.route('/api/installs')
+def list_installs():
+    """Get every install the fixer has seen, with the selected one"""
+    try:
+        return jsonify({
+            'success': True,
+            'selected': get_selected_emby_path(),
+            'installs': database.get_installs()
+        })
+    except Exception as e:
+        error_msg = "Error listing installs: {}".format(str(e))
+        logging.error(error_msg)
+        return jsonify({
+            'success': False,
+            'message': error_msg
+        }), 500
+
+@app.route('/api/history')
+def operation_history():
+    """Get the operation history, newest first.
+
+    Accepts 'path', 'limit' (at most 500) and 'before_id' query parameters;
+    pass the returned 'next_before_id' as 'before_id' to get the next page.
+    """
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        before_id = request.args.get('before_id', type=int)
+        operations = database.get_history(request.args.get('path'), limit, before_id)
+        return jsonify({
+            'success': True,
+            'operations': operations,
+            'next_before_id': operations[-1]['id'] if len(operations) == limit else None
+        })
+    except Exception as e:
+        error_msg = "Error getting history: {}".format(str(e))
+        logging.error(error_msg)
+        return jsonify({
+            'success': False,
+            'message': error_msg
+        }), 500
+
+@app.route('/api/emby-server', methods=['POST'])
+def set_emby_server():
+    """Remember the Emby Server API address and key used to read its sessions"""
+    data = request.get_json(silent=True) or {}
+    url = data.get('url')
+    if not url:
+        return jsonify({'success': False, 'message': 'No Emby Server URL provided'}), 400
+    database.set_setting('emby_server_url', url)
+    database.set_setting('emby_api_key', data.get('api_key') or '')
+    return jsonify({'success': True, 'url': url})
+
+@app.route('/api/emby-server-status')
+@admission_limited('emby-server-status')
+def emby_server_status():
+    """Get the configured Emby Server's system info and transcoding state from its API"""
+    url = database.get_setting('emby_server_url')
+    if not url:
+        return jsonify({'success': False, 'message': 'No Emby Server URL configured'}), 404
+    try:
+        client = emby_clients.get_client(url, database.get_setting('emby_api_key') or None)
+        return jsonify({
+            'success': True,
+            'system_info': client.get_system_info(),
+            'transcoding': client.get_transcoding_state()
+        })
+    except EmbyClientError as e:
+        logging.warning(str(e))
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 502
+
+def fleet_error():
+    """Get the error response for a fleet request without the fleet token, None if it carries it."""
+    token = os.environ.get('EMBY_FIXER_FLEET_TOKEN')
+    if not token:
+        # Without a token anyone could register agents and queue commands on them
+        return jsonify({'success': False,
+                        'message': 'Fleet coordination is disabled, start with a fleet token to enable it'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Fleet-Token', '').encode('utf-8'), token.encode('utf-8')):
+        return jsonify({'success': False, 'message': 'Invalid fleet token'}), 403
+    return None
+
+@app.route('/api/fleet/report', methods=['POST'])
+def fleet_report():
+    """Receive an agent's status delta and answer with its queued commands"""
+    error = fleet_error()
+    if error:
+        return error
+    try:
+        report = decode_report(request.get_data(), request.headers.get('Content-Encoding'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': 'Invalid report: {}'.format(str(e))}), 400
+    try:
+        return jsonify(fleet_coordinator.receive_report(report))
+    except Exception as e:
+        error_msg = "Error applying fleet report: {}".format(str(e))
+        logging.error(error_msg)
+        return jsonify({
+            'success': False,
+            'message': error_msg
+        }), 500
+
+@app.route('/api/fleet/status')
+def fleet_status():
+    """Get the status of every host reporting to this coordinator"""
+    error = fleet_error()
+    if error:
+        return error
+    return jsonify(fleet_coordinator.get_status())
+
+@app.route('/api/fleet/command', methods=['POST'])
+def fleet_command():
+    """Queue a fix, restore or rescan for a host's agent"""
+    error = fleet_error()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    if not data.get('host_id'):
+        return jsonify({'success': False, 'message': 'No host_id provided'}), 400
+    result = fleet_coordinator.queue_command(data['host_id'], data.get('command'), data.get('path'))
+    return jsonify(result), 200 if result['success'] else 400
+
+@app.route('/api/fleet/commands')
+def fleet_commands():
+    """Get the most recent fleet commands and their outcomes"""
+    error = fleet_error()
+    if error:
+        return error
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    fleet_coordinator.expire_commands()
+    return jsonify({'success': True, 'commands': database.get_fleet_commands(request.args.get('host_id'), limit)})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request, operation, subprocess, cache and queue metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint to verify server status."""
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat(),
+        'warmup': warmup.get_progress()
+    })
+
 def run_process(cmd, shell=False):
     global CURRENT_PROCESS
     try:
@@ -682,9 +1160,246 @@ def run_process(cmd, shell=False):
         CURRENT_PROCESS = None
         raise e
 
+def parse_args(argv=None):
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description='Emby FFMPEG Fixer')
+    parser.add_argument('--server', choices=['waitress', 'async'], default='waitress',
+                        help='Serving mode: waitress thread pool (default) or asyncio event loop')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Worker threads for waitress, or for blocking work in async mode')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes; more than one shares state through a local database')
+    parser.add_argument('--data-dir', default=None,
+                        help='Directory for databases and runtime files (default: per-user data directory)')
+    parser.add_argument('--search-root', action='append', default=None,
+                        help='Directory to search for Emby Server installs (repeatable, replaces the defaults)')
+    parser.add_argument('--health-concurrency', type=int, default=2,
+                        help='Background install health checks run at once (0 disables them)')
+    parser.add_argument('--health-min-interval', type=int, default=30,
+                        help='Seconds between health checks of an install that just changed')
+    parser.add_argument('--health-max-interval', type=int, default=3600,
+                        help='Longest interval between health checks of a stable install')
+    parser.add_argument('--staging-budget-mb', type=int, default=1024,
+                        help='Disk space for replacements staged next to installs (0 disables staging)')
+    parser.add_argument('--staging-interval', type=int, default=300,
+                        help='Seconds between checks that the staged replacements are fresh')
+    parser.add_argument('--watch', action='store_true',
+                        help='Watch installs for Emby Server updates that replace FFMPEG')
+    parser.add_argument('--auto-fix', action='store_true',
+                        help='With --watch, fix an install as soon as its FFMPEG becomes incompatible')
+    parser.add_argument('--watch-debounce', type=float, default=2.0,
+                        help='Seconds without changes before a watched install is checked')
+    parser.add_argument('--log-scan-interval', type=float, default=10,
+                        help="Seconds between reads of new Emby log lines for FFMPEG failures (0 disables them)")
+    parser.add_argument('--agent', metavar='COORDINATOR_URL', default=None,
+                        help='Run headless, reporting install status to a coordinator fixer')
+    parser.add_argument('--agent-id', default=None,
+                        help='Host name reported by the agent (default: this host name)')
+    parser.add_argument('--agent-interval', type=int, default=30,
+                        help='Seconds between agent inspections')
+    parser.add_argument('--fleet-token', default=None,
+                        help='Shared token required between agents and the coordinator, fleet routes are disabled without it')
+    parser.add_argument('--export-inventory', choices=['ndjson', 'csv'], default=None,
+                        help='Write the install inventory to stdout in this format, then exit')
+    parser.add_argument('--since', default=None,
+                        help='With --export-inventory, only export changes after this token')
+    parser.add_argument('--import-profile', action='store_true',
+                        help='Report the time spent importing each module against the budget, then exit')
+    parser.add_argument('--import-budget', type=int, default=None,
+                        help='Import time budget in milliseconds for --import-profile')
+    return parser.parse_args(argv)
+
+def warm_install(emby_path):
+    """Fill the status caches for an install, as the check endpoints would."""
+    response_cache.get_or_compute('check-compatibility', emby_path,
+                                  lambda: compute_compatibility(emby_path, False), variant='local')
+    response_cache.get_or_compute('check-backup', emby_path, lambda: compute_backup_status(emby_path))
+    response_cache.get_or_compute('check-test-mode', emby_path, lambda: compute_test_mode_status(emby_path))
+
+def get_warmup_tasks():
+    """Get the discoveries and inspections to run in the background at startup."""
+    known_paths = []
+    for emby_path in (get_selected_emby_path(), get_default_emby_path()):
+        if emby_path and emby_path not in known_paths and os.path.exists(emby_path):
+            known_paths.append(emby_path)
+    
+    def discover_servers():
+        entry = response_cache.get_or_compute('list-emby-servers', None, compute_emby_servers)
+        servers = json.loads(entry.body).get('servers', [])
+        # Inspect discovered installs after the configured ones
+        return [('inspect ' + emby_path, functools.partial(warm_install, emby_path))
+                for emby_path in servers if emby_path not in known_paths]
+    
+    tasks = [('inspect ' + emby_path, functools.partial(warm_install, emby_path)) for emby_path in known_paths]
+    tasks.append(('discover servers', discover_servers))
+    if sys.platform == 'darwin':
+        # system_profiler takes seconds; remote clients need its answer
+        tasks.append(('hardware architecture', lambda: get_system_architecture('remote')))
+    return tasks
+
+def get_known_installs():
+    """Get the discovered installs and the selected one, for health checks."""
+    installs = set(find_emby_servers())
+    selected = get_selected_emby_path()
+    if selected and os.path.exists(selected):
+        installs.add(selected)
+    return installs
+
+def start_health_scheduler(args):
+    """Start the background health checks."""
+    if args.health_concurrency < 1:
+        return
+    health_scheduler.min_interval = args.health_min_interval
+    health_scheduler.max_interval = args.health_max_interval
+    health_scheduler.max_concurrent = args.health_concurrency
+    health_scheduler.start(get_known_installs)
+
+def get_staging_installs():
+    """Get the installs to stage replacements for, the selected one first."""
+    selected = get_selected_emby_path()
+    return sorted(get_known_installs(), key=lambda emby_path: (emby_path != selected, emby_path))
+
+def start_fix_staging(args):
+    """Start keeping replacements staged."""
+    if args.staging_budget_mb < 1:
+        return
+    fix_staging.budget = args.staging_budget_mb * 1024 * 1024
+    fix_staging.interval = args.staging_interval
+    fix_staging.start(get_staging_installs)
+
+def start_install_watcher(args):
+    """Start watching installs for FFMPEG changes."""
+    if not args.watch:
+        return
+    install_watcher.debounce = args.watch_debounce
+    install_watcher.auto_fix = args.auto_fix
+    install_watcher.start(get_known_installs)
+
+def start_log_analyzer(args):
+    """Start reading new Emby log lines in the background."""
+    if args.log_scan_interval <= 0:
+        return
+    log_analyzer.interval = args.log_scan_interval
+    log_analyzer.start(get_known_installs)
+
+def get_background_status():
+    """Get the status of the background services run by this process, to publish to the others."""
+    summary = log_analyzer.get_summary(1)
+    return {
+        'health-schedule': health_scheduler.get_schedule(),
+        'fix-staging': fix_staging.get_status(),
+        'watch-status': install_watcher.get_status(),
+        'log-analyzer': {key: summary[key] for key in ('running', 'last_pass', 'stats')}
+    }
+
+def publish_background_status():
+    """Publish the background services' status, so routes answered by other workers report it."""
+    while True:
+        try:
+            shared_store.set('background_status', 'status', {'at': time.time(), 'services': get_background_status()})
+        except Exception as e:
+            logging.warning(f"Could not publish background status: {e}")
+        time.sleep(BACKGROUND_STATUS_INTERVAL)
+
+def background_status(name, status):
+    """Get a background service's status, as published by the worker running it when that is another."""
+    if status['running'] or not shared_store.enabled:
+        return status
+    published = shared_store.get('background_status', 'status')
+    if not published or time.time() - published['at'] > 3 * BACKGROUND_STATUS_INTERVAL:
+        return status  # The worker running it is gone
+    return dict(status, **published['services'][name])
+
+def start_background_services(args):
+    """Start the health checks, staging, install watcher and log analyzer, in only one worker process.
+
+    They share one lock so they run in the same process: the watcher and the
+    log analyzer reset the health checks of the installs they change or find
+    failing.
+    """
+    global BACKGROUND_LOCK
+    lock = InstanceLock(os.path.join(get_data_dir(), 'background.lock'))
+    if not lock.acquire():
+        return
+    BACKGROUND_LOCK = lock  # Held for the life of the process
+    start_health_scheduler(args)
+    start_fix_staging(args)
+    start_install_watcher(args)
+    start_log_analyzer(args)
+    if shared_store.enabled:
+        threading.Thread(target=publish_background_status, daemon=True, name='background-status').start()
+
+def serve_app(args, sock):
+    """Serve the app on the listening socket in the selected server mode."""
+    # Runs in every worker process, since caches are per process
+    warmup.start(get_warmup_tasks())
+    if shared_store.enabled:
+        # Each worker publishes its metrics, so a scrape answered by any worker covers all of them
+        metrics.start_publishing(shared_store)
+    start_background_services(args)
+    if args.server == 'async':
+        # Event loop server for many idle, streaming and long-polling clients
+        from core.async_server import AsyncServer
+        AsyncServer(app, APP_HOST, APP_PORT, max_workers=args.threads).serve_forever(sock)
+    else:
+        # Use waitress instead of Flask's development server
+        from waitress import serve
+        # send_bytes=1 flushes every write, so streamed lines are not held back
+        serve(app, sockets=[sock], threads=args.threads, send_bytes=1)
+
+def bind_listen_socket():
+    """Bind the configured port, or the first free fallback port if it is taken."""
+    global APP_PORT
+    try:
+        return create_listen_socket(APP_HOST, APP_PORT)
+    except OSError as e:
+        logging.warning("Port {} is not available ({}), looking for another one".format(APP_PORT, e))
+    port = find_available_port()
+    if port is None:
+        raise RuntimeError("No available port found")
+    APP_PORT = port
+    return create_listen_socket(APP_HOST, APP_PORT)
+
+def run_agent(args):
+    """Run headless, inspecting local installs and reporting to a coordinator."""
+    from core.fleet import FleetAgent
+    if not os.environ.get('EMBY_FIXER_FLEET_TOKEN'):
+        logging.error("A fleet token is required to report to a coordinator, pass --fleet-token")
+        sys.exit(1)
+    agent_lock = InstanceLock(os.path.join(get_data_dir(), 'agent.lock'))
+    if not agent_lock.acquire():
+        logging.error("Another agent is already running with data directory {}".format(get_data_dir()))
+        sys.exit(1)
+    database.open(os.path.join(get_data_dir(), 'fixer.db'))
+    journal.open(os.path.join(get_data_dir(), 'journal.db'))
+    journal.recover()
+    start_install_watcher(args)
+    FleetAgent(args.agent, args.agent_id, args.agent_interval,
+               os.environ.get('EMBY_FIXER_FLEET_TOKEN')).run_forever()
+
+def run_inventory_export(args):
+    """Write the inventory to stdout and the token for the next export to stderr."""
+    # The data goes to stdout, so log to stderr
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+    database.open(os.path.join(get_data_dir(), 'fixer.db'))
+    try:
+        token, chunks = inventory.export(args.since, args.export_inventory)
+    except ValueError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 2
+    for chunk in chunks:
+        sys.stdout.write(chunk)
+    sys.stdout.flush()
+    print("Next token: {}".format(token), file=sys.stderr)
+    return 0
+
 def main():
     """Main entry point for the application"""
     try:
+        args = parse_args()
+        
         # Configure logging first
         if not os.path.exists('logs'):
             os.makedirs('logs')
@@ -698,20 +1413,57 @@ def main():
             ]
         )
 
-        # Kill any existing Flask processes
-        kill_existing_flask()
-        time.sleep(2)  # Give processes more time to die
+        if args.data_dir:
+            os.environ['EMBY_FIXER_DATA_DIR'] = os.path.abspath(args.data_dir)
+        if args.search_root:
+            os.environ['EMBY_FIXER_SEARCH_ROOTS'] = os.pathsep.join(os.path.abspath(root) for root in args.search_root)
+        if args.fleet_token:
+            os.environ['EMBY_FIXER_FLEET_TOKEN'] = args.fleet_token
         
-        # Check if port is in use
-        if is_port_in_use(APP_PORT):
-            logging.error("Port {} is already in use".format(APP_PORT))
-            sys.exit(1)
-            
+        if args.agent:
+            run_agent(args)
+            return
+        if args.export_inventory:
+            sys.exit(run_inventory_export(args))
+        
+        # Only one instance per data directory; hand over to a running one
+        instance_lock = InstanceLock(os.path.join(get_data_dir(), 'instance.lock'))
+        if not instance_lock.acquire():
+            port = find_running_instance(instance_lock)
+            if port is None:
+                logging.error("Another instance holds the instance lock but is not responding")
+                sys.exit(1)
+            logging.info("Application is already running on port {}".format(port))
+            print("Application is already running at http://localhost:{}".format(port))
+            sys.exit(0)
+        
+        sock = bind_listen_socket()
+        instance_lock.set_port(APP_PORT)
         logging.info("Starting application on {}:{}".format(APP_HOST, APP_PORT))
         print("Starting application on {}:{}".format(APP_HOST, APP_PORT))
         
-        # Use waitress instead of Flask's development server
-        serve(app, host=APP_HOST, port=APP_PORT)
+        # Recover the selected install from the previous run
+        database.open(os.path.join(get_data_dir(), 'fixer.db'))
+        app.config['EMBY_PATH'] = database.get_setting('emby_path')
+        interrupted = database.interrupt_rollouts()
+        if interrupted:
+            logging.warning("Marked {} fix rollouts left running by the previous run as interrupted".format(
+                interrupted))
+        
+        # Finish or roll back operations interrupted by a crash before serving
+        journal.open(os.path.join(get_data_dir(), 'journal.db'))
+        journal.recover()
+        
+        if args.workers > 1:
+            # Pre-fork: workers share one listening socket and keep state in the shared store
+            global SUPERVISOR_PID
+            from core.prefork import run_prefork
+            SUPERVISOR_PID = os.getpid()
+            shared_store.open(os.path.join(get_data_dir(), 'shared_state.db'))
+            logging.info("Starting {} worker processes".format(args.workers))
+            run_prefork(lambda: serve_app(args, sock), args.workers)
+        else:
+            serve_app(args, sock)
         
     except Exception as e:
         logging.error("Error starting application: {}".format(e), exc_info=True)
@@ -732,12 +1484,3 @@ if __name__ == '__main__':
     except Exception as e:
         logging.error("Fatal error: {}".format(e), exc_info=True)
         sys.exit(1)
-
-# Add a health check endpoint
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint to verify server status."""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat()
-    })
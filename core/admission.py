@@ -0,0 +1,309 @@
+"""
+Admission control module for Emby FFMPEG Fixer.
+Limits how many expensive operations run at once, how many may queue behind
+them and how fast each client may call them, so that a misbehaving client
+cannot starve the fixer or the Emby host it shares disk and CPU with.
+With several worker processes, slots, queues and token buckets are kept in
+the shared store, so the limits hold for the whole server, not each worker.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from .metrics import metrics
+from .shared_store import shared_store
+
+# Per-endpoint limits. max_concurrent/max_queue bound in-flight and waiting
+# requests, queue_timeout bounds how long a request may wait for a slot and
+# rate/burst configure each client's token bucket (requests per second).
+ADMISSION_POLICIES = {
+    'fix-ffmpeg': {'max_concurrent': 1, 'max_queue': 2, 'queue_timeout': 30, 'rate': 0.2, 'burst': 2},
+    'restore-ffmpeg': {'max_concurrent': 1, 'max_queue': 2, 'queue_timeout': 30, 'rate': 0.2, 'burst': 2},
+    'force-test-mode': {'max_concurrent': 1, 'max_queue': 2, 'queue_timeout': 30, 'rate': 0.2, 'burst': 2},
+    'stop-process': {'max_concurrent': 1, 'max_queue': 1, 'queue_timeout': 30, 'rate': 0.5, 'burst': 2},
+    'check-compatibility': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'check-backup': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'check-test-mode': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'install-status': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'list-emby-servers': {'max_concurrent': 2, 'max_queue': 8, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'browse-emby': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 10, 'burst': 20},
+    'emby-server-status': {'max_concurrent': 4, 'max_queue': 16, 'queue_timeout': 10, 'rate': 5, 'burst': 10},
+    'batch': {'max_concurrent': 2, 'max_queue': 4, 'queue_timeout': 10, 'rate': 1, 'burst': 5},
+    'inventory': {'max_concurrent': 2, 'max_queue': 4, 'queue_timeout': 30, 'rate': 1, 'burst': 5},
+}
+
+# Token buckets idle for this long are full again and can be forgotten
+BUCKET_IDLE_SECONDS = 600
+SHARED_POLL_INTERVAL = 0.05  # Seconds between checks for a slot freed by another worker
+
+def _pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+def _take_shared_token(bucket, policy):
+    # A token bucket kept in the shared store, with wall-clock times all workers agree on
+    now = time.time()
+    tokens = policy['burst'] if bucket is None else \
+        min(policy['burst'], bucket['tokens'] + (now - bucket['updated']) * policy['rate'])
+    wait = 0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        wait = (1 - tokens) / policy['rate']
+    return {'tokens': tokens, 'updated': now}, wait
+
+def _count_shared(slots, name):
+    return sum(slots[name].values())
+
+def _live_slots(slots):
+    # Slots and queue places held by workers that died are given back
+    slots = slots or {'in_flight': {}, 'queued': {}}
+    for name in ('in_flight', 'queued'):
+        slots[name] = {pid: count for pid, count in slots[name].items() if count > 0 and _pid_alive(pid)}
+    return slots
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token. Returns the number of seconds to wait if none is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Admission:
+    def __init__(self, controller, endpoint, granted, reason=None, retry_after=0):
+        self._controller = controller
+        self.endpoint = endpoint
+        self.granted = granted
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after))) if not granted else 0
+        self._started = time.monotonic()
+
+    def release(self):
+        """Release the slot held by a granted admission."""
+        if self.granted:
+            self.granted = False
+            self._controller._release(self.endpoint, time.monotonic() - self._started)
+
+class EndpointState:
+    def __init__(self, policy):
+        self.policy = policy
+        self.in_flight = 0
+        self.queued = 0
+        self.avg_duration = 1.0
+        self.admitted = 0
+        self.rejected = {'rate_limited': 0, 'queue_full': 0, 'queue_timeout': 0}
+        self.max_queue_wait = 0.0
+
+class AdmissionController:
+    def __init__(self, policies=None, store=shared_store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._endpoints = {name: EndpointState(policy)
+                           for name, policy in (policies or ADMISSION_POLICIES).items()}
+        self._buckets = {}
+        self._last_prune = time.monotonic()
+
+    def try_acquire(self, endpoint, client_id):
+        """Try to admit a request, waiting in the endpoint's queue if it is busy.
+
+        Args:
+            endpoint (str): Name of the endpoint being called
+            client_id (str): Identity of the caller, usually its IP address
+
+        Returns:
+            Admission: Granted admission to release when done, or a rejection with retry_after
+        """
+        if self._store.enabled and endpoint in self._endpoints:
+            return self._try_acquire_shared(endpoint, client_id)
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            if state is None:
+                return Admission(self, endpoint, True)
+            policy = state.policy
+
+            wait = self._get_bucket(endpoint, client_id, policy).take()
+            if wait:
+                return self._reject(state, endpoint, client_id, 'rate_limited', wait)
+
+            if state.in_flight >= policy['max_concurrent']:
+                if state.queued >= policy['max_queue']:
+                    return self._reject(state, endpoint, client_id, 'queue_full',
+                                        state.avg_duration * (state.queued + 1) / policy['max_concurrent'])
+
+                state.queued += 1
+                queued_at = time.monotonic()
+                deadline = queued_at + policy['queue_timeout']
+                try:
+                    while state.in_flight >= policy['max_concurrent']:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._reject(state, endpoint, client_id, 'queue_timeout', state.avg_duration)
+                        self._slot_freed.wait(remaining)
+                finally:
+                    state.queued -= 1
+                    waited = time.monotonic() - queued_at
+                    state.max_queue_wait = max(state.max_queue_wait, waited)
+                    QUEUE_WAIT_SECONDS.observe(waited, endpoint=endpoint)
+
+            state.in_flight += 1
+            state.admitted += 1
+            return Admission(self, endpoint, True)
+
+    def _try_acquire_shared(self, endpoint, client_id):
+        # Same policy as try_acquire, with the counters of every worker
+        state = self._endpoints[endpoint]
+        policy = state.policy
+        pid = str(os.getpid())
+        now = time.monotonic()
+        if now - self._last_prune > BUCKET_IDLE_SECONDS:
+            self._store.expire('admission_buckets', BUCKET_IDLE_SECONDS)
+            self._last_prune = now
+        wait = self._store.update('admission_buckets', '{} {}'.format(endpoint, client_id),
+                                  lambda bucket: _take_shared_token(bucket, policy))
+        if wait:
+            with self._lock:
+                return self._reject(state, endpoint, client_id, 'rate_limited', wait)
+
+        def enter(slots):
+            slots = _live_slots(slots)
+            if _count_shared(slots, 'in_flight') < policy['max_concurrent']:
+                slots['in_flight'][pid] = slots['in_flight'].get(pid, 0) + 1
+                return slots, 'granted'
+            if _count_shared(slots, 'queued') >= policy['max_queue']:
+                return slots, 'queue_full'
+            slots['queued'][pid] = slots['queued'].get(pid, 0) + 1
+            return slots, 'queued'
+
+        def claim(slots):
+            # Called while queued: take a freed slot, or give up the queue place on timeout
+            slots = _live_slots(slots)
+            timed_out = time.monotonic() >= deadline
+            if _count_shared(slots, 'in_flight') < policy['max_concurrent'] or timed_out:
+                slots['queued'][pid] = slots['queued'].get(pid, 0) - 1
+                if timed_out:
+                    return slots, False
+                slots['in_flight'][pid] = slots['in_flight'].get(pid, 0) + 1
+                return slots, True
+            return slots, None
+
+        outcome = self._store.update('admission', endpoint, enter)
+        if outcome == 'queue_full':
+            queued = _count_shared(_live_slots(self._store.get('admission', endpoint)), 'queued')
+            with self._lock:
+                return self._reject(state, endpoint, client_id, 'queue_full',
+                                    state.avg_duration * (queued + 1) / policy['max_concurrent'])
+        if outcome == 'queued':
+            queued_at = time.monotonic()
+            deadline = queued_at + policy['queue_timeout']
+            with self._lock:
+                state.queued += 1
+            try:
+                while True:
+                    claimed = self._store.update('admission', endpoint, claim)
+                    if claimed is not None:
+                        break
+                    with self._lock:
+                        # Woken early by a release in this process
+                        self._slot_freed.wait(SHARED_POLL_INTERVAL)
+            finally:
+                waited = time.monotonic() - queued_at
+                with self._lock:
+                    state.queued -= 1
+                    state.max_queue_wait = max(state.max_queue_wait, waited)
+                QUEUE_WAIT_SECONDS.observe(waited, endpoint=endpoint)
+            if not claimed:
+                with self._lock:
+                    return self._reject(state, endpoint, client_id, 'queue_timeout', state.avg_duration)
+        with self._lock:
+            state.in_flight += 1
+            state.admitted += 1
+        return Admission(self, endpoint, True)
+
+    def _release(self, endpoint, duration):
+        if self._store.enabled:
+            pid = str(os.getpid())
+
+            def leave(slots):
+                slots = _live_slots(slots)
+                slots['in_flight'][pid] = slots['in_flight'].get(pid, 0) - 1
+                return slots, None
+
+            self._store.update('admission', endpoint, leave)
+        with self._lock:
+            state = self._endpoints[endpoint]
+            state.in_flight -= 1
+            # Exponentially weighted average, used to estimate Retry-After
+            state.avg_duration = 0.8 * state.avg_duration + 0.2 * duration
+            self._slot_freed.notify_all()
+
+    def _reject(self, state, endpoint, client_id, reason, retry_after):
+        state.rejected[reason] += 1
+        logging.warning(f"Rejected {endpoint} request from {client_id}: {reason}")
+        return Admission(self, endpoint, False, reason, retry_after)
+
+    def _get_bucket(self, endpoint, client_id, policy):
+        now = time.monotonic()
+        if now - self._last_prune > BUCKET_IDLE_SECONDS:
+            self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                             if now - bucket.updated < BUCKET_IDLE_SECONDS}
+            self._last_prune = now
+        key = (endpoint, client_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(policy['rate'], policy['burst'])
+        return bucket
+
+    def get_stats(self):
+        """Get admission and rejection counters per endpoint.
+
+        With several workers, 'in_flight' and 'queued' are those of all
+        workers, the other counters this worker's.
+        """
+        shared = {}
+        if self._store.enabled:
+            for name in self._endpoints:
+                slots = _live_slots(self._store.get('admission', name))
+                shared[name] = (_count_shared(slots, 'in_flight'), _count_shared(slots, 'queued'))
+        with self._lock:
+            return {
+                name: {
+                    'in_flight': shared[name][0] if name in shared else state.in_flight,
+                    'queued': shared[name][1] if name in shared else state.queued,
+                    'admitted': state.admitted,
+                    'rejected': dict(state.rejected),
+                    'max_queue_wait': round(state.max_queue_wait, 3),
+                    'avg_duration': round(state.avg_duration, 3)
+                }
+                for name, state in self._endpoints.items()
+            }
+
+# Create a global instance
+admission_controller = AdmissionController()
+
+QUEUE_WAIT_SECONDS = metrics.histogram('admission_queue_wait_seconds', 'Time requests waited in an endpoint queue',
+                                       ('endpoint',))
+metrics.callback('admission_in_flight', 'Requests being served, by admission-controlled endpoint', ('endpoint',),
+                 lambda: [((name,), stats['in_flight']) for name, stats in admission_controller.get_stats().items()])
+metrics.callback('admission_queue_depth', 'Requests waiting for a slot, by admission-controlled endpoint',
+                 ('endpoint',),
+                 lambda: [((name,), stats['queued']) for name, stats in admission_controller.get_stats().items()])
+metrics.callback('admission_rejected_total', 'Requests rejected, by endpoint and reason', ('endpoint', 'reason'),
+                 lambda: [((name, reason), count) for name, stats in admission_controller.get_stats().items()
+                          for reason, count in stats['rejected'].items()], metric_type='counter')
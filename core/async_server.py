@@ -0,0 +1,445 @@
+"""
+Asyncio server module for Emby FFMPEG Fixer.
+An alternative to waitress that keeps idle, long-polling and streaming
+connections on an event loop instead of pinning a worker thread each.
+Health, log streaming and install status are served by native async
+handlers; every other request is dispatched to the Flask app on a thread pool.
+"""
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import unquote, parse_qs
+from .admission import admission_controller
+from .install_status import collect_install_status, STATUS_FIELDS
+from .metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS
+from .process_manager import process_manager
+from .response_cache import response_cache
+from .state_manager import state_manager
+from .discovery import discovery
+from .utils import is_remote_address
+from .warmup import warmup
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 16 * 1024 * 1024
+IDLE_TIMEOUT = 300  # Seconds an idle keep-alive connection is kept open
+LOG_POLL_INTERVAL = 0.5
+STATUS_POLL_INTERVAL = 1.0
+MAX_STATUS_WAIT = 60
+INSTALL_STATUS_ROUTE = '/api/install-status'  # Metrics label shared with the Flask route
+
+class HttpRequest:
+    def __init__(self, method, target, version, headers, body, peer):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.peer = peer
+        self.path, _, self.query_string = target.partition('?')
+        self.query = {key: values[-1] for key, values in parse_qs(self.query_string).items()}
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+class StatusWatch:
+    """An install status being long-polled, and the requests waiting for it to change."""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.changed = asyncio.Event()  # Replaced by a new event each time it is set
+        self.waiters = 0
+        self.poller = None
+
+    def update(self, entry):
+        """Record a changed status and wake the requests waiting for it."""
+        self.entry = entry
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class AsyncServer:
+    def __init__(self, wsgi_app, host, port, log_file=os.path.join('logs', 'emby_ffmpeg_fixer.log'),
+                 max_workers=16):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.log_file = log_file
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-worker')
+        self.open_connections = 0
+        self._status_watches = {}  # (path, fields, remote) -> StatusWatch
+        self._routes = {
+            ('GET', '/health'): self._handle_health,
+            ('GET', '/api/stream-logs'): self._handle_stream_logs,
+            ('GET', '/api/install-status'): self._handle_install_status,
+        }
+
+    def serve_forever(self, sock=None):
+        """Run the event loop until interrupted."""
+        try:
+            asyncio.run(self._serve(sock))
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def _serve(self, sock=None):
+        if sock is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=sock, limit=MAX_HEADER_BYTES)
+        else:
+            server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                limit=MAX_HEADER_BYTES, reuse_address=True, backlog=1024)
+        logging.info(f"Async server listening on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def run_blocking(self, func, *args):
+        """Run blocking (filesystem, subprocess) work on the executor."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _handle_connection(self, reader, writer):
+        self.open_connections += 1
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                request = await self._read_request(reader, writer, peer)
+                if request is None:
+                    break
+                keep_alive = await self._dispatch(request, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error(f"Error handling async connection: {e}", exc_info=True)
+        finally:
+            self.open_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader, writer, peer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        except asyncio.LimitOverrunError:
+            await self._send_simple(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, keep_alive=False)
+            return None
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            await self._send_simple(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            headers[name] = headers[name] + ', ' + value.strip() if name in headers else value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            await self._send_simple(writer, HTTPStatus.LENGTH_REQUIRED, keep_alive=False)
+            return None
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self._send_simple(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return None
+        if length > MAX_BODY_BYTES:
+            await self._send_simple(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+            return None
+        body = await reader.readexactly(length) if length else b''
+        return HttpRequest(method.upper(), target, version, headers, body, peer)
+
+    async def _dispatch(self, request, writer):
+        handler = self._routes.get((request.method, request.path))
+        if handler is not None:
+            try:
+                return await handler(request, writer)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                logging.error(f"Error in async handler for {request.path}: {e}", exc_info=True)
+                return await self._send_json(writer, {'success': False, 'message': str(e)},
+                                             HTTPStatus.INTERNAL_SERVER_ERROR, request.keep_alive)
+        return await self._call_wsgi(request, writer)
+
+    async def _send_simple(self, writer, status, keep_alive):
+        return await self._send(writer, status, [('Content-Type', 'text/plain')],
+                                status.phrase.encode('utf-8'), keep_alive)
+
+    async def _send_json(self, writer, payload, status=HTTPStatus.OK, keep_alive=True, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        return await self._send(writer, status, [('Content-Type', 'application/json')] + (headers or []),
+                                body, keep_alive)
+
+    async def _send(self, writer, status, headers, body, keep_alive):
+        head = ['HTTP/1.1 {} {}'.format(status.value, status.phrase)]
+        head.extend('{}: {}'.format(name, value) for name, value in headers)
+        head.append('Content-Length: {}'.format(len(body)))
+        head.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        return keep_alive
+
+    async def _handle_health(self, request, writer):
+        return await self._send_json(writer, {
+            'status': 'healthy',
+            'timestamp': datetime.now().isoformat(),
+            'server': 'async',
+            'open_connections': self.open_connections,
+            'warmup': warmup.get_progress()
+        }, keep_alive=request.keep_alive)
+
+    async def _handle_install_status(self, request, writer):
+        """Serve install status, optionally long-polling until it changes.
+
+        With ?wait=N and If-None-Match, the request is held for up to N seconds
+        until the status ETag changes; it answers 304 if nothing changed. The
+        status is polled once per STATUS_POLL_INTERVAL however many wait for it.
+        Requests are counted and timed like the Flask route's, excluding the
+        time spent waiting for a change.
+        """
+        started = time.perf_counter()
+
+        async def respond(status, headers, body):
+            HTTP_REQUESTS.inc(route=INSTALL_STATUS_ROUTE, method=request.method, status=status.value)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=INSTALL_STATUS_ROUTE,
+                                         method=request.method)
+            return await self._send(writer, status, headers, body, request.keep_alive)
+
+        def respond_json(payload, status, headers=()):
+            return respond(status, [('Content-Type', 'application/json')] + list(headers),
+                           json.dumps(payload).encode('utf-8'))
+
+        emby_path = request.query.get('path') or None
+        fields = [field.strip() for field in request.query.get('fields', '').split(',') if field.strip()]
+        fields = tuple(sorted(set(fields or STATUS_FIELDS)))
+        unknown = [field for field in fields if field not in STATUS_FIELDS]
+        if unknown:
+            return await respond_json({
+                'success': False,
+                'message': 'Unknown status fields: {}'.format(', '.join(unknown))
+            }, HTTPStatus.BAD_REQUEST)
+
+        client_ip = request.peer[0] if request.peer else ''
+        is_remote_access = is_remote_address(client_ip)
+        if_none_match = request.headers.get('if-none-match', '').replace('W/', '')
+        known_etags = {tag.strip().strip('"') for tag in if_none_match.split(',') if tag.strip()}
+        try:
+            wait = min(float(request.query.get('wait', 0)), MAX_STATUS_WAIT)
+        except ValueError:
+            wait = 0
+        deadline = asyncio.get_running_loop().time() + wait
+
+        admission = await self.run_blocking(admission_controller.try_acquire, 'install-status', client_ip)
+        if not admission.granted:
+            return await respond_json({
+                'success': False,
+                'message': 'Too many install-status requests, retry in {} seconds'.format(admission.retry_after),
+                'reason': admission.reason
+            }, HTTPStatus.TOO_MANY_REQUESTS, [('Retry-After', str(admission.retry_after))])
+
+        try:
+            entry = await self._get_install_status(emby_path, fields, is_remote_access)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            error_msg = "Error getting install status: {}".format(str(e))
+            logging.error(error_msg)
+            return await respond_json({'success': False, 'message': error_msg}, HTTPStatus.INTERNAL_SERVER_ERROR)
+        finally:
+            admission.release()
+
+        if entry.etag in known_etags and entry.status == 200:
+            # Long-poll: every request waiting on the same status shares one poller
+            key = (emby_path, fields, is_remote_access)
+            watch = self._status_watches.get(key)
+            if watch is None:
+                watch = self._status_watches[key] = StatusWatch(entry)
+                watch.poller = asyncio.get_running_loop().create_task(self._poll_status(key, watch))
+            elif watch.entry.etag != entry.etag:
+                watch.update(entry)  # Fresher than the poller's last result
+            watch.waiters += 1
+            try:
+                while watch.entry.etag in known_etags and watch.entry.status == 200:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        return await respond(HTTPStatus.NOT_MODIFIED,
+                                             [('ETag', '"{}"'.format(watch.entry.etag)),
+                                              ('Cache-Control', 'no-cache')], b'')
+                    paused = time.perf_counter()
+                    try:
+                        await asyncio.wait_for(watch.changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    started += time.perf_counter() - paused
+                entry = watch.entry
+            finally:
+                watch.waiters -= 1
+
+        return await respond(HTTPStatus(entry.status),
+                             [('Content-Type', 'application/json'),
+                              ('ETag', '"{}"'.format(entry.etag)),
+                              ('Cache-Control', 'no-cache')],
+                             entry.body)
+
+    async def _get_install_status(self, emby_path, fields, is_remote_access):
+        # Use the same cache key as the Flask endpoint so both modes share entries
+        is_processing = process_manager.is_running if 'process_state' in fields else None
+        return await self.run_blocking(
+            response_cache.get_or_compute, 'install-status', emby_path,
+            lambda: (collect_install_status(emby_path, fields, is_remote_access), 200),
+            (fields, is_remote_access, is_processing, state_manager.is_main_app_running()),
+            discovery.get_watch_paths())
+
+    async def _poll_status(self, key, watch):
+        """Poll one install status for all the requests waiting on it, waking them when it changes."""
+        try:
+            while True:
+                await asyncio.sleep(STATUS_POLL_INTERVAL)
+                if not watch.waiters:
+                    return
+                try:
+                    entry = await self._get_install_status(*key)
+                except Exception as e:
+                    logging.warning(f"Could not poll install status of {key[0]}: {e}")
+                    continue
+                if entry.etag != watch.entry.etag or entry.status != watch.entry.status:
+                    watch.update(entry)
+        finally:
+            del self._status_watches[key]
+
+    async def _handle_stream_logs(self, request, writer):
+        """Stream new log lines as server-sent events until the client disconnects.
+
+        Starts from ?offset=N (bytes) if given, otherwise from the end of the log.
+        """
+        try:
+            offset = int(request.query['offset']) if 'offset' in request.query else None
+        except ValueError:
+            offset = None
+        if offset is None:
+            offset = await self.run_blocking(lambda: os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0)
+
+        writer.write(('HTTP/1.1 200 OK\r\n'
+                      'Content-Type: text/event-stream\r\n'
+                      'Cache-Control: no-cache\r\n'
+                      'Access-Control-Allow-Origin: *\r\n'
+                      'Connection: close\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        pending = b''
+        while not writer.is_closing():
+            chunk, offset = await self.run_blocking(self._read_log_from, offset)
+            if chunk:
+                pending += chunk
+                *lines, pending = pending.split(b'\n')
+                events = ''.join('id: {}\ndata: {}\n\n'.format(offset - len(pending), line.decode('utf-8', 'replace'))
+                                 for line in lines if line)
+                writer.write(events.encode('utf-8'))
+            else:
+                # Comment line keeps proxies from timing out the idle stream
+                writer.write(b': keep-alive\n\n')
+            await writer.drain()
+            await asyncio.sleep(LOG_POLL_INTERVAL)
+        return False
+
+    def _read_log_from(self, offset):
+        try:
+            with open(self.log_file, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                if size < offset:
+                    offset = 0  # Log was truncated or rotated
+                f.seek(offset)
+                chunk = f.read(1024 * 1024)
+                return chunk, offset + len(chunk)
+        except OSError:
+            return b'', offset
+
+    async def _call_wsgi(self, request, writer):
+        """Run the request through the WSGI app on the executor, streaming its body back."""
+        environ = self._build_environ(request)
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = status
+            response_start['headers'] = headers
+            return lambda data: None
+
+        def run_app():
+            result = self.wsgi_app(environ, start_response)
+            return result, iter(result)
+
+        result, iterator = await self.run_blocking(run_app)
+        try:
+            status = response_start['status']
+            headers = [(name, value) for name, value in response_start['headers']
+                       if name.lower() not in ('connection', 'transfer-encoding')]
+            has_length = any(name.lower() == 'content-length' for name, _ in headers)
+            keep_alive = request.keep_alive and (has_length or request.version == 'HTTP/1.1')
+            if not has_length and keep_alive:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+            head = ['HTTP/1.1 {}'.format(status)] + ['{}: {}'.format(name, value) for name, value in headers]
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+            chunked = not has_length and keep_alive
+            while True:
+                chunk = await self.run_blocking(next, iterator, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return keep_alive
+        finally:
+            if hasattr(result, 'close'):
+                await self.run_blocking(result.close)
+
+    def _build_environ(self, request):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(request.path, encoding='latin-1'),
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': request.peer[0] if request.peer else '',
+            'CONTENT_TYPE': request.headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            if name in ('content-type', 'content-length'):
+                continue
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
@@ -0,0 +1,146 @@
+"""
+Batch module for Emby FFMPEG Fixer.
+Checks or fixes many installs, or fleet hosts, in one request. Targets run
+concurrently on a bounded thread pool and each result is yielded as soon
+as it finishes, for streaming as one NDJSON line per target.
+"""
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .database import database
+from .fleet import fleet_coordinator
+from .shared_store import shared_store
+from .response_cache import response_cache
+from .health_scheduler import health_scheduler
+from .install_status import inspect_install
+from .emby_processes import emby_process_monitor
+from .operations import fix_ffmpeg_compatibility
+from .utils import create_backup
+
+DEFAULT_PARALLELISM = 8
+MAX_PARALLELISM = 32
+MAX_FIX_PARALLELISM = 4  # Fixes a batch or rollout runs at once
+MAX_CONCURRENT_FIXES = 2  # Fixes running at once in all batches, rollouts and fix requests
+MAX_TARGETS = 1000
+
+def check_install(emby_path):
+    """Check one install for a batch."""
+    if not os.path.exists(emby_path):
+        return {"success": False, "message": "Emby Server path does not exist"}
+    return dict(inspect_install(emby_path), success=True)
+
+def backup_install(emby_path):
+    """Back a whole install up before a fix, recording the backup."""
+    backup_result = create_backup(emby_path)
+    if backup_result["success"]:
+        database.record_backup(emby_path, 'pre-fix', backup_result['backup_dir'])
+    return backup_result
+
+def fix_slot():
+    """Hold one of the fix slots shared by every worker.
+
+    A fix may copy a whole install before replacing its binaries, so only a
+    few run at once however many batches or rollouts ask for them.
+    """
+    return shared_store.semaphore('fixes', MAX_CONCURRENT_FIXES)
+
+def fix_install(emby_path, force=False):
+    """Fix one install for a batch, with the same guards as the fix endpoint."""
+    if not os.path.exists(emby_path):
+        return {"success": False, "message": "Emby Server path does not exist"}
+    if not force and emby_process_monitor.get_active_transcodes(emby_path):
+        return {"success": False, "message": "Emby Server is transcoding, retry when it finishes or set force"}
+    # Same order as the fix endpoint: the install lock, then a fix slot
+    with shared_store.lock('install-{}'.format(emby_path)), fix_slot():
+        operation_id = database.start_operation(emby_path, 'fix')
+        result = {"success": False, "message": None}
+        try:
+            try:
+                result = fix_ffmpeg_compatibility(emby_path, backup=lambda: backup_install(emby_path))
+            finally:
+                response_cache.invalidate(emby_path)
+            return result
+        finally:
+            database.finish_operation(operation_id, result.get('success'), result.get('message'))
+            health_scheduler.reset(emby_path)
+
+def check_host(host_id):
+    """Get a fleet host's last reported status for a batch."""
+    for host in database.get_fleet_hosts():
+        if host['host_id'] == host_id:
+            return dict(host, success=True)
+    return {"success": False, "message": "Unknown fleet host"}
+
+def fix_host(host_id):
+    """Queue a fix of every install of a fleet host for a batch."""
+    host = check_host(host_id)
+    if not host['success']:
+        return host
+    queued = [fleet_coordinator.queue_command(host_id, 'fix', install['path'])['id']
+              for install in host['installs'] if install.get('is_compatible') is False]
+    return {"success": True, "message": "Queued {} fixes".format(len(queued)), "command_ids": queued}
+
+def get_targets(data):
+    """Get the targets of a batch request body.
+
+    Returns:
+        list: ('path', value) and ('host_id', value) pairs
+
+    Raises:
+        ValueError: If the body names no targets or too many
+    """
+    targets = [('path', path) for path in data.get('paths') or []]
+    targets += [('host_id', host_id) for host_id in data.get('host_ids') or []]
+    if not targets:
+        raise ValueError("No paths or host_ids provided")
+    if len(targets) > MAX_TARGETS:
+        raise ValueError("At most {} targets are allowed per batch".format(MAX_TARGETS))
+    if not all(isinstance(value, str) and value for _, value in targets):
+        raise ValueError("Paths and host_ids must be non-empty strings")
+    return targets
+
+def run_batch(targets, run_target, parallelism=DEFAULT_PARALLELISM, max_parallelism=MAX_PARALLELISM):
+    """Run a function on each target concurrently, yielding results as they finish.
+
+    Args:
+        targets (list): (kind, value) pairs from get_targets
+        run_target (callable): Called with (kind, value), returns a result dict
+        parallelism (int): Targets processed at once, capped at max_parallelism
+        max_parallelism (int): Cap on parallelism, lower for fixes than for checks
+
+    Yields:
+        dict: One result per target in completion order, with its 'index', then a
+            final summary with 'done' set
+    """
+    started = time.time()
+    parallelism = max(1, min(parallelism or DEFAULT_PARALLELISM, max_parallelism, len(targets)))
+    succeeded = 0
+
+    def run(index, kind, value):
+        target_started = time.time()
+        try:
+            result = run_target(kind, value)
+        except Exception as e:
+            logging.error(f"Batch target {value} failed: {e}")
+            result = {"success": False, "message": str(e)}
+        return dict(result, index=index, **{kind: value}, elapsed=round(time.time() - target_started, 3))
+
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='batch')
+    try:
+        futures = [executor.submit(run, index, kind, value) for index, (kind, value) in enumerate(targets)]
+        for future in as_completed(futures):
+            result = future.result()
+            succeeded += bool(result.get('success'))
+            yield result
+    finally:
+        # Also reached when the client disconnects; targets not yet started are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield {'done': True, 'total': len(targets), 'succeeded': succeeded, 'failed': len(targets) - succeeded,
+           'parallelism': parallelism, 'elapsed': round(time.time() - started, 3)}
+
+def to_ndjson(results):
+    """Encode results as NDJSON lines."""
+    for result in results:
+        yield json.dumps(result, default=str) + '\n'
@@ -0,0 +1,657 @@
+"""
+Database module for Emby FFMPEG Fixer.
+Persists discovered installs, inspection results, backups and operation
+history in an embedded SQLite database (WAL mode), so a restarted fixer
+recovers its selected install and its own backups without rescanning.
+All queries are constant SQL strings, reused from each connection's
+prepared statement cache, and every lookup is backed by an index.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from .shared_store import connect_sqlite
+
+INSPECTION_RETENTION = 100  # Inspections kept per install; older ones are pruned on insert
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS installs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inspections (
+    id INTEGER PRIMARY KEY,
+    install_id INTEGER NOT NULL REFERENCES installs(id),
+    inspected_at REAL NOT NULL,
+    ffmpeg_path TEXT,
+    ffmpeg_architecture TEXT,
+    system_architecture TEXT,
+    is_compatible INTEGER,
+    has_backup INTEGER,
+    test_mode_active INTEGER
+);
+CREATE INDEX IF NOT EXISTS inspections_install_time ON inspections (install_id, inspected_at);
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    install_id INTEGER NOT NULL REFERENCES installs(id),
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_install_kind_time ON backups (install_id, kind, created_at);
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    install_id INTEGER REFERENCES installs(id),
+    kind TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    success INTEGER,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS operations_install_id ON operations (install_id, id);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fleet_hosts (
+    host_id TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    last_seen REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fleet_installs (
+    host_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host_id, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fleet_commands (
+    id INTEGER PRIMARY KEY,
+    host_id TEXT NOT NULL,
+    command TEXT NOT NULL,
+    path TEXT,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    success INTEGER,
+    message TEXT,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS fleet_commands_host_state ON fleet_commands (host_id, state, id);
+CREATE TABLE IF NOT EXISTS inventory (
+    host_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    row TEXT NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host_id, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS inventory_seq ON inventory (seq);
+CREATE TABLE IF NOT EXISTS fix_rollouts (
+    id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    config TEXT NOT NULL,
+    progress TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fix_recipes (
+    emby_version TEXT NOT NULL,
+    system_architecture TEXT NOT NULL,
+    recipe TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (emby_version, system_architecture)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS log_offsets (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS log_failures (
+    install_path TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (install_path, bucket, kind)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS log_failures_bucket ON log_failures (bucket);
+'''
+
+class Database:
+    def __init__(self):
+        self._path = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        """Whether the database has been opened."""
+        return self._path is not None
+
+    def open(self, path):
+        """Open (creating if needed) the database at the given path."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        # Columns added after their table, missing from databases created before
+        if 'sent_at' not in {row[1] for row in conn.execute('PRAGMA table_info(fleet_commands)')}:
+            conn.execute('ALTER TABLE fleet_commands ADD COLUMN sent_at REAL')
+        logging.info(f"Database opened at {path}")
+
+    def _connection(self):
+        # SQLite connections must not cross threads or survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self._path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements as one transaction, yielding the connection."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _install_id(self, conn, emby_path):
+        now = time.time()
+        conn.execute('INSERT INTO installs (path, first_seen, last_seen) VALUES (?, ?, ?) '
+                     'ON CONFLICT(path) DO UPDATE SET last_seen = excluded.last_seen',
+                     (emby_path, now, now))
+        return conn.execute('SELECT id FROM installs WHERE path = ?', (emby_path,)).fetchone()[0]
+
+    def record_installs(self, emby_paths):
+        """Record discovered installs."""
+        if not self.enabled or not emby_paths:
+            return
+        with self.transaction() as conn:
+            for emby_path in emby_paths:
+                self._install_id(conn, emby_path)
+
+    def get_installs(self):
+        """Get all known installs, most recently seen first."""
+        if not self.enabled:
+            return []
+        rows = self._connection().execute(
+            'SELECT path, first_seen, last_seen FROM installs ORDER BY last_seen DESC').fetchall()
+        return [{'path': path, 'first_seen': first_seen, 'last_seen': last_seen}
+                for path, first_seen, last_seen in rows]
+
+    def record_inspection(self, emby_path, ffmpeg_path=None, ffmpeg_architecture=None,
+                          system_architecture=None, is_compatible=None, has_backup=None,
+                          test_mode_active=None):
+        """Record the result of inspecting an install, keeping its last INSPECTION_RETENTION."""
+        if not self.enabled:
+            return
+        with self.transaction() as conn:
+            install_id = self._install_id(conn, emby_path)
+            conn.execute('INSERT INTO inspections (install_id, inspected_at, ffmpeg_path, ffmpeg_architecture, '
+                         'system_architecture, is_compatible, has_backup, test_mode_active) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (install_id, time.time(), ffmpeg_path, ffmpeg_architecture,
+                          system_architecture, is_compatible, has_backup, test_mode_active))
+            # Health checks inspect every install each round; keep only recent history
+            conn.execute('DELETE FROM inspections WHERE install_id = ? AND inspected_at < ('
+                         'SELECT inspected_at FROM inspections WHERE install_id = ? '
+                         'ORDER BY inspected_at DESC LIMIT 1 OFFSET ?)',
+                         (install_id, install_id, INSPECTION_RETENTION - 1))
+
+    def get_latest_inspection(self, emby_path):
+        """Get the most recent inspection of an install."""
+        if not self.enabled:
+            return None
+        row = self._connection().execute(
+            'SELECT i.inspected_at, i.ffmpeg_path, i.ffmpeg_architecture, i.system_architecture, '
+            'i.is_compatible, i.has_backup, i.test_mode_active FROM inspections i '
+            'JOIN installs s ON s.id = i.install_id WHERE s.path = ? '
+            'ORDER BY i.inspected_at DESC LIMIT 1', (emby_path,)).fetchone()
+        if not row:
+            return None
+        keys = ('inspected_at', 'ffmpeg_path', 'ffmpeg_architecture', 'system_architecture',
+                'is_compatible', 'has_backup', 'test_mode_active')
+        return dict(zip(keys, row))
+
+    def record_backup(self, emby_path, kind, backup_path):
+        """Record a backup created for an install."""
+        if not self.enabled:
+            return
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO backups (install_id, kind, path, created_at) VALUES (?, ?, ?, ?)',
+                         (self._install_id(conn, emby_path), kind, backup_path, time.time()))
+
+    def get_latest_backup(self, emby_path, kind):
+        """Get the path of the most recent backup of a kind that still exists."""
+        if not self.enabled:
+            return None
+        rows = self._connection().execute(
+            'SELECT b.path FROM backups b JOIN installs s ON s.id = b.install_id '
+            'WHERE s.path = ? AND b.kind = ? ORDER BY b.created_at DESC',
+            (emby_path, kind))
+        for (backup_path,) in rows:
+            if os.path.exists(backup_path):
+                return backup_path
+        return None
+
+    def start_operation(self, emby_path, kind):
+        """Record the start of an operation, returning its id."""
+        if not self.enabled:
+            return None
+        with self.transaction() as conn:
+            install_id = self._install_id(conn, emby_path) if emby_path else None
+            return conn.execute('INSERT INTO operations (install_id, kind, started_at) VALUES (?, ?, ?)',
+                                (install_id, kind, time.time())).lastrowid
+
+    def finish_operation(self, operation_id, success, message=None):
+        """Record the outcome of an operation."""
+        if not self.enabled or operation_id is None:
+            return
+        self._connection().execute('UPDATE operations SET finished_at = ?, success = ?, message = ? WHERE id = ?',
+                                   (time.time(), int(bool(success)), message, operation_id))
+
+    def get_history(self, emby_path=None, limit=50, before_id=None):
+        """Get operation history, newest first.
+
+        Paginates by id (keyset pagination) so pages stay index lookups
+        however many rows the table holds.
+
+        Args:
+            emby_path (str, optional): Only return operations on this install
+            limit (int): Maximum number of operations to return
+            before_id (int, optional): Only return operations older than this id
+
+        Returns:
+            list: Operation dicts
+        """
+        if not self.enabled:
+            return []
+        before_id = before_id if before_id is not None else 2 ** 63 - 1
+        if emby_path:
+            rows = self._connection().execute(
+                'SELECT o.id, s.path, o.kind, o.started_at, o.finished_at, o.success, o.message '
+                'FROM operations o JOIN installs s ON s.id = o.install_id '
+                'WHERE s.path = ? AND o.id < ? ORDER BY o.id DESC LIMIT ?',
+                (emby_path, before_id, limit)).fetchall()
+        else:
+            rows = self._connection().execute(
+                'SELECT o.id, s.path, o.kind, o.started_at, o.finished_at, o.success, o.message '
+                'FROM operations o LEFT JOIN installs s ON s.id = o.install_id '
+                'WHERE o.id < ? ORDER BY o.id DESC LIMIT ?',
+                (before_id, limit)).fetchall()
+        keys = ('id', 'path', 'kind', 'started_at', 'finished_at', 'success', 'message')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get_last_operation(self, emby_path, kinds):
+        """Get the most recent finished operation of the given kinds on an install."""
+        if not self.enabled:
+            return None
+        for row in self._connection().execute(
+                'SELECT o.kind, o.finished_at, o.success, o.message FROM operations o '
+                'JOIN installs s ON s.id = o.install_id WHERE s.path = ? AND o.finished_at IS NOT NULL '
+                'ORDER BY o.id DESC', (emby_path,)):
+            if row[0] in kinds:
+                return dict(zip(('kind', 'finished_at', 'success', 'message'), row))
+        return None
+
+    def get_setting(self, key, default=None):
+        """Get a persisted setting."""
+        if not self.enabled:
+            return default
+        row = self._connection().execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        """Persist a setting."""
+        if not self.enabled:
+            return
+        self._connection().execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def get_fleet_seq(self, host_id):
+        """Get the sequence number of the last report applied for a fleet host."""
+        if not self.enabled:
+            return None
+        row = self._connection().execute('SELECT seq FROM fleet_hosts WHERE host_id = ?', (host_id,)).fetchone()
+        return row[0] if row else None
+
+    def apply_fleet_report(self, host_id, seq, info, installs, removed, full=False):
+        """Merge an agent's status report into the fleet state.
+
+        Args:
+            host_id (str): Reporting host
+            seq (int): The report's sequence number
+            info (dict): Host details, merged into the stored ones
+            installs (dict): Install path -> changed status fields
+            removed (list): Install paths no longer present on the host
+            full (bool): Whether the report replaces everything known about the host
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT info FROM fleet_hosts WHERE host_id = ?', (host_id,)).fetchone()
+            host_info = {} if full or not row else json.loads(row[0])
+            host_info.update(info or {})
+            conn.execute('INSERT OR REPLACE INTO fleet_hosts (host_id, info, seq, last_seen) VALUES (?, ?, ?, ?)',
+                         (host_id, json.dumps(host_info), seq, now))
+            if full:
+                conn.execute('DELETE FROM fleet_installs WHERE host_id = ?', (host_id,))
+            for path in removed or ():
+                conn.execute('DELETE FROM fleet_installs WHERE host_id = ? AND path = ?', (host_id, path))
+            for path, changes in (installs or {}).items():
+                row = conn.execute('SELECT status FROM fleet_installs WHERE host_id = ? AND path = ?',
+                                   (host_id, path)).fetchone()
+                status = json.loads(row[0]) if row else {}
+                status.update(changes)
+                conn.execute('INSERT OR REPLACE INTO fleet_installs (host_id, path, status, updated_at) '
+                             'VALUES (?, ?, ?, ?)', (host_id, path, json.dumps(status), now))
+
+    def touch_fleet_host(self, host_id, seq):
+        """Record that a fleet host reported without changes."""
+        if not self.enabled:
+            return
+        self._connection().execute('UPDATE fleet_hosts SET seq = ?, last_seen = ? WHERE host_id = ?',
+                                   (seq, time.time(), host_id))
+
+    def get_fleet_hosts(self):
+        """Get every fleet host with its installs."""
+        if not self.enabled:
+            return []
+        conn = self._connection()
+        hosts = {}
+        for host_id, info, seq, last_seen in conn.execute(
+                'SELECT host_id, info, seq, last_seen FROM fleet_hosts ORDER BY host_id'):
+            hosts[host_id] = {'host_id': host_id, 'info': json.loads(info), 'seq': seq,
+                              'last_seen': last_seen, 'installs': []}
+        for host_id, path, status, updated_at in conn.execute(
+                'SELECT host_id, path, status, updated_at FROM fleet_installs ORDER BY host_id, path'):
+            if host_id in hosts:
+                hosts[host_id]['installs'].append(dict(json.loads(status), path=path, updated_at=updated_at))
+        return list(hosts.values())
+
+    def queue_fleet_command(self, host_id, command, path=None):
+        """Queue a command for a fleet host, returning its id."""
+        if not self.enabled:
+            return None
+        return self._connection().execute(
+            "INSERT INTO fleet_commands (host_id, command, path, state, created_at) VALUES (?, ?, ?, 'queued', ?)",
+            (host_id, command, path, time.time())).lastrowid
+
+    def take_fleet_commands(self, host_id):
+        """Hand a fleet host its queued commands, marking them as sent."""
+        if not self.enabled:
+            return []
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT id, command, path FROM fleet_commands "
+                                "WHERE host_id = ? AND state = 'queued' ORDER BY id", (host_id,)).fetchall()
+            now = time.time()
+            conn.executemany("UPDATE fleet_commands SET state = 'sent', sent_at = ? WHERE id = ?",
+                             [(now, row[0]) for row in rows])
+        return [{'id': command_id, 'command': command, 'path': path} for command_id, command, path in rows]
+
+    def finish_fleet_command(self, command_id, success, message=None):
+        """Record the outcome a fleet host reported for a command."""
+        if not self.enabled:
+            return
+        self._connection().execute(
+            "UPDATE fleet_commands SET state = 'done', finished_at = ?, success = ?, message = ? WHERE id = ?",
+            (time.time(), int(bool(success)), message, command_id))
+
+    def expire_fleet_commands(self, max_age):
+        """Fail commands sent to a fleet host that reported no outcome within max_age seconds.
+
+        Returns:
+            int: Number of commands expired
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        return self._connection().execute(
+            "UPDATE fleet_commands SET state = 'expired', finished_at = ?, success = 0, message = ? "
+            "WHERE state = 'sent' AND COALESCE(sent_at, created_at) < ?",
+            (now, "No outcome reported within {}s".format(int(max_age)), now - max_age)).rowcount
+
+    def get_fleet_commands(self, host_id=None, limit=100):
+        """Get the most recent fleet commands, newest first."""
+        if not self.enabled:
+            return []
+        if host_id:
+            rows = self._connection().execute(
+                'SELECT id, host_id, command, path, state, created_at, finished_at, success, message '
+                'FROM fleet_commands WHERE host_id = ? ORDER BY id DESC LIMIT ?', (host_id, limit)).fetchall()
+        else:
+            rows = self._connection().execute(
+                'SELECT id, host_id, command, path, state, created_at, finished_at, success, message '
+                'FROM fleet_commands ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        keys = ('id', 'host_id', 'command', 'path', 'state', 'created_at', 'finished_at', 'success', 'message')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def create_rollout(self, config, progress):
+        """Record a new fix rollout, returning its id."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        return self._connection().execute(
+            "INSERT INTO fix_rollouts (state, config, progress, created_at, updated_at) VALUES ('pending', ?, ?, ?, ?)",
+            (json.dumps(config), json.dumps(progress), now, now)).lastrowid
+
+    def count_running_rollouts(self):
+        """Count the fix rollouts not yet finished, in any worker process."""
+        if not self.enabled:
+            return 0
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM fix_rollouts WHERE state IN ('pending', 'running', 'cancelling')").fetchone()[0]
+
+    def interrupt_rollouts(self):
+        """Mark the fix rollouts left unfinished by a previous run as interrupted, returning how many."""
+        if not self.enabled:
+            return 0
+        return self._connection().execute(
+            "UPDATE fix_rollouts SET state = 'interrupted', updated_at = ? "
+            "WHERE state IN ('pending', 'running', 'cancelling')", (time.time(),)).rowcount
+
+    def update_rollout(self, rollout_id, state, progress=None):
+        """Record a fix rollout's state, and its progress if given."""
+        if not self.enabled or rollout_id is None:
+            return
+        if progress is None:
+            self._connection().execute('UPDATE fix_rollouts SET state = ?, updated_at = ? WHERE id = ?',
+                                       (state, time.time(), rollout_id))
+        else:
+            self._connection().execute(
+                'UPDATE fix_rollouts SET state = ?, progress = ?, updated_at = ? WHERE id = ?',
+                (state, json.dumps(progress), time.time(), rollout_id))
+
+    def get_rollout(self, rollout_id):
+        """Get a fix rollout with its configuration and progress."""
+        if not self.enabled:
+            return None
+        row = self._connection().execute(
+            'SELECT id, state, config, progress, created_at, updated_at FROM fix_rollouts WHERE id = ?',
+            (rollout_id,)).fetchone()
+        if not row:
+            return None
+        return {'id': row[0], 'state': row[1], 'config': json.loads(row[2]), 'progress': json.loads(row[3]),
+                'created_at': row[4], 'updated_at': row[5]}
+
+    def get_rollouts(self, limit=20):
+        """Get the most recent fix rollouts, newest first, without their per-target results."""
+        if not self.enabled:
+            return []
+        rows = self._connection().execute(
+            'SELECT id, state, config, created_at, updated_at FROM fix_rollouts ORDER BY id DESC LIMIT ?',
+            (limit,)).fetchall()
+        return [{'id': rollout_id, 'state': state, 'config': json.loads(config), 'created_at': created_at,
+                 'updated_at': updated_at} for rollout_id, state, config, created_at, updated_at in rows]
+
+    def iter_fleet_installs(self):
+        """Iterate over (host_id, path, status) of every fleet install, without loading them all."""
+        if not self.enabled:
+            return
+        for host_id, path, status in self._connection().execute(
+                'SELECT host_id, path, status FROM fleet_installs ORDER BY host_id, path'):
+            yield host_id, path, json.loads(status)
+
+    def update_inventory(self, host_id, path, fingerprint, row):
+        """Store an inventory row, taking a new sequence number only if it changed.
+
+        Returns:
+            bool: Whether the row changed
+        """
+        if not self.enabled:
+            return False
+        with self.transaction() as conn:
+            stored = conn.execute('SELECT fingerprint, removed FROM inventory WHERE host_id = ? AND path = ?',
+                                  (host_id, path)).fetchone()
+            if stored and stored[0] == fingerprint and not stored[1]:
+                return False
+            seq = conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM inventory').fetchone()[0]
+            conn.execute('INSERT OR REPLACE INTO inventory (host_id, path, seq, fingerprint, row, removed, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, 0, ?)', (host_id, path, seq, fingerprint, json.dumps(row), time.time()))
+        return True
+
+    def remove_inventory(self, host_id, present_paths):
+        """Mark a host's inventory rows that are no longer present as removed."""
+        if not self.enabled:
+            return
+        with self.transaction() as conn:
+            gone = [path for (path,) in conn.execute(
+                        'SELECT path FROM inventory WHERE host_id = ? AND removed = 0', (host_id,)).fetchall()
+                    if path not in present_paths]
+            for path in gone:
+                seq = conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM inventory').fetchone()[0]
+                conn.execute('UPDATE inventory SET removed = 1, seq = ?, updated_at = ? WHERE host_id = ? AND path = ?',
+                             (seq, time.time(), host_id, path))
+
+    def get_inventory_hosts(self):
+        """Get the host ids that have inventory rows."""
+        if not self.enabled:
+            return []
+        return [host_id for (host_id,) in self._connection().execute('SELECT DISTINCT host_id FROM inventory')]
+
+    def get_inventory_seq(self):
+        """Get the sequence number of the most recent inventory change."""
+        if not self.enabled:
+            return 0
+        return self._connection().execute('SELECT COALESCE(MAX(seq), 0) FROM inventory').fetchone()[0]
+
+    def iter_inventory(self, since_seq=0, until_seq=None):
+        """Iterate over inventory rows changed after a sequence number, oldest change first.
+
+        Rows are read from the cursor one at a time, so memory use does not grow with the fleet.
+        """
+        if not self.enabled:
+            return
+        until_seq = until_seq if until_seq is not None else 2 ** 63 - 1
+        cursor = self._connection().execute(
+            'SELECT host_id, path, seq, row, removed, updated_at FROM inventory '
+            'WHERE seq > ? AND seq <= ? ORDER BY seq', (since_seq, until_seq))
+        for host_id, path, seq, row, removed, updated_at in cursor:
+            yield dict(json.loads(row), host_id=host_id, path=path, seq=seq, removed=bool(removed),
+                       updated_at=updated_at)
+
+    def get_fix_recipe(self, emby_version, system_architecture):
+        """Get the cached fix recipe for an Emby version on a host architecture."""
+        if not self.enabled:
+            return None
+        row = self._connection().execute(
+            'SELECT recipe FROM fix_recipes WHERE emby_version = ? AND system_architecture = ?',
+            (emby_version, system_architecture)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_fix_recipe(self, emby_version, system_architecture, recipe):
+        """Cache the fix recipe for an Emby version on a host architecture."""
+        if not self.enabled:
+            return
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO fix_recipes (emby_version, system_architecture, recipe, created_at, last_used) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT(emby_version, system_architecture) DO UPDATE SET '
+            'recipe = excluded.recipe, created_at = excluded.created_at, last_used = excluded.last_used',
+            (emby_version, system_architecture, json.dumps(recipe), now, now))
+
+    def record_fix_recipe_use(self, emby_version, system_architecture):
+        """Count a fix done from a cached recipe."""
+        if not self.enabled:
+            return
+        self._connection().execute(
+            'UPDATE fix_recipes SET uses = uses + 1, last_used = ? WHERE emby_version = ? AND system_architecture = ?',
+            (time.time(), emby_version, system_architecture))
+
+    def delete_fix_recipe(self, emby_version, system_architecture):
+        """Drop a cached fix recipe."""
+        if not self.enabled:
+            return
+        self._connection().execute('DELETE FROM fix_recipes WHERE emby_version = ? AND system_architecture = ?',
+                                   (emby_version, system_architecture))
+
+    def get_fix_recipes(self):
+        """Get every cached fix recipe, most recently used first."""
+        if not self.enabled:
+            return []
+        rows = self._connection().execute(
+            'SELECT recipe, created_at, last_used, uses FROM fix_recipes ORDER BY last_used DESC').fetchall()
+        return [dict(json.loads(recipe), created_at=created_at, last_used=last_used, uses=uses)
+                for recipe, created_at, last_used, uses in rows]
+
+    def get_log_offsets(self):
+        """Get how far each log file has been analyzed, as path -> (inode, offset)."""
+        if not self.enabled:
+            return {}
+        return {path: (inode, offset) for path, inode, offset in self._connection().execute(
+            'SELECT path, inode, offset FROM log_offsets')}
+
+    def save_log_progress(self, offsets, removed, counts):
+        """Store a log analysis pass: the new file offsets and the failures found.
+
+        Args:
+            offsets (dict): Path -> (inode, offset) of the files read
+            removed (iterable): Paths of log files that are gone
+            counts (dict): (install path, bucket, kind) -> failures found in the pass
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO log_offsets (path, inode, offset, updated_at) VALUES (?, ?, ?, ?)',
+                             [(path, inode, offset, now) for path, (inode, offset) in offsets.items()])
+            conn.executemany('DELETE FROM log_offsets WHERE path = ?', [(path,) for path in removed])
+            conn.executemany('INSERT INTO log_failures (install_path, bucket, kind, count, last_seen) '
+                             'VALUES (?, ?, ?, ?, ?) ON CONFLICT(install_path, bucket, kind) DO UPDATE SET '
+                             'count = count + excluded.count, last_seen = excluded.last_seen',
+                             [(install_path, bucket, kind, count, now)
+                              for (install_path, bucket, kind), count in counts.items()])
+
+    def prune_log_failures(self, before_bucket):
+        """Delete the failure counts of buckets older than the given one, returning how many."""
+        if not self.enabled:
+            return 0
+        return self._connection().execute('DELETE FROM log_failures WHERE bucket < ?', (before_bucket,)).rowcount
+
+    def get_log_failures(self, since_bucket=0):
+        """Get the failure counts per install, time bucket and kind, newest bucket first."""
+        if not self.enabled:
+            return []
+        rows = self._connection().execute(
+            'SELECT install_path, bucket, kind, count, last_seen FROM log_failures WHERE bucket >= ? '
+            'ORDER BY bucket DESC, install_path, kind', (since_bucket,)).fetchall()
+        keys = ('path', 'bucket', 'kind', 'count', 'last_seen')
+        return [dict(zip(keys, row)) for row in rows]
+
+# Create a global instance
+database = Database()
@@ -0,0 +1,89 @@
+"""
+Directory browser module for Emby FFMPEG Fixer.
+Lists directories for the web UI's install picker with os.scandir, caching
+each listing until the directory changes, so paging and filtering through
+directories with thousands of entries stays cheap.
+"""
+import os
+import threading
+from collections import OrderedDict
+from .discovery import is_emby_install
+
+class DirectoryBrowser:
+    def __init__(self, max_directories=64):
+        self._listings = OrderedDict()  # path -> (directory stat key, entries)
+        self._max_directories = max_directories
+        self._lock = threading.Lock()
+
+    def _get_entries(self, path):
+        # Adding, removing or renaming entries changes the directory's mtime
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            cached = self._listings.get(path)
+            if cached and cached[0] == key:
+                self._listings.move_to_end(path)
+                return cached[1]
+
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    # Uses the type from the directory listing, no stat call for most entries
+                    if not entry.is_dir():
+                        continue
+                except OSError:
+                    continue
+                entries.append({
+                    'name': entry.name,
+                    'path': entry.path,
+                    'is_emby': is_emby_install(entry.path, entry.name),
+                    'hidden': entry.name.startswith('.')
+                })
+        # Emby installs first, then by name
+        entries.sort(key=lambda e: (not e['is_emby'], e['name'].lower()))
+
+        with self._lock:
+            self._listings[path] = (key, entries)
+            self._listings.move_to_end(path)
+            while len(self._listings) > self._max_directories:
+                self._listings.popitem(last=False)
+        return entries
+
+    def list_directory(self, path, offset=0, limit=200, name_filter=None, show_hidden=False):
+        """List the subdirectories of a directory, one page at a time.
+
+        Args:
+            path (str): Directory to list
+            offset (int): Index of the first entry to return
+            limit (int): Maximum number of entries to return
+            name_filter (str, optional): Case-insensitive substring entries must contain
+            show_hidden (bool): Whether to include dot directories
+
+        Returns:
+            dict: 'path', 'parent', whether the directory itself 'is_emby', 'entries',
+                'total' matching entries and 'next_offset'
+
+        Raises:
+            OSError: If the directory cannot be listed
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        entries = self._get_entries(path)
+        if not show_hidden:
+            entries = [e for e in entries if not e['hidden']]
+        if name_filter:
+            needle = name_filter.lower()
+            entries = [e for e in entries if needle in e['name'].lower()]
+        page = entries[offset:offset + limit]
+        parent = os.path.dirname(path)
+        return {
+            'path': path,
+            'parent': parent if parent != path else None,
+            'is_emby': is_emby_install(path, os.path.basename(path)),
+            'entries': [{'name': e['name'], 'path': e['path'], 'is_emby': e['is_emby']} for e in page],
+            'total': len(entries),
+            'next_offset': offset + limit if offset + limit < len(entries) else None
+        }
+
+# Create a global instance
+directory_browser = DirectoryBrowser()
@@ -0,0 +1,121 @@
+"""
+Discovery module for Emby FFMPEG Fixer.
+Finds Emby Server installations under a configurable list of search roots:
+macOS application bundles as well as Linux and Windows install directories.
+Roots are scanned concurrently to a limited depth, and each root's result is
+reused until one of the directories scanned under it changes.
+"""
+import os
+import logging
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .utils import get_ffmpeg_dirs, get_ffmpeg_name, stat_manifest
+
+MAX_DEPTH = 2  # Directory levels below a root that are searched
+MAX_WORKERS = 8
+
+def get_default_search_roots():
+    """Get the platform's usual locations of Emby Server installations."""
+    if platform.system() == 'Darwin':
+        return ['/Applications', os.path.expanduser('~/Applications')]
+    if platform.system() == 'Windows':
+        return [os.environ.get('APPDATA', ''), os.environ.get('ProgramFiles', 'C:\\Program Files')]
+    return ['/opt', '/usr/lib', '/usr/local', '/srv', '/var/lib']
+
+def get_search_roots():
+    """Get the configured search roots.
+
+    Set EMBY_FIXER_SEARCH_ROOTS to a os.pathsep separated list to override the defaults.
+    """
+    configured = os.environ.get('EMBY_FIXER_SEARCH_ROOTS')
+    roots = configured.split(os.pathsep) if configured else get_default_search_roots()
+    return [os.path.abspath(os.path.expanduser(root)) for root in roots if root]
+
+def is_emby_install(path, name):
+    """Whether a directory looks like an Emby Server installation."""
+    if 'emby' not in name.lower():
+        return False
+    if name.endswith('.app'):
+        return True
+    ffmpeg_name = get_ffmpeg_name()
+    return any(os.path.isfile(os.path.join(ffmpeg_dir, ffmpeg_name)) for ffmpeg_dir in get_ffmpeg_dirs(path))
+
+def _scan_root(root, max_depth):
+    """Find installs under a root, returning them with the directories scanned."""
+    installs, scanned = [], []
+    pending = [(root, 0)]
+    while pending:
+        directory, depth = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        scanned.append(directory)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+            except OSError:
+                continue
+            if is_emby_install(entry.path, entry.name):
+                installs.append(entry.path)
+            elif depth < max_depth and not entry.name.endswith('.app') and not entry.is_symlink():
+                # Do not descend into other bundles, or follow links that may loop
+                pending.append((entry.path, depth + 1))
+    return installs, scanned
+
+class Discovery:
+    def __init__(self, max_depth=MAX_DEPTH):
+        self._max_depth = max_depth
+        self._results = {}  # root -> (manifest of scanned directories, scanned directories, installs)
+        self._lock = threading.Lock()
+
+    def _discover_root(self, root):
+        with self._lock:
+            cached = self._results.get(root)
+        if cached and stat_manifest(cached[1]) == cached[0]:
+            return cached[2]
+        installs, scanned = _scan_root(root, self._max_depth)
+        with self._lock:
+            self._results[root] = (stat_manifest(scanned), scanned, installs)
+        return installs
+
+    def find_emby_servers(self, roots=None):
+        """Find Emby Server installations under the search roots.
+
+        Args:
+            roots (list, optional): Directories to search, defaults to get_search_roots()
+
+        Returns:
+            list: Sorted install paths
+        """
+        roots = [root for root in (roots or get_search_roots()) if os.path.isdir(root)]
+        if not roots:
+            return []
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(roots))) as executor:
+            results = list(executor.map(self._discover_root, roots))
+        found = set()
+        for installs in results:
+            found.update(installs)
+        logging.debug("Discovered {} Emby Server installs under {}".format(len(found), roots))
+        return sorted(found)
+
+    def get_watch_paths(self):
+        """Get the search roots and the directories scanned under them.
+
+        Their stat info changes whenever an install appears or disappears.
+        """
+        with self._lock:
+            scanned = [directory for result in self._results.values() for directory in result[1]]
+        return get_search_roots() + scanned
+
+# Create a global instance
+discovery = Discovery()
+
+def find_emby_servers():
+    """Find Emby Server installations under the configured search roots."""
+    return discovery.find_emby_servers()
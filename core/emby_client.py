@@ -0,0 +1,216 @@
+"""
+Emby client module for Emby FFMPEG Fixer.
+Talks to the Emby Server REST API to read system info, sessions and the
+transcoding state. Each server gets a small pool of keep-alive connections
+and a limit on concurrent requests, and responses are cached for a TTL
+that depends on the endpoint.
+"""
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import CACHE_REQUESTS
+
+DEFAULT_TIMEOUT = 5
+MAX_CONNECTIONS = 4  # Concurrent requests, and pooled connections, per server
+MAX_WORKERS = 32  # Servers queried at the same time by fetch_transcoding_states
+
+# Seconds a response is reused, per endpoint; sessions change quickly, system info rarely
+ENDPOINT_TTLS = {
+    '/System/Info': 300,
+    '/System/Info/Public': 300,
+    '/Sessions': 2
+}
+
+class EmbyClientError(Exception):
+    """Raised when an Emby Server cannot be reached or answers with an error."""
+
+class EmbyClient:
+    def __init__(self, base_url, api_key=None, timeout=DEFAULT_TIMEOUT, max_connections=MAX_CONNECTIONS):
+        parts = urlsplit(base_url if '://' in base_url else 'http://' + base_url)
+        self.base_url = base_url
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        # Emby Server answers under /emby as well as at the root
+        self._prefix = parts.path.rstrip('/')
+        self._api_key = api_key
+        self._timeout = timeout
+        self._idle = []  # Keep-alive connections not in use
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._cache = {}  # (path, query) -> (expires, data)
+        self._cache_lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    def _new_connection(self):
+        import http.client  # Only needed once a server is queried
+        if self._scheme == 'https':
+            conn = http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+        else:
+            conn = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        self.connections_opened += 1
+        return conn
+
+    def _checkout(self):
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _checkin(self, conn):
+        with self._idle_lock:
+            self._idle.append(conn)
+
+    def _request(self, path, params=None):
+        import http.client
+        url = self._prefix + path + ('?' + urlencode(params) if params else '')
+        headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        if self._api_key:
+            headers['X-Emby-Token'] = self._api_key
+        with self._slots:
+            conn, reused = self._checkout()
+            while True:
+                try:
+                    conn.request('GET', url, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                    self.requests_sent += 1
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    if reused:
+                        # The server closed an idle connection, retry once on a new one
+                        conn, reused = self._new_connection(), False
+                        continue
+                    raise EmbyClientError("Could not reach Emby Server at {}: {}".format(self.base_url, e))
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+        if response.status != 200:
+            raise EmbyClientError("Emby Server at {} answered {} {} for {}".format(
+                self.base_url, response.status, response.reason, path))
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise EmbyClientError("Invalid response from Emby Server at {}: {}".format(self.base_url, e))
+
+    def get(self, path, params=None, ttl=None):
+        """Get an API endpoint's JSON response, cached for the endpoint's TTL.
+
+        Args:
+            path (str): Endpoint path, e.g. '/Sessions'
+            params (dict, optional): Query parameters
+            ttl (float, optional): Seconds to cache the response, defaults to ENDPOINT_TTLS
+
+        Raises:
+            EmbyClientError: If the request fails
+        """
+        ttl = ENDPOINT_TTLS.get(path, 0) if ttl is None else ttl
+        key = (path, tuple(sorted((params or {}).items())))
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            CACHE_REQUESTS.inc(cache='emby_api', result='hit')
+            return cached[1]
+        if ttl > 0:
+            CACHE_REQUESTS.inc(cache='emby_api', result='miss')
+        data = self._request(path, params)
+        if ttl > 0:
+            with self._cache_lock:
+                self._cache[key] = (now + ttl, data)
+        return data
+
+    def get_system_info(self):
+        """Get the server's name, version and operating system."""
+        return self.get('/System/Info')
+
+    def get_sessions(self):
+        """Get the active sessions."""
+        return self.get('/Sessions')
+
+    def get_transcoding_state(self):
+        """Get the sessions that are transcoding.
+
+        Returns:
+            dict: 'transcoding' count and 'sessions' with the transcoding details of each
+        """
+        transcodes = []
+        for session in self.get_sessions():
+            info = session.get('TranscodingInfo')
+            if not info:
+                continue
+            transcodes.append({
+                'session_id': session.get('Id'),
+                'user': session.get('UserName'),
+                'client': session.get('Client'),
+                'item': (session.get('NowPlayingItem') or {}).get('Name'),
+                'video_codec': info.get('VideoCodec'),
+                'audio_codec': info.get('AudioCodec'),
+                'is_video_direct': info.get('IsVideoDirect'),
+                'progress': info.get('CompletionPercentage'),
+                'reasons': info.get('TranscodeReasons', [])
+            })
+        return {'transcoding': len(transcodes), 'sessions': transcodes}
+
+    def invalidate(self):
+        """Drop the cached responses."""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def close(self):
+        """Close the pooled connections."""
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+class EmbyClients:
+    def __init__(self):
+        self._clients = {}  # (base_url, api_key) -> EmbyClient
+        self._lock = threading.Lock()
+
+    def get_client(self, base_url, api_key=None):
+        """Get the shared client of a server, so its connections and cache are reused."""
+        with self._lock:
+            client = self._clients.get((base_url, api_key))
+            if client is None:
+                client = self._clients[(base_url, api_key)] = EmbyClient(base_url, api_key)
+            return client
+
+    def fetch_transcoding_states(self, servers, max_workers=MAX_WORKERS):
+        """Get the transcoding state of many servers concurrently.
+
+        Args:
+            servers (list): (base_url, api_key) pairs
+
+        Returns:
+            dict: base_url -> transcoding state, or {'error': message} for a server that failed
+        """
+        def fetch(server):
+            base_url, api_key = server
+            try:
+                return base_url, self.get_client(base_url, api_key).get_transcoding_state()
+            except EmbyClientError as e:
+                logging.warning(str(e))
+                return base_url, {'error': str(e)}
+
+        if not servers:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(servers))) as executor:
+            return dict(executor.map(fetch, servers))
+
+    def close(self):
+        """Close every client's connections."""
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            client.close()
+
+# Create a global instance
+emby_clients = EmbyClients()
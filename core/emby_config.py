@@ -0,0 +1,132 @@
+"""
+Emby config module for Emby FFMPEG Fixer.
+Reads the encoder paths from Emby Server's encoding configuration, so a
+custom ffmpeg set up in Emby is the one that gets inspected (and fixed, when
+the user confirms modifying a binary outside the install).
+The XML is streamed and parsing stops at the last element of interest;
+results are reused until the file changes.
+"""
+import os
+import logging
+import platform
+import threading
+from xml.etree.ElementTree import iterparse, ParseError
+
+CONFIG_FILE = 'encoding.xml'
+
+# Elements holding encoder paths, as written by different Emby Server versions
+FFMPEG_ELEMENTS = ('EncoderAppPath', 'EncoderAppPathDisplay', 'FfmpegPath', 'FFmpegPath')
+FFPROBE_ELEMENTS = ('ProbeAppPath', 'FfprobePath', 'FFprobePath')
+LOCATION_ELEMENTS = ('EncoderLocationType', 'EncoderLocation')
+
+def get_config_dirs(emby_path):
+    """Get the directories that may hold an install's Emby configuration.
+
+    Set EMBY_FIXER_EMBY_DATA_DIR to Emby's program data directory to check it first.
+    """
+    dirs = []
+    configured = os.environ.get('EMBY_FIXER_EMBY_DATA_DIR')
+    if configured:
+        dirs.append(os.path.join(os.path.expanduser(configured), 'config'))
+    if emby_path:
+        # Portable installs keep program data next to, or inside, the install
+        dirs.append(os.path.join(emby_path, 'programdata', 'config'))
+        dirs.append(os.path.join(os.path.dirname(emby_path.rstrip(os.sep)), 'programdata', 'config'))
+    if platform.system() == 'Darwin':
+        dirs.append(os.path.expanduser('~/.config/emby-server/config'))
+    elif platform.system() == 'Windows':
+        dirs.append(os.path.join(os.environ.get('APPDATA', ''), 'Emby-Server', 'programdata', 'config'))
+    else:
+        dirs.extend(['/var/lib/emby/config', os.path.expanduser('~/.config/emby-server/config')])
+    return dirs
+
+def get_log_dirs(emby_path):
+    """Get the directories that may hold an install's Emby Server and transcode logs."""
+    return [os.path.join(os.path.dirname(config_dir), 'logs') for config_dir in get_config_dirs(emby_path)]
+
+def parse_encoding_config(config_path):
+    """Parse the encoder settings from an encoding.xml file.
+
+    Returns:
+        dict: 'ffmpeg_path', 'ffprobe_path' and 'location_type', each None when not set
+    """
+    settings = {'ffmpeg_path': None, 'ffprobe_path': None, 'location_type': None}
+    wanted = set(FFMPEG_ELEMENTS + FFPROBE_ELEMENTS + LOCATION_ELEMENTS)
+    with open(config_path, 'rb') as f:
+        for _, element in iterparse(f, events=('end',)):
+            tag = element.tag.rpartition('}')[2]
+            text = (element.text or '').strip()
+            if tag in wanted:
+                wanted.discard(tag)
+                if text:
+                    if tag in FFMPEG_ELEMENTS:
+                        settings['ffmpeg_path'] = settings['ffmpeg_path'] or text
+                    elif tag in FFPROBE_ELEMENTS:
+                        settings['ffprobe_path'] = settings['ffprobe_path'] or text
+                    else:
+                        settings['location_type'] = text
+                if settings['ffmpeg_path'] and settings['ffprobe_path'] and settings['location_type']:
+                    break
+            # Free parsed elements, the rest of the document is not needed
+            element.clear()
+    return settings
+
+class EmbyConfig:
+    def __init__(self):
+        self._settings = {}  # config path -> ((mtime_ns, size), settings)
+        self._lock = threading.Lock()
+
+    def get_encoding_settings(self, config_path):
+        """Get an encoding.xml file's encoder settings, parsed once per change.
+
+        Returns:
+            dict: As returned by parse_encoding_config, or None if the file is missing or invalid
+        """
+        try:
+            st = os.stat(config_path)
+        except OSError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._settings.get(config_path)
+        if cached and cached[0] == key:
+            return cached[1]
+        try:
+            settings = parse_encoding_config(config_path)
+        except (ParseError, OSError) as e:
+            logging.warning(f"Could not parse Emby configuration {config_path}: {e}")
+            settings = None
+        with self._lock:
+            self._settings[config_path] = (key, settings)
+        return settings
+
+    def find_config(self, emby_path):
+        """Find the encoding.xml that applies to an install."""
+        for config_dir in get_config_dirs(emby_path):
+            config_path = os.path.join(config_dir, CONFIG_FILE)
+            if os.path.isfile(config_path):
+                return config_path
+        return None
+
+    def get_custom_ffmpeg_paths(self, emby_path):
+        """Get the ffmpeg and ffprobe paths Emby Server is configured to use.
+
+        Returns:
+            tuple: (ffmpeg_path, ffprobe_path), None for a path that is not
+                configured or does not exist
+        """
+        config_path = self.find_config(emby_path)
+        settings = self.get_encoding_settings(config_path) if config_path else None
+        if not settings or (settings['location_type'] or '').lower() in ('default', 'bundled'):
+            return None, None
+        paths = []
+        for path in (settings['ffmpeg_path'], settings['ffprobe_path']):
+            if path and os.path.isdir(path):
+                # Some versions store the directory holding the binaries
+                name = 'ffmpeg' if not paths else 'ffprobe'
+                path = os.path.join(path, name + ('.exe' if platform.system() == 'Windows' else ''))
+            paths.append(path if path and os.path.isfile(path) else None)
+        return tuple(paths)
+
+# Create a global instance
+emby_config = EmbyConfig()
@@ -0,0 +1,166 @@
+"""
+Emby process module for Emby FFMPEG Fixer.
+Finds running Emby Server processes and the ffmpeg/ffprobe processes they
+started, so fixes can target the binaries Emby actually executes and wait
+for active transcodes to finish. Scans are incremental: only processes that
+appeared since the last poll are inspected, and results are reused briefly.
+"""
+import os
+import time
+import logging
+import threading
+
+EMBY_PROCESS_NAMES = {'embyserver', 'embyserver.exe', 'emby-server', 'emby server'}
+FFMPEG_PROCESS_NAMES = {'ffmpeg', 'ffprobe', 'ffdetect', 'ffmpeg.exe', 'ffprobe.exe'}
+POLL_TTL = 2  # Seconds a scan result is reused
+FULL_SCAN_INTERVAL = 60  # Seconds between rescans of every process, to catch reused pids
+
+def _get_install_path(exe):
+    """Get the install an executable belongs to."""
+    if '.app' + os.sep in exe:
+        return exe[:exe.index('.app' + os.sep) + 4]
+    directory = os.path.dirname(exe)
+    # Linux and Windows layouts keep binaries in bin/ or system/ below the install
+    while os.path.basename(directory) in ('bin', 'system', 'ffmpeg'):
+        directory = os.path.dirname(directory)
+    return directory
+
+class EmbyProcessMonitor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = {}  # pid -> (create_time, kind, info) with kind 'emby', 'ffmpeg' or None
+        self._snapshot = None
+        self._scanned_at = 0
+        self._full_scan_at = 0
+
+    def _classify(self, psutil, proc, create_time):
+        # Called once per new process; most are not interesting and cost one read
+        name = proc.name()
+        lowered = name.lower()
+        if lowered in FFMPEG_PROCESS_NAMES:
+            kind = 'ffmpeg'
+        elif lowered in EMBY_PROCESS_NAMES:
+            kind = 'emby'
+        elif lowered in ('dotnet', 'mono', 'dotnet.exe'):
+            try:
+                cmdline = proc.cmdline()
+            except psutil.AccessDenied:
+                return None, None  # Another user's .NET host could be anything, not only Emby
+            if not any('embyserver' in arg.lower() for arg in cmdline):
+                return None, None
+            kind = 'emby'
+        else:
+            return None, None
+        # Processes of another user may hide their executable and arguments but
+        # not their name or parent, so they are still found, without an install
+        try:
+            exe = proc.exe()
+        except psutil.AccessDenied:
+            exe = None
+        try:
+            cmdline = proc.cmdline()
+        except psutil.AccessDenied:
+            cmdline = []
+        info = {'pid': proc.pid, 'name': name, 'exe': exe, 'started': create_time}
+        if kind == 'emby':
+            # A dotnet host runs EmbyServer.dll; the install is where the dll is
+            dll = next((arg for arg in cmdline if arg.lower().endswith('embyserver.dll')), None)
+            info['install_path'] = _get_install_path(dll or exe) if dll or exe else None
+        else:
+            info['ppid'] = proc.ppid()
+            info['cmdline'] = ' '.join(cmdline)[:500]
+            info['install_path'] = _get_install_path(exe) if exe else None
+        return kind, info
+
+    def _scan(self, psutil):
+        now = time.time()
+        full_scan = now - self._full_scan_at >= FULL_SCAN_INTERVAL
+        pids = set(psutil.pids())
+        for pid in list(self._known):
+            if pid not in pids:
+                del self._known[pid]
+        for pid in pids:
+            known = self._known.get(pid)
+            if known is not None and not full_scan and known[1] in (None, 'denied'):
+                continue
+            create_time = None
+            try:
+                proc = psutil.Process(pid)
+                try:
+                    create_time = proc.create_time()
+                except psutil.AccessDenied:
+                    pass  # Then a reused pid goes unnoticed, as for processes that stay denied
+                if known is not None and known[0] == create_time:
+                    continue
+                kind, info = self._classify(psutil, proc, create_time)
+                self._known[pid] = (create_time, kind, info)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                self._known.pop(pid, None)
+            except (psutil.AccessDenied, OSError):
+                # Remembered until it exits, so it is not probed again on every scan
+                self._known[pid] = (create_time, 'denied', None)
+        if full_scan:
+            self._full_scan_at = now
+
+        servers = [info for _, kind, info in self._known.values() if kind == 'emby']
+        server_installs = {server['pid']: server['install_path'] for server in servers}
+        denied = {pid for pid, (_, kind, _) in self._known.items() if kind == 'denied'}
+        ffmpeg = [info for _, kind, info in self._known.values() if kind == 'ffmpeg']
+        # A transcode belongs to the install of the server that started it, wherever
+        # its binary lives: a custom ffmpeg from encoding.xml runs outside the bundle.
+        # When that install cannot be read, it is None: the transcode may be any install's
+        transcodes = [dict(p, install_path=server_installs.get(p['ppid']))
+                      for p in ffmpeg if p['ppid'] in server_installs or p['ppid'] in denied]
+        return {
+            'available': True,
+            'servers': sorted(servers, key=lambda s: s['pid']),
+            'transcodes': sorted(transcodes, key=lambda p: p['pid']),
+            'ffmpeg_paths': sorted({p['exe'] for p in transcodes if p['exe']}),
+            'unattributed_transcodes': sum(1 for p in transcodes if p['install_path'] is None),
+            'inaccessible_processes': len(denied),
+            'scanned_at': now
+        }
+
+    def get_snapshot(self, max_age=POLL_TTL):
+        """Get the running Emby servers and their ffmpeg processes.
+
+        Returns:
+            dict: 'servers', 'transcodes' and the 'ffmpeg_paths' in use; 'available'
+                is False when process information cannot be read, and
+                'unattributed_transcodes' counts transcodes of servers whose
+                install cannot be read
+        """
+        with self._lock:
+            if self._snapshot is None or time.time() - self._scanned_at > max_age:
+                try:
+                    import psutil  # Only loaded once process discovery is used
+                except ImportError:
+                    return {'available': False, 'servers': [], 'transcodes': [], 'ffmpeg_paths': [],
+                            'unattributed_transcodes': 0, 'inaccessible_processes': 0}
+                started = time.time()
+                self._snapshot = self._scan(psutil)
+                self._scanned_at = time.time()
+                logging.debug("Scanned processes in {:.3f}s".format(self._scanned_at - started))
+            return self._snapshot
+
+    def get_active_transcodes(self, emby_path):
+        """Get the ffmpeg processes an install's Emby Server is currently running.
+
+        Transcodes of a server whose install cannot be read, e.g. one running
+        as another user, are included: they may be this install's, so guards
+        waiting for idle transcodes refuse rather than pass.
+        """
+        emby_path = os.path.abspath(emby_path).rstrip(os.sep)
+        install_paths = (emby_path, os.path.realpath(emby_path), None)
+        return [p for p in self.get_snapshot()['transcodes'] if p['install_path'] in install_paths]
+
+    def get_running_ffmpeg_path(self, emby_path):
+        """Get the ffmpeg binary inside an install that Emby is executing, if any."""
+        emby_path = os.path.abspath(emby_path).rstrip(os.sep)
+        for path in self.get_snapshot()['ffmpeg_paths']:
+            if path.startswith(emby_path + os.sep) and os.path.basename(path).lower().startswith('ffmpeg'):
+                return path
+        return None
+
+# Create a global instance
+emby_process_monitor = EmbyProcessMonitor()
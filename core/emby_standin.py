@@ -0,0 +1,93 @@
+"""
+Emby stand-in module for Emby FFMPEG Fixer.
+A minimal local server answering the Emby Server API endpoints the client
+uses, with keep-alive connections, for tests and benchmarks without a real
+Emby Server. It counts the connections and requests it receives.
+"""
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keeps connections open between requests
+
+    def setup(self):
+        super().setup()
+        with self.server.stats_lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.stats_lock:
+            self.server.requests += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)  # Simulates a busy server, so requests overlap
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/emby/'):
+            path = path[len('/emby'):]
+        if self.server.api_key and self.headers.get('X-Emby-Token') != self.server.api_key:
+            return self._send(401, {'error': 'Access token is invalid or expired'})
+        if path in ('/System/Info', '/System/Info/Public'):
+            return self._send(200, self.server.system_info)
+        if path == '/Sessions':
+            return self._send(200, self.server.sessions)
+        return self._send(404, {'error': 'Not found'})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class EmbyStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, api_key=None, transcodes=1, version='4.8.0.0'):
+        super().__init__((host, port), _StandInHandler)
+        self.api_key = api_key
+        self.stats_lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.delay = 0  # Seconds each request takes
+        self.system_info = {
+            'ServerName': 'Emby stand-in {}'.format(self.server_address[1]),
+            'Version': version,
+            'OperatingSystem': 'macOS',
+            'Id': 'standin-{}'.format(self.server_address[1])
+        }
+        self.set_transcodes(transcodes)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def set_transcodes(self, count):
+        """Set how many of the stand-in's sessions are transcoding."""
+        self.sessions = [{
+            'Id': 'session-{}'.format(i),
+            'UserName': 'user{}'.format(i),
+            'Client': 'Emby Web',
+            'NowPlayingItem': {'Name': 'Item {}'.format(i)},
+            'TranscodingInfo': {
+                'VideoCodec': 'h264',
+                'AudioCodec': 'aac',
+                'IsVideoDirect': False,
+                'CompletionPercentage': 12.5,
+                'TranscodeReasons': ['VideoCodecNotSupported']
+            } if i < count else None
+        } for i in range(count + 1)]
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True, name='emby-standin')
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
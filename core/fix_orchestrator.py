@@ -0,0 +1,216 @@
+"""
+Fix orchestrator module for Emby FFMPEG Fixer.
+Rolls the FFMPEG fix out over many installs or fleet hosts in waves. Each
+wave is fixed with bounded parallelism and then verified by inspecting the
+targets again; the rollout halts on its own once the share of failed
+targets crosses a threshold. Progress and per-wave throughput and latency
+are kept in the database, so every worker process can report them.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .database import database
+from .shared_store import shared_store
+from .install_status import inspect_install
+from .batch import fix_install, fix_host, check_host
+from .metrics import metrics
+
+DEFAULT_WAVE_SIZE = 10
+DEFAULT_PARALLELISM = 4
+DEFAULT_FAILURE_THRESHOLD = 0.2  # Share of failed targets that halts the rollout
+MAX_RUNNING_ROLLOUTS = 2  # Rollouts running at once in all worker processes
+HOST_VERIFY_TIMEOUT = 300  # Seconds to wait for a fleet host to report its fixes
+HOST_VERIFY_POLL = 2
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+def verify_install(emby_path):
+    """Check that a fixed install now runs FFMPEG built for this system."""
+    status = inspect_install(emby_path)
+    if status['test_mode_active']:
+        return False, "Test mode is still active"
+    if not status['is_compatible']:
+        return False, "FFMPEG architecture {} still does not match".format(status['ffmpeg_architecture'])
+    return True, "Verified"
+
+def verify_host(host_id, command_ids, timeout=HOST_VERIFY_TIMEOUT):
+    """Wait for a fleet host to run its fix commands and report compatible installs."""
+    deadline = time.time() + timeout
+    while True:
+        commands = [c for c in database.get_fleet_commands(host_id, limit=500) if c['id'] in command_ids]
+        failed = [c for c in commands if c['state'] == 'done' and not c['success']]
+        if failed:
+            return False, failed[0]['message'] or "Fix failed on host"
+        if all(c['state'] == 'done' for c in commands):
+            host = check_host(host_id)
+            if host['success'] and all(i.get('is_compatible') for i in host['installs']):
+                return True, "Verified"
+        if time.time() >= deadline:
+            return False, "Host did not report compatible installs within {}s".format(timeout)
+        time.sleep(HOST_VERIFY_POLL)
+
+class FixOrchestrator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rollouts = {}  # id -> progress of the rollouts run by this process
+        self._cancelled = set()
+
+    def count_running(self):
+        """Count the rollouts this process is running."""
+        with self._lock:
+            return sum(1 for rollout in self._rollouts.values() if rollout['state'] == 'running')
+
+    def start(self, targets, wave_size=DEFAULT_WAVE_SIZE, parallelism=DEFAULT_PARALLELISM,
+              failure_threshold=DEFAULT_FAILURE_THRESHOLD, force=False):
+        """Start a rollout in the background.
+
+        Args:
+            targets (list): ('path', value) and ('host_id', value) pairs
+            wave_size (int): Targets per wave
+            parallelism (int): Targets fixed at once within a wave
+            failure_threshold (float): Share of failed targets, from 0 to 1, that halts the rollout
+            force (bool): Fix installs even while they are transcoding
+
+        Returns:
+            int: The rollout id
+
+        Raises:
+            RuntimeError: If MAX_RUNNING_ROLLOUTS rollouts are already running
+        """
+        with shared_store.lock('rollouts'):
+            running = database.count_running_rollouts() if database.enabled else self.count_running()
+            if running >= MAX_RUNNING_ROLLOUTS:
+                raise RuntimeError("{} rollouts are already running, retry when one finishes".format(running))
+            return self._start(targets, wave_size, parallelism, failure_threshold, force)
+
+    def _start(self, targets, wave_size, parallelism, failure_threshold, force):
+        config = {'targets': len(targets), 'wave_size': max(1, wave_size), 'parallelism': max(1, parallelism),
+                  'failure_threshold': failure_threshold, 'force': force}
+        progress = {'waves': [], 'results': [], 'completed': 0, 'succeeded': 0, 'failed': 0,
+                    'started_at': time.time(), 'finished_at': None, 'message': None}
+        rollout_id = database.create_rollout(config, progress)
+        with self._lock:
+            if rollout_id is None:
+                # Without a database, number rollouts within this process
+                rollout_id = -(len(self._rollouts) + 1)
+            self._rollouts[rollout_id] = {'id': rollout_id, 'state': 'running', 'config': config,
+                                          'progress': progress}
+        database.update_rollout(rollout_id, 'running')
+        threading.Thread(target=self._run, args=(rollout_id, targets, config), daemon=True,
+                         name='fix-rollout-{}'.format(rollout_id)).start()
+        logging.info("Started fix rollout {} over {} targets in waves of {}".format(
+            rollout_id, len(targets), config['wave_size']))
+        return rollout_id
+
+    def _fix_target(self, kind, value, force):
+        started = time.time()
+        try:
+            if kind == 'path':
+                result = fix_install(value, force)
+                success, message = result.get('success', False), result.get('message')
+                if success:
+                    success, message = verify_install(value)
+            else:
+                result = fix_host(value)
+                success, message = result.get('success', False), result.get('message')
+                if success:
+                    success, message = verify_host(value, set(result['command_ids']))
+        except Exception as e:
+            logging.error(f"Rollout target {value} failed: {e}")
+            success, message = False, str(e)
+        return {kind: value, 'success': success, 'message': message, 'latency': round(time.time() - started, 3)}
+
+    def _is_cancelled(self, rollout_id):
+        with self._lock:
+            if rollout_id in self._cancelled:
+                return True
+        # Cancellation may come through another worker process
+        stored = database.get_rollout(rollout_id)
+        return bool(stored and stored['state'] == 'cancelling')
+
+    def _run(self, rollout_id, targets, config):
+        with self._lock:
+            rollout = self._rollouts[rollout_id]
+        progress = rollout['progress']
+        state = 'done'
+        wave_size = config['wave_size']
+        with ThreadPoolExecutor(max_workers=config['parallelism'], thread_name_prefix='fix-rollout') as executor:
+            for wave_start in range(0, len(targets), wave_size):
+                if self._is_cancelled(rollout_id):
+                    state, progress['message'] = 'cancelled', "Cancelled before wave {}".format(
+                        len(progress['waves']) + 1)
+                    break
+                wave = targets[wave_start:wave_start + wave_size]
+                started = time.time()
+                results = list(executor.map(lambda target: self._fix_target(*target, config['force']), wave))
+                duration = time.time() - started
+                latencies = [result['latency'] for result in results]
+                failed = sum(1 for result in results if not result['success'])
+                with self._lock:
+                    progress['results'].extend(results)
+                    progress['completed'] += len(results)
+                    progress['failed'] += failed
+                    progress['succeeded'] += len(results) - failed
+                    progress['waves'].append({
+                        'wave': len(progress['waves']) + 1,
+                        'size': len(results),
+                        'failed': failed,
+                        'duration': round(duration, 3),
+                        'throughput': round(len(results) / duration, 3) if duration else None,
+                        'latency_p50': _percentile(latencies, 0.5),
+                        'latency_p95': _percentile(latencies, 0.95),
+                        'latency_max': max(latencies)
+                    })
+                    failure_rate = progress['failed'] / progress['completed']
+                    halted = failure_rate > config['failure_threshold']
+                    if halted:
+                        state = 'halted'
+                        progress['message'] = "Halted after wave {}: {:.0%} of targets failed (threshold {:.0%})".format(
+                            len(progress['waves']), failure_rate, config['failure_threshold'])
+                database.update_rollout(rollout_id, 'cancelling' if self._is_cancelled(rollout_id) else 'running',
+                                        progress)
+                if halted:
+                    logging.warning("Fix rollout {}: {}".format(rollout_id, progress['message']))
+                    break
+        with self._lock:
+            progress['finished_at'] = time.time()
+            rollout['state'] = state
+        database.update_rollout(rollout_id, state, progress)
+        logging.info("Fix rollout {} {}: {} of {} targets fixed".format(
+            rollout_id, state, progress['succeeded'], len(targets)))
+
+    def cancel(self, rollout_id):
+        """Stop a rollout before its next wave.
+
+        Returns:
+            bool: False if the rollout is unknown or already finished
+        """
+        rollout = self.get_rollout(rollout_id)
+        if not rollout or rollout['state'] not in ('pending', 'running'):
+            return False
+        with self._lock:
+            self._cancelled.add(rollout_id)
+        database.update_rollout(rollout_id, 'cancelling')
+        return True
+
+    def get_rollout(self, rollout_id):
+        """Get a rollout's state, configuration and progress."""
+        with self._lock:
+            rollout = self._rollouts.get(rollout_id)
+            if rollout is not None:
+                state = 'cancelling' if rollout_id in self._cancelled and rollout['state'] == 'running' \
+                    else rollout['state']
+                return dict(rollout, state=state, progress=dict(rollout['progress'],
+                                                                waves=list(rollout['progress']['waves']),
+                                                                results=list(rollout['progress']['results'])))
+        return database.get_rollout(rollout_id)
+
+# Create a global instance
+fix_orchestrator = FixOrchestrator()
+
+metrics.callback('rollouts_running', 'Fix rollouts being run', (), lambda: [((), fix_orchestrator.count_running())])
@@ -0,0 +1,121 @@
+"""
+Fix recipes module for Emby FFMPEG Fixer.
+Every install of one Emby Server version on one host architecture needs the
+same fix, so the outcome of detecting it (where the binaries live inside the
+bundle, which ones are replaced, and with what) is cached as a recipe keyed
+by (Emby version, host architecture). Later fixes of a known combination
+skip FFMPEG discovery and go straight to a swap verified against the
+recipe's hashes.
+"""
+import os
+import logging
+import threading
+from .database import database
+from .metrics import CACHE_REQUESTS
+from .utils import get_emby_version, get_resource_path, hash_file
+
+class FixRecipes:
+    def __init__(self):
+        self._recipes = {}  # (emby version, system architecture) -> recipe
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'builds': 0, 'invalidations': 0}
+
+    def build(self, emby_path, ffmpeg_dir, binaries, system_arch, replacement_dir):
+        """Describe a fix detected the slow way as a recipe.
+
+        Args:
+            emby_path (str): The install being fixed
+            ffmpeg_dir (str): Directory holding the install's FFMPEG binaries
+            binaries (list): Binaries to replace
+            system_arch (str): Host architecture the replacements are built for
+            replacement_dir (str): Resource directory of the replacements, relative to get_resource_path
+
+        Returns:
+            dict: The recipe, with the size and SHA-256 of each replacement
+        """
+        replacements = {}
+        for binary in binaries:
+            path = get_resource_path(os.path.join(replacement_dir, binary))
+            replacements[binary] = {'size': os.path.getsize(path), 'sha256': hash_file(path)}
+        with self._lock:
+            self._stats['builds'] += 1
+        return {
+            'emby_version': get_emby_version(emby_path),
+            'system_architecture': system_arch,
+            'ffmpeg_dir': os.path.relpath(ffmpeg_dir, emby_path),
+            'binaries': list(binaries),
+            'replacement_dir': replacement_dir,
+            'replacements': replacements
+        }
+
+    def _applies(self, emby_path, recipe):
+        # A few stats: the binaries are where the recipe says, and the bundled
+        # replacements were not swapped for other builds since it was made
+        ffmpeg_dir = os.path.join(emby_path, recipe['ffmpeg_dir'])
+        for binary in recipe['binaries']:
+            if not os.path.isfile(os.path.join(ffmpeg_dir, binary)):
+                return False
+            try:
+                size = os.path.getsize(get_resource_path(os.path.join(recipe['replacement_dir'], binary)))
+            except OSError:
+                return False
+            if size != recipe['replacements'][binary]['size']:
+                return False
+        return True
+
+    def get(self, emby_path, system_arch):
+        """Get the cached recipe that fixes an install on this host, if there is one."""
+        emby_version = get_emby_version(emby_path)
+        recipe = None
+        if emby_version:
+            key = (emby_version, system_arch)
+            with self._lock:
+                recipe = self._recipes.get(key)
+            if recipe is None:
+                # Recipes made by other worker processes or earlier runs
+                recipe = database.get_fix_recipe(*key)
+                if recipe is not None:
+                    with self._lock:
+                        self._recipes[key] = recipe
+            if recipe is not None and not self._applies(emby_path, recipe):
+                logging.info(f"Cached fix recipe for Emby {emby_version} on {system_arch} does not fit {emby_path}")
+                recipe = None
+        with self._lock:
+            self._stats['hits' if recipe else 'misses'] += 1
+        CACHE_REQUESTS.inc(cache='fix_recipe', result='hit' if recipe else 'miss')
+        return recipe
+
+    def save(self, recipe):
+        """Cache a recipe that fixed an install, if it can be reused."""
+        # Without a version there is no key, and binaries outside the bundle are not shared by its version
+        if not recipe['emby_version'] or recipe['ffmpeg_dir'].startswith(os.pardir):
+            return
+        key = (recipe['emby_version'], recipe['system_architecture'])
+        with self._lock:
+            self._recipes[key] = recipe
+        database.save_fix_recipe(key[0], key[1], recipe)
+        logging.info("Cached fix recipe for Emby {} on {}".format(*key))
+
+    def record_use(self, recipe):
+        """Count a fix done from a cached recipe."""
+        database.record_fix_recipe_use(recipe['emby_version'], recipe['system_architecture'])
+
+    def forget(self, recipe):
+        """Drop a recipe that no longer fixes its installs."""
+        key = (recipe['emby_version'], recipe['system_architecture'])
+        with self._lock:
+            self._recipes.pop(key, None)
+            self._stats['invalidations'] += 1
+        database.delete_fix_recipe(*key)
+        logging.warning("Dropped cached fix recipe for Emby {} on {}".format(*key))
+
+    def get_recipes(self):
+        """Get the cached recipes and this process's hit and miss counts."""
+        with self._lock:
+            stats = dict(self._stats)
+            cached = list(self._recipes.values())
+        recipes = database.get_fix_recipes() if database.enabled else cached
+        return {'recipes': recipes, 'stats': stats}
+
+# Create a global instance
+fix_recipes = FixRecipes()
@@ -0,0 +1,258 @@
+"""
+Fix staging module for Emby FFMPEG Fixer.
+Keeps verified copies of the replacement binaries staged next to each
+install, on the same filesystem as its FFMPEG directory, so fixing an
+install after an Emby update brought a wrong-architecture FFMPEG back only
+takes renames. Staging runs in the background, within a disk budget, and
+restages an install when its bundled replacements change or a fix used the
+staged copies up.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from .fix_recipes import fix_recipes
+from .metrics import record_copy
+from .utils import (
+    FFMPEG_BINARIES,
+    find_ffmpeg_binaries,
+    get_external_ffmpeg,
+    get_resource_path,
+    get_system_architecture,
+    hash_file
+)
+
+STAGING_DIR = '.emby-fixer-staging'
+MANIFEST = 'manifest.json'
+DEFAULT_BUDGET = 1024 * 1024 * 1024  # Bytes of staged copies over all installs
+DEFAULT_INTERVAL = 300  # Seconds between checks that the staged copies are fresh
+
+def get_staging_dir(emby_path):
+    """Get the directory where an install's replacements are staged.
+
+    It sits next to the install rather than inside it, so it survives an
+    update that replaces the whole bundle.
+    """
+    emby_path = emby_path.rstrip(os.sep)
+    return os.path.join(os.path.dirname(emby_path), STAGING_DIR, os.path.basename(emby_path))
+
+def _staged_key(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+def _source_key(st):
+    return [st.st_size, st.st_mtime_ns]
+
+class FixStaging:
+    def __init__(self, budget=DEFAULT_BUDGET, interval=DEFAULT_INTERVAL):
+        self.budget = budget
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = False
+        self._staged = {}  # path -> bytes staged for it in the last round
+        self._stats = {'staged': 0, 'fresh': 0, 'taken': 0, 'over_budget': 0, 'failures': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _read_manifest(self, staging_dir):
+        try:
+            with open(os.path.join(staging_dir, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_fresh(self, emby_path, manifest, system_arch):
+        # Only stats: the staged copies are the ones verified, the bundled
+        # replacements did not change since, and the install still has the
+        # binaries where the recipe expects them
+        if not manifest or manifest.get('system_architecture') != system_arch:
+            return False
+        recipe = manifest['recipe']
+        ffmpeg_dir = os.path.join(emby_path, recipe['ffmpeg_dir'])
+        staging_dir = get_staging_dir(emby_path)
+        for binary in recipe['binaries']:
+            try:
+                staged = os.stat(os.path.join(staging_dir, binary))
+                source = os.stat(get_resource_path(os.path.join(recipe['replacement_dir'], binary)))
+            except OSError:
+                return False
+            if not os.path.isfile(os.path.join(ffmpeg_dir, binary)) or \
+                    _staged_key(staged) != manifest['files'][binary] or _source_key(source) != manifest['sources'][binary]:
+                return False
+        return True
+
+    def prepare(self, emby_path, system_arch, budget_left):
+        """Stage verified replacements for an install, unless fresh ones are staged.
+
+        Args:
+            emby_path (str): The install
+            system_arch (str): Host architecture to stage replacements for
+            budget_left (int): Bytes that may still be staged
+
+        Returns:
+            int: Bytes staged for the install, 0 if nothing is
+        """
+        staging_dir = get_staging_dir(emby_path)
+        manifest = self._read_manifest(staging_dir)
+        if self._is_fresh(emby_path, manifest, system_arch):
+            with self._lock:
+                self._stats['fresh'] += 1
+            return manifest['bytes']
+
+        ffmpeg_path = find_ffmpeg_binaries(emby_path)
+        if not ffmpeg_path or get_external_ffmpeg(emby_path):
+            # Only the bundled binaries are staged for, a custom FFMPEG is never swapped unasked
+            self.discard(emby_path)
+            return 0
+        ffmpeg_dir = os.path.dirname(ffmpeg_path)
+        replacement_dir = os.path.join('ffmpeg_binaries', system_arch)
+        binaries = [binary for binary in FFMPEG_BINARIES if os.path.exists(os.path.join(ffmpeg_dir, binary))]
+        sources = {binary: get_resource_path(os.path.join(replacement_dir, binary)) for binary in binaries}
+        if not binaries or not all(os.path.exists(source) for source in sources.values()):
+            # The fix would fail as well, nothing to stage
+            self.discard(emby_path)
+            return 0
+        size = sum(os.path.getsize(source) for source in sources.values())
+        if size > budget_left:
+            logging.info(f"Not staging replacements for {emby_path}: {size} bytes exceed the staging budget")
+            with self._lock:
+                self._stats['over_budget'] += 1
+            self.discard(emby_path)
+            return 0
+
+        os.makedirs(staging_dir, exist_ok=True)
+        if os.stat(staging_dir).st_dev != os.stat(ffmpeg_dir).st_dev:
+            logging.info(f"Not staging replacements for {emby_path}: {staging_dir} is on another filesystem")
+            self.discard(emby_path)
+            return 0
+        # Without a manifest a half-restaged directory is never used
+        manifest_path = os.path.join(staging_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        recipe = fix_recipes.build(emby_path, ffmpeg_dir, binaries, system_arch, replacement_dir)
+        manifest = {'emby_path': emby_path, 'system_architecture': system_arch, 'recipe': recipe,
+                    'files': {}, 'sources': {}, 'bytes': size, 'staged_at': time.time()}
+        for binary in binaries:
+            staged = os.path.join(staging_dir, binary)
+            tmp = staged + '.tmp'
+            started = time.perf_counter()
+            shutil.copy2(sources[binary], tmp)
+            os.chmod(tmp, 0o755)
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            record_copy('staging', os.path.getsize(tmp), time.perf_counter() - started)
+            if hash_file(tmp) != recipe['replacements'][binary]['sha256']:
+                os.remove(tmp)
+                raise ValueError("Staged copy of {} does not match {}".format(binary, sources[binary]))
+            os.replace(tmp, staged)
+            manifest['files'][binary] = _staged_key(os.stat(staged))
+            manifest['sources'][binary] = _source_key(os.stat(sources[binary]))
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_path + '.tmp', manifest_path)
+        with self._lock:
+            self._stats['staged'] += 1
+        logging.info(f"Staged {system_arch} replacements for {emby_path} in {staging_dir}")
+        return size
+
+    def discard(self, emby_path):
+        """Remove an install's staged replacements."""
+        staging_dir = get_staging_dir(emby_path)
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def take(self, emby_path, system_arch):
+        """Get an install's staged replacements if they are still fresh.
+
+        Returns:
+            tuple: (recipe, staging directory), or None
+        """
+        staging_dir = get_staging_dir(emby_path)
+        manifest = self._read_manifest(staging_dir)
+        if not self._is_fresh(emby_path, manifest, system_arch):
+            return None
+        with self._lock:
+            self._stats['taken'] += 1
+        return manifest['recipe'], staging_dir
+
+    def request(self):
+        """Check the staged copies without waiting for the interval, e.g. after a fix used some up."""
+        self._wake.set()
+
+    def prepare_all(self, emby_paths):
+        """Stage replacements for each install, in order, until the budget is used up."""
+        system_arch = get_system_architecture()
+        staged, used = {}, 0
+        for emby_path in emby_paths:
+            try:
+                size = self.prepare(emby_path, system_arch, self.budget - used)
+            except Exception as e:
+                logging.warning(f"Could not stage replacements for {emby_path}: {e}")
+                with self._lock:
+                    self._stats['failures'] += 1
+                self.discard(emby_path)
+                continue
+            if size:
+                staged[emby_path] = size
+                used += size
+        with self._lock:
+            gone = set(self._staged) - set(emby_paths)
+            self._staged = staged
+        for emby_path in gone:
+            self.discard(emby_path)
+
+    def start(self, get_installs):
+        """Keep the replacements staged in the background.
+
+        Args:
+            get_installs (callable): Returns the install paths to stage for, most important first
+        """
+        if self.running or self.budget < 1:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, args=(get_installs,), daemon=True, name='fix-staging')
+        self._thread.start()
+        logging.info("Fix staging started: {} byte budget, checked every {}s".format(self.budget, self.interval))
+
+    def stop(self):
+        """Stop staging after the current round."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self, get_installs):
+        while not self._stopping:
+            try:
+                self.prepare_all(list(get_installs()))
+            except Exception as e:
+                logging.warning(f"Fix staging round failed: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def get_status(self):
+        """Get the staged installs, the budget used and the staging counts."""
+        with self._lock:
+            staged = dict(self._staged)
+            stats = dict(self._stats)
+        return {
+            'running': self.running,
+            'budget': self.budget,
+            'used': sum(staged.values()),
+            'interval': self.interval,
+            'stats': stats,
+            'installs': [{'path': emby_path, 'staging_dir': get_staging_dir(emby_path), 'bytes': size}
+                         for emby_path, size in sorted(staged.items())]
+        }
+
+# Create a global instance
+fix_staging = FixStaging()
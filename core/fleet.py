@@ -0,0 +1,271 @@
+"""
+Fleet module for Emby FFMPEG Fixer.
+Lets one fixer act as a coordinator for many hosts. On each host a headless
+agent inspects the local installs and pushes only the status fields that
+changed since the coordinator's last acknowledged report, gzip compressed.
+The coordinator merges the deltas into its database and hands queued
+commands (fix, restore, rescan) back in its reply.
+"""
+import os
+import json
+import time
+import zlib
+import gzip
+import socket
+import logging
+import platform
+from urllib.parse import urlsplit
+from .database import database
+from .discovery import find_emby_servers
+from .install_status import inspect_install
+from .inventory import inventory
+from .shared_store import shared_store
+from .response_cache import response_cache
+from .health_scheduler import health_scheduler
+from .emby_processes import emby_process_monitor
+from .operations import fix_ffmpeg_compatibility, restore_original_ffmpeg
+from .utils import get_system_architecture
+
+REPORT_PATH = '/api/fleet/report'
+DEFAULT_INTERVAL = 30  # Seconds between agent inspections
+MAX_REPORT_SIZE = 16 * 1024 * 1024  # Decompressed bytes accepted from an agent
+COMMANDS = ('fix', 'restore', 'rescan')
+COMMAND_TIMEOUT = 3600  # Seconds a sent command may go without an outcome before it expires
+
+def decode_report(body, content_encoding=None):
+    """Decode an agent's report body, gunzipping it if needed.
+
+    Raises:
+        ValueError: If the body is invalid or decompresses past MAX_REPORT_SIZE
+    """
+    if content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, MAX_REPORT_SIZE)
+        except zlib.error as e:
+            raise ValueError("Invalid gzip body: {}".format(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Report is larger than {} bytes".format(MAX_REPORT_SIZE))
+    report = json.loads(body)
+    if not isinstance(report, dict) or not report.get('host_id') or not isinstance(report.get('seq'), int):
+        raise ValueError("Report needs a host_id and an integer seq")
+    return report
+
+class FleetCoordinator:
+    def receive_report(self, report):
+        """Apply an agent's report and get the reply with its queued commands.
+
+        A delta only applies on top of the report it was computed against;
+        otherwise the agent is asked to resend everything.
+        """
+        host_id = report['host_id']
+        self.expire_commands()
+        for result in report.get('results', ()):
+            database.finish_fleet_command(result.get('id'), result.get('success'), result.get('message'))
+        if not report.get('full') and report.get('base_seq') != database.get_fleet_seq(host_id):
+            logging.info(f"Fleet host {host_id} sent a delta against an unknown report, asking for a resync")
+            return {'success': True, 'ack': None, 'resync': True, 'commands': []}
+        if report.get('full') or report.get('installs') or report.get('removed') or report.get('host'):
+            database.apply_fleet_report(host_id, report['seq'], report.get('host'), report.get('installs'),
+                                        report.get('removed'), full=bool(report.get('full')))
+        else:
+            database.touch_fleet_host(host_id, report['seq'])
+        return {'success': True, 'ack': report['seq'], 'resync': False,
+                'commands': database.take_fleet_commands(host_id)}
+
+    def expire_commands(self):
+        """Expire commands whose agent never reported an outcome, e.g. because it died."""
+        expired = database.expire_fleet_commands(COMMAND_TIMEOUT)
+        if expired:
+            logging.warning(f"Expired {expired} fleet commands without an outcome after {COMMAND_TIMEOUT}s")
+        return expired
+
+    def get_status(self, now=None):
+        """Get the fleet's hosts and installs with summary counts."""
+        now = now or time.time()
+        self.expire_commands()
+        hosts = database.get_fleet_hosts()
+        summary = {'hosts': len(hosts), 'stale_hosts': 0, 'installs': 0, 'incompatible': 0, 'test_mode': 0}
+        for host in hosts:
+            # A host is stale once it missed a few reports
+            interval = host['info'].get('interval', DEFAULT_INTERVAL)
+            host['stale'] = now - host['last_seen'] > 3 * interval
+            summary['stale_hosts'] += host['stale']
+            summary['installs'] += len(host['installs'])
+            summary['incompatible'] += sum(1 for i in host['installs'] if i.get('is_compatible') is False)
+            summary['test_mode'] += sum(1 for i in host['installs'] if i.get('test_mode_active'))
+        return {'success': True, 'summary': summary, 'hosts': hosts}
+
+    def queue_command(self, host_id, command, path=None):
+        """Queue a command for a host's agent, delivered with its next report.
+
+        Returns:
+            dict: {"success": bool, "message": str} with the command 'id' on success
+        """
+        if command not in COMMANDS:
+            return {"success": False, "message": "Unknown command {}".format(command)}
+        if command != 'rescan' and not path:
+            return {"success": False, "message": "No Emby Server path provided"}
+        command_id = database.queue_fleet_command(host_id, command, path)
+        return {"success": True, "message": "Command queued", "id": command_id}
+
+class FleetAgent:
+    def __init__(self, coordinator_url, host_id=None, interval=DEFAULT_INTERVAL, token=None):
+        parts = urlsplit(coordinator_url if '://' in coordinator_url else 'http://' + coordinator_url)
+        self.coordinator_url = coordinator_url
+        self.host_id = host_id or socket.gethostname()
+        self.interval = interval
+        self._host = parts.hostname
+        self._port = parts.port
+        self._https = parts.scheme == 'https'
+        self._token = token
+        self._conn = None
+        self._seq = 0
+        self._acked_seq = None
+        self._acked = None  # Install statuses as of the acknowledged report, None to send everything
+        self._acked_info = {}
+        self._results = []  # Command outcomes not yet delivered
+
+    def collect(self):
+        """Inspect the local installs."""
+        paths = set(find_emby_servers())
+        selected = database.get_setting('emby_path')
+        if selected and os.path.exists(selected):
+            paths.add(selected)
+        installs = {}
+        for emby_path in sorted(paths):
+            try:
+                # Inventory fields are cached by stat info, and only sent when they change
+                installs[emby_path] = dict(inventory.describe_install(emby_path), **inspect_install(emby_path))
+            except Exception as e:
+                logging.warning(f"Could not inspect {emby_path}: {e}")
+        return installs
+
+    def get_host_info(self):
+        return {
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'system_architecture': get_system_architecture(),
+            'interval': self.interval
+        }
+
+    def build_report(self, installs, info):
+        """Build the report of what changed since the acknowledged one."""
+        self._seq += 1
+        report = {'host_id': self.host_id, 'seq': self._seq, 'base_seq': self._acked_seq,
+                  'results': list(self._results)}
+        if self._acked is None:
+            report.update(full=True, host=info, installs=installs, removed=[])
+            return report
+        changes = {}
+        for emby_path, status in installs.items():
+            previous = self._acked.get(emby_path, {})
+            changed = {key: value for key, value in status.items() if previous.get(key) != value}
+            if changed:
+                changes[emby_path] = changed
+        report.update(full=False, installs=changes,
+                      removed=[emby_path for emby_path in self._acked if emby_path not in installs],
+                      host={key: value for key, value in info.items() if self._acked_info.get(key) != value})
+        return report
+
+    def _post(self, report):
+        import http.client  # Agents only
+        body = gzip.compress(json.dumps(report, separators=(',', ':')).encode('utf-8'))
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        if self._token:
+            headers['X-Fleet-Token'] = self._token
+        for attempt in range(2):
+            if self._conn is None:
+                connection_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+                self._conn = connection_class(self._host, self._port, timeout=10)
+            try:
+                self._conn.request('POST', REPORT_PATH, body=body, headers=headers)
+                response = self._conn.getresponse()
+                payload = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # Retry once in case the coordinator closed the kept-alive connection
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise OSError("Coordinator answered {} {}".format(response.status, response.reason))
+        return json.loads(payload)
+
+    def report_once(self):
+        """Inspect, report the changes and run the commands handed back.
+
+        Returns:
+            dict: The coordinator's reply
+        """
+        installs, info = self.collect(), self.get_host_info()
+        report = self.build_report(installs, info)
+        # Only changed installs are recorded, like they are reported
+        for emby_path in report['installs']:
+            status = installs[emby_path]
+            database.record_inspection(
+                emby_path, ffmpeg_path=status['ffmpeg_path'], ffmpeg_architecture=status['ffmpeg_architecture'],
+                system_architecture=info['system_architecture'], is_compatible=status['is_compatible'],
+                has_backup=status['has_backup'], test_mode_active=status['test_mode_active'])
+        # Sent even without changes: it is a few bytes, and the reply carries queued commands
+        reply = self._post(report)
+        self._results = self._results[len(report['results']):]
+        if reply.get('resync'):
+            self._acked, self._acked_seq, self._acked_info = None, None, {}
+        elif reply.get('ack') == report['seq']:
+            self._acked, self._acked_seq, self._acked_info = installs, report['seq'], info
+        for command in reply.get('commands', ()):
+            self._results.append(self.run_command(command))
+        return reply
+
+    def run_command(self, command):
+        """Run a command from the coordinator, returning its outcome."""
+        emby_path = command.get('path')
+        logging.info("Running fleet command {} on {}".format(command.get('command'), emby_path))
+        operation_id = database.start_operation(emby_path, 'fleet-' + str(command.get('command')))
+        success, message = False, None
+        try:
+            if command.get('command') == 'rescan':
+                self._acked = None
+                success, message = True, "Full report scheduled"
+            elif not emby_path or not os.path.exists(emby_path):
+                message = "Emby Server path does not exist"
+            elif emby_process_monitor.get_active_transcodes(emby_path):
+                message = "Emby Server is transcoding, not modifying the install"
+            elif command.get('command') in ('fix', 'restore'):
+                # Serialized with the install watcher and the API, like every other change to an install
+                with shared_store.lock('install-{}'.format(emby_path)):
+                    try:
+                        if command['command'] == 'fix':
+                            result = fix_ffmpeg_compatibility(emby_path)
+                            success, message = result['success'], result['message']
+                        else:
+                            success, message = restore_original_ffmpeg(emby_path)
+                    finally:
+                        response_cache.invalidate(emby_path)
+                health_scheduler.reset(emby_path)
+            else:
+                message = "Unknown command {}".format(command.get('command'))
+        except Exception as e:
+            message = str(e)
+        database.finish_operation(operation_id, success, message)
+        return {'id': command.get('id'), 'success': success, 'message': message}
+
+    def run_forever(self):
+        """Report every interval until interrupted."""
+        logging.info("Fleet agent {} reporting to {} every {}s".format(
+            self.host_id, self.coordinator_url, self.interval))
+        while True:
+            started = time.time()
+            try:
+                reply = self.report_once()
+                if reply.get('resync') or reply.get('commands'):
+                    # Report the resync or the command outcomes without waiting
+                    continue
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not report to coordinator {self.coordinator_url}: {e}")
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+# Create a global instance
+fleet_coordinator = FleetCoordinator()
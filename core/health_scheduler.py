@@ -0,0 +1,265 @@
+"""
+Health scheduler module for Emby FFMPEG Fixer.
+Re-inspects every known install in the background on an adaptive interval:
+checks come often right after an install changed (an Emby update, a fix)
+and back off exponentially while it stays the same. Intervals are jittered
+so installs do not all come due together, and a global budget caps how
+many checks run at once. A check first compares the install's stat
+manifest and only runs the full inspection when something changed.
+"""
+import time
+import heapq
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .database import database
+from .install_status import inspect_install
+from .metrics import metrics
+from .shared_store import shared_store
+from .utils import get_install_watch_paths, stat_manifest
+
+MIN_INTERVAL = 30  # Seconds between checks of an install that just changed
+MAX_INTERVAL = 3600  # Seconds between checks of an install that has been stable for long
+BACKOFF = 2.0  # Interval multiplier after each check that found no change
+JITTER = 0.1  # Fraction by which each interval is randomly shortened or lengthened
+MAX_CONCURRENT = 2  # Checks running at the same time
+REDISCOVER_INTERVAL = 300  # Seconds between refreshes of the list of installs
+LAG_SMOOTHING = 0.2  # Weight of the newest sample in the average scheduling lag
+SHARED_RESET_INTERVAL = 2  # Seconds between checks for resets requested by other worker processes
+
+class HealthScheduler:
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, backoff=BACKOFF,
+                 jitter=JITTER, max_concurrent=MAX_CONCURRENT):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self._installs = {}  # path -> schedule state
+        self._heap = []  # (due time, path); entries whose due time was rescheduled are skipped
+        self._cond = threading.Condition()
+        self._slots = None  # Built in start(), from max_concurrent as configured then
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+        self._get_installs = None
+        self._rediscover_interval = REDISCOVER_INTERVAL
+        self._next_discovery = 0
+        self._metrics = {'checks': 0, 'inspections': 0, 'changes': 0, 'failures': 0,
+                         'lag_avg': 0.0, 'lag_max': 0.0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, path, due):
+        # Called with the condition held
+        self._installs[path]['next_run'] = due
+        heapq.heappush(self._heap, (due, path))
+        self._cond.notify()
+
+    def sync(self, emby_paths):
+        """Start checking new installs and stop checking ones that are gone."""
+        now = time.time()
+        with self._cond:
+            for path in set(emby_paths) - set(self._installs):
+                self._installs[path] = {
+                    'interval': self.min_interval, 'next_run': None, 'last_run': None,
+                    'last_duration': None, 'last_lag': None, 'last_change': None,
+                    'checks': 0, 'changes': 0, 'failures': 0, 'running': False,
+                    'manifest': None, 'status': None
+                }
+                # Spread the first checks over an interval instead of running them all now
+                self._schedule(path, now + random.uniform(0, self.min_interval))
+            for path in set(self._installs) - set(emby_paths):
+                del self._installs[path]
+
+    def reset(self, emby_path):
+        """Check an install soon and often again, e.g. after it was modified.
+
+        In a worker process that does not run the checks, the reset is passed
+        on through the shared store to the one that does.
+        """
+        if not self.running and shared_store.enabled:
+            shared_store.set('health_resets', emby_path, time.time())
+            return
+        self._reset(emby_path)
+
+    def _apply_shared_resets(self):
+        for emby_path, _ in shared_store.items('health_resets'):
+            shared_store.delete('health_resets', emby_path)
+            self._reset(emby_path)
+
+    def _reset(self, emby_path):
+        with self._cond:
+            state = self._installs.get(emby_path)
+            if state is None:
+                return
+            state['interval'] = self.min_interval
+            self._schedule(emby_path, time.time() + self._jittered(self.min_interval))
+
+    def start(self, get_installs, rediscover_interval=REDISCOVER_INTERVAL):
+        """Start checking in the background.
+
+        Args:
+            get_installs (callable): Returns the install paths to check; called
+                again every rediscover_interval seconds
+        """
+        if self.running or self.max_concurrent < 1:
+            return
+        self._get_installs = get_installs
+        self._rediscover_interval = rediscover_interval
+        self._stopping = False
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='health-check')
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='health-scheduler')
+        self._thread.start()
+        logging.info("Health scheduler started: {}s to {}s intervals, {} concurrent checks".format(
+            self.min_interval, self.max_interval, self.max_concurrent))
+
+    def stop(self):
+        """Stop scheduling checks, letting running ones finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _loop(self):
+        while True:
+            now = time.time()
+            if now >= self._next_discovery:
+                try:
+                    self.sync(self._get_installs())
+                except Exception as e:
+                    logging.warning(f"Health scheduler could not list installs: {e}")
+                self._next_discovery = now + self._rediscover_interval
+            check_resets_at = float('inf')
+            if shared_store.enabled:
+                try:
+                    self._apply_shared_resets()
+                except Exception as e:
+                    logging.warning(f"Health scheduler could not read shared resets: {e}")
+                check_resets_at = time.time() + SHARED_RESET_INTERVAL
+            with self._cond:
+                while not self._stopping:
+                    now = time.time()
+                    # Drop heap entries left behind by rescheduling
+                    while self._heap and (self._heap[0][1] not in self._installs or
+                                          self._installs[self._heap[0][1]]['next_run'] != self._heap[0][0]):
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    wait_until = min(self._heap[0][0] if self._heap else self._next_discovery,
+                                     self._next_discovery, check_resets_at)
+                    if wait_until <= now:
+                        break
+                    self._cond.wait(wait_until - now)
+                if self._stopping:
+                    return
+                if not self._heap or self._heap[0][0] > time.time():
+                    continue  # Time to rediscover, or to apply resets from other workers
+                due, path = heapq.heappop(self._heap)
+                self._installs[path]['next_run'] = None
+                self._installs[path]['running'] = True
+            # Waiting for a free slot is part of the scheduling lag
+            self._slots.acquire()
+            self._executor.submit(self._run, path, due)
+
+    def _run(self, path, due):
+        started = time.time()
+        lag = max(0.0, started - due)
+        changed, failed, status = False, False, None
+        try:
+            with self._cond:
+                previous_manifest = self._installs[path]['manifest'] if path in self._installs else None
+            manifest = stat_manifest(get_install_watch_paths(path))
+            if manifest != previous_manifest:
+                # Something on disk changed, inspect it
+                status = inspect_install(path)
+                changed = previous_manifest is not None
+        except Exception as e:
+            failed = True
+            logging.warning(f"Health check of {path} failed: {e}")
+        finally:
+            self._slots.release()
+        finished = time.time()
+
+        with self._cond:
+            metrics = self._metrics
+            metrics['checks'] += 1
+            metrics['inspections'] += status is not None
+            metrics['changes'] += changed
+            metrics['failures'] += failed
+            metrics['lag_avg'] += LAG_SMOOTHING * (lag - metrics['lag_avg'])
+            metrics['lag_max'] = max(metrics['lag_max'], lag)
+            state = self._installs.get(path)
+            if state is None:
+                return  # No longer an install
+            state.update(running=False, last_run=started, last_duration=finished - started, last_lag=lag)
+            state['checks'] += 1
+            if failed:
+                state['failures'] += 1
+                state['interval'] = self.min_interval
+            elif status is not None:
+                if changed or state['status'] is None:
+                    state['interval'] = self.min_interval
+                if changed:
+                    state['changes'] += 1
+                    state['last_change'] = finished
+                state['manifest'], state['status'] = manifest, status
+            else:
+                state['interval'] = min(state['interval'] * self.backoff, self.max_interval)
+            if state['next_run'] is None:
+                self._schedule(path, finished + self._jittered(state['interval']))
+        if status is not None:
+            database.record_inspection(
+                path, ffmpeg_path=status['ffmpeg_path'], ffmpeg_architecture=status['ffmpeg_architecture'],
+                is_compatible=status['is_compatible'], has_backup=status['has_backup'],
+                test_mode_active=status['test_mode_active'])
+            if changed:
+                logging.info(f"Health check found a change in {path}: {status}")
+
+    def count_due(self):
+        """Count the installs whose check is due, i.e. the scheduler's queue depth."""
+        now = time.time()
+        with self._cond:
+            return sum(1 for state in self._installs.values() if state['next_run'] and state['next_run'] <= now)
+
+    def get_schedule(self):
+        """Get each install's schedule and the scheduler's lag metrics."""
+        now = time.time()
+        with self._cond:
+            installs = []
+            for path, state in sorted(self._installs.items()):
+                entry = {key: value for key, value in state.items() if key != 'manifest'}
+                entry['path'] = path
+                entry['next_run_in'] = round(state['next_run'] - now, 3) if state['next_run'] else None
+                # Positive once an install is overdue and waiting for the scheduler or a free slot
+                entry['overdue'] = round(now - state['next_run'], 3) if state['next_run'] and \
+                    state['next_run'] < now else 0
+                installs.append(entry)
+            metrics = dict(self._metrics, lag_avg=round(self._metrics['lag_avg'], 3),
+                           lag_max=round(self._metrics['lag_max'], 3))
+        return {
+            'running': self.running,
+            'max_concurrent': self.max_concurrent,
+            'min_interval': self.min_interval,
+            'max_interval': self.max_interval,
+            'metrics': metrics,
+            'installs': installs
+        }
+
+# Create a global instance
+health_scheduler = HealthScheduler()
+
+metrics.callback('health_checks_due', 'Installs whose health check is due or overdue', (),
+                 lambda: [((), health_scheduler.count_due())])
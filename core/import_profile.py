@@ -0,0 +1,103 @@
+"""
+Import profile module for Emby FFMPEG Fixer.
+Measures how long importing the application takes, per module, so startup
+cost (which the PyInstaller onefile build pays on every launch) can be
+checked against a budget. Works in the frozen build, where -X importtime
+is not available, by timing module execution from a meta path finder.
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+
+DEFAULT_BUDGET_MS = 300  # Total import time allowed for the application
+REPORT_LIMIT = 25  # Modules listed in the report
+
+class _TimedLoader:
+    def __init__(self, loader, profiler, name):
+        self._loader = loader
+        self._profiler = profiler
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._profiler.start(self._name)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler.stop(self._name)
+
+class ImportProfiler:
+    def __init__(self):
+        self.timings = {}  # name -> (cumulative seconds, self seconds)
+        self._stack = []
+
+    def find_spec(self, fullname, path, target=None):
+        # Ask the remaining finders, then time the module's execution
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self, fullname)
+                return spec
+        return None
+
+    def start(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self, name):
+        _, started, children = self._stack.pop()
+        cumulative = time.perf_counter() - started
+        self.timings[name] = (cumulative, cumulative - children)
+        if self._stack:
+            self._stack[-1][2] += cumulative
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc):
+        sys.meta_path.remove(self)
+
+def format_report(timings, total, budget_ms, limit=REPORT_LIMIT):
+    """Format the slowest imports and the total against the budget."""
+    lines = ["{:>10} {:>10}  {}".format('cumul ms', 'self ms', 'module')]
+    for name, (cumulative, own) in sorted(timings.items(), key=lambda item: -item[1][0])[:limit]:
+        lines.append("{:>10.1f} {:>10.1f}  {}".format(cumulative * 1000, own * 1000, name))
+    status = 'OK' if total * 1000 <= budget_ms else 'OVER BUDGET'
+    lines.append("Total import time: {:.1f} ms of {} ms budget ({}), {} modules".format(
+        total * 1000, budget_ms, status, len(timings)))
+    return '\n'.join(lines)
+
+def run_import_profile(module_name, argv=None):
+    """Import a module with profiling and print the report.
+
+    Must run before the module (and ideally its dependencies) is imported.
+    The budget comes from --import-budget in argv, the
+    EMBY_FIXER_IMPORT_BUDGET_MS environment variable or DEFAULT_BUDGET_MS.
+
+    Args:
+        module_name (str): Module to import, e.g. 'app'
+        argv (list, optional): Command line arguments
+
+    Returns:
+        int: Exit status, 0 within budget and 1 over budget
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--import-budget', type=int,
+                        default=int(os.environ.get('EMBY_FIXER_IMPORT_BUDGET_MS', DEFAULT_BUDGET_MS)))
+    budget_ms = parser.parse_known_args(argv)[0].import_budget
+    with ImportProfiler() as profiler:
+        started = time.perf_counter()
+        importlib.import_module(module_name)
+        total = time.perf_counter() - started
+    print(format_report(profiler.timings, total, budget_ms))
+    return 0 if total * 1000 <= budget_ms else 1
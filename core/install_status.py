@@ -0,0 +1,189 @@
+"""
+Install status module for Emby FFMPEG Fixer.
+Inspects an Emby Server installation in a single pass, sharing the discovered
+FFMPEG path and architecture results between all status fields.
+"""
+import os
+from .process_manager import process_manager
+from .state_manager import state_manager
+from .database import database
+from .discovery import find_emby_servers
+from .emby_processes import emby_process_monitor
+from .utils import (
+    get_system_architecture,
+    find_ffmpeg_binaries,
+    get_ffmpeg_architecture,
+    get_default_emby_path,
+    is_test_mode_active,
+    get_test_mode_info
+)
+
+# Fields that can be requested from collect_install_status
+STATUS_FIELDS = ('default_path', 'servers', 'compatibility', 'backup', 'test_mode', 'process_state')
+
+_UNSET = object()
+
+class InstallInspection:
+    def __init__(self, emby_path, is_remote_access=False):
+        self.emby_path = emby_path
+        self.is_remote_access = is_remote_access
+        self._ffmpeg_path = _UNSET
+        self._ffmpeg_arch = _UNSET
+        self._system_arch = _UNSET
+        self._local_arch = _UNSET
+
+    @property
+    def ffmpeg_path(self):
+        """Path to the install's FFMPEG binary, located once."""
+        if self._ffmpeg_path is _UNSET:
+            self._ffmpeg_path = find_ffmpeg_binaries(self.emby_path)
+        return self._ffmpeg_path
+
+    @property
+    def ffmpeg_architecture(self):
+        """Architecture of the install's FFMPEG binary, probed once."""
+        if self._ffmpeg_arch is _UNSET:
+            self._ffmpeg_arch = get_ffmpeg_architecture(self.ffmpeg_path) if self.ffmpeg_path else None
+        return self._ffmpeg_arch
+
+    @property
+    def system_architecture(self):
+        """Architecture of the host, as seen by the requesting client."""
+        if self._system_arch is _UNSET:
+            self._system_arch = get_system_architecture('remote' if self.is_remote_access else None)
+        return self._system_arch
+
+    @property
+    def local_architecture(self):
+        """Architecture of the machine this fixer runs on."""
+        if self._local_arch is _UNSET:
+            self._local_arch = get_system_architecture()
+        return self._local_arch
+
+    def compatibility(self):
+        """Get the check-compatibility payload."""
+        system_arch = self.system_architecture
+        ffmpeg_arch = self.ffmpeg_architecture
+        is_compatible = system_arch == ffmpeg_arch if system_arch and ffmpeg_arch else False
+        message = "FFMPEG is compatible with your system" if is_compatible else \
+                 "FFMPEG architecture ({}) does not match system architecture ({})".format(
+                     ffmpeg_arch or "Unknown", system_arch or "Unknown")
+        return {
+            'success': True,
+            'is_compatible': is_compatible,
+            'message': message,
+            'system_architecture': system_arch or "Unknown",
+            'ffmpeg_architecture': ffmpeg_arch or "Unknown"
+        }
+
+    def backup(self):
+        """Get the check-backup payload."""
+        if not self.ffmpeg_path:
+            return {
+                'success': False,
+                'message': 'FFMPEG binaries not found in Emby Server',
+                'has_backup': False
+            }
+        backup_dir = os.path.join(os.path.dirname(self.ffmpeg_path), "ffmpeg_backup_original")
+        return {
+            'success': True,
+            'has_backup': os.path.exists(backup_dir)
+        }
+
+    def test_mode(self):
+        """Get the check-test-mode payload."""
+        is_active = is_test_mode_active(self.ffmpeg_path) if self.ffmpeg_path else False
+        current_arch = self.ffmpeg_architecture
+        system_arch = self.local_architecture
+        return {
+            'success': True,
+            'test_mode_active': is_active,
+            'test_info': get_test_mode_info(self.ffmpeg_path) if is_active else None,
+            'details': {
+                'system_architecture': system_arch,
+                'current_ffmpeg_architecture': current_arch,
+                'is_compatible': current_arch == system_arch if current_arch else None
+            }
+        }
+
+    def record(self, is_compatible=None, has_backup=None, test_mode_active=None):
+        """Persist the results of this inspection, without probing anything not yet looked at."""
+        known = lambda value: None if value is _UNSET else value
+        database.record_inspection(
+            self.emby_path,
+            ffmpeg_path=known(self._ffmpeg_path),
+            ffmpeg_architecture=known(self._ffmpeg_arch),
+            system_architecture=known(self._local_arch),
+            is_compatible=is_compatible,
+            has_backup=has_backup,
+            test_mode_active=test_mode_active)
+
+def inspect_install(emby_path):
+    """Get the compact status of an install, as reported by agents and health checks."""
+    inspection = InstallInspection(emby_path)
+    ffmpeg_arch = inspection.ffmpeg_architecture
+    system_arch = inspection.local_architecture
+    has_backup = inspection.backup()['has_backup']
+    test_mode_active = inspection.test_mode()['test_mode_active']
+    is_compatible = system_arch == ffmpeg_arch if system_arch and ffmpeg_arch else False
+    return {
+        'ffmpeg_path': inspection.ffmpeg_path,
+        'ffmpeg_architecture': ffmpeg_arch,
+        'is_compatible': is_compatible,
+        'has_backup': has_backup,
+        'test_mode_active': test_mode_active,
+        'transcodes': len(emby_process_monitor.get_active_transcodes(emby_path))
+    }
+
+def get_process_status():
+    """Get the process-state payload."""
+    return {
+        'success': True,
+        'is_processing': process_manager.is_running,
+        'main_app_running': state_manager.is_main_app_running()
+    }
+
+def collect_install_status(emby_path=None, fields=None, is_remote_access=False):
+    """Collect everything the UI needs about an install in one pass.
+
+    Args:
+        emby_path (str, optional): Install to inspect. Falls back to the default install.
+        fields (iterable, optional): Subset of STATUS_FIELDS to compute. Defaults to all.
+        is_remote_access (bool): Whether the request comes from a remote browser
+
+    Returns:
+        dict: One entry per requested field, plus the inspected 'path'
+    """
+    fields = set(fields or STATUS_FIELDS)
+    status = {'success': True}
+
+    default_path = None
+    if 'default_path' in fields or not emby_path:
+        default_path = get_default_emby_path()
+        if 'default_path' in fields:
+            status['default_path'] = default_path
+
+    if 'servers' in fields:
+        status['servers'] = find_emby_servers()
+
+    emby_path = emby_path or default_path
+    status['path'] = emby_path
+
+    inspection_fields = fields & {'compatibility', 'backup', 'test_mode'}
+    if inspection_fields:
+        if emby_path and os.path.exists(emby_path):
+            inspection = InstallInspection(emby_path, is_remote_access)
+            for field in inspection_fields:
+                status[field] = getattr(inspection, field)()
+            inspection.record(
+                is_compatible=status.get('compatibility', {}).get('is_compatible'),
+                has_backup=status.get('backup', {}).get('has_backup'),
+                test_mode_active=status.get('test_mode', {}).get('test_mode_active'))
+        else:
+            for field in inspection_fields:
+                status[field] = {'success': False, 'message': 'Invalid Emby Server path'}
+
+    if 'process_state' in fields:
+        status['process_state'] = get_process_status()
+
+    return status
@@ -0,0 +1,424 @@
+"""
+Install watcher module for Emby FFMPEG Fixer.
+Notices within seconds when an Emby Server update puts an incompatible
+FFMPEG back. Each install's directories are watched with inotify on Linux,
+or else polled through their stat manifest; bursts of changes, like an
+update rewriting a bundle, are debounced into one check, which probes only
+the binaries whose stat info changed and can fix the install right away.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import platform
+import threading
+from collections import deque
+from .database import database
+from .metrics import metrics
+from .shared_store import shared_store
+from .response_cache import response_cache
+from .health_scheduler import health_scheduler
+from .emby_processes import emby_process_monitor
+from .operations import fix_ffmpeg_compatibility
+from .utils import (
+    FFMPEG_BINARIES,
+    find_ffmpeg_binaries,
+    get_ffmpeg_architecture,
+    get_install_watch_paths,
+    get_system_architecture,
+    is_test_mode_active,
+    stat_manifest
+)
+
+DEBOUNCE = 2.0  # Seconds without changes before an install is checked
+MAX_DELAY = 30.0  # Longest a check waits while changes keep coming
+POLL_INTERVAL = 5.0  # Seconds between stat manifest polls without inotify
+TRANSCODE_RETRY = 30.0  # Seconds before retrying a fix put off by a transcode
+FAILED_FIX_BACKOFF = 300.0  # Seconds before retrying a fix that failed
+REDISCOVER_INTERVAL = 300  # Seconds between refreshes of the list of installs
+MAX_EVENTS = 100  # Recent checks kept for the status
+
+# inotify flags, from <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """Minimal inotify binding through ctypes, Linux only."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path):
+        """Watch a directory, returning its watch descriptor or None if it cannot be watched."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        return wd if wd >= 0 else None
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Read the pending events as (wd, mask, name) tuples."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+def _binary_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+class InstallWatcher:
+    def __init__(self, debounce=DEBOUNCE, max_delay=MAX_DELAY, poll_interval=POLL_INTERVAL, auto_fix=False):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.auto_fix = auto_fix
+        self._lock = threading.Lock()
+        self._installs = {}  # path -> watch state
+        self._due = {}  # path -> (first change, check time)
+        self._wds = {}  # inotify watch descriptor -> {path: file name filter or None}
+        self._inotify = None
+        self._thread = None
+        self._stopping = False
+        self._wake_r, self._wake_w = None, None
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._stats = {'notifications': 0, 'checks': 0, 'probes': 0, 'fixes': 0, 'fix_failures': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def backend(self):
+        return 'inotify' if self._inotify else 'polling'
+
+    def start(self, get_installs, rediscover_interval=REDISCOVER_INTERVAL):
+        """Start watching in the background.
+
+        Args:
+            get_installs (callable): Returns the install paths to watch; called
+                again every rediscover_interval seconds
+        """
+        if self.running:
+            return
+        self._stopping = False
+        if platform.system() == 'Linux':
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify is unavailable ({e}), polling installs instead")
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._loop, args=(get_installs, rediscover_interval),
+                                        daemon=True, name='install-watcher')
+        self._thread.start()
+        logging.info("Install watcher started with {}, auto-fix {}".format(
+            self.backend, 'on' if self.auto_fix else 'off'))
+
+    def stop(self):
+        """Stop watching."""
+        self._stopping = True
+        if self._wake_w is not None:
+            os.write(self._wake_w, b'x')
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._wake_r, self._wake_w):
+            if fd is not None:
+                os.close(fd)
+        self._wake_r, self._wake_w = None, None
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+        self._wds.clear()
+
+    def _watch(self, emby_path):
+        # inotify watches directories; an update replacing the whole bundle is
+        # seen through the parent directory, filtered on the bundle's name
+        dirs = [(os.path.dirname(emby_path.rstrip(os.sep)), os.path.basename(emby_path.rstrip(os.sep)))]
+        dirs += [(path, None) for path in get_install_watch_paths(emby_path)]
+        for path, name in dirs:
+            if not os.path.isdir(path):
+                continue
+            wd = self._inotify.add_watch(path)
+            if wd is not None:
+                # A directory watched twice gets the same descriptor
+                self._wds.setdefault(wd, {})[emby_path] = name
+
+    def _unwatch(self, emby_path):
+        for wd in list(self._wds):
+            self._wds[wd].pop(emby_path, None)
+            if not self._wds[wd]:
+                del self._wds[wd]
+                self._inotify.rm_watch(wd)
+
+    def _snapshot(self, emby_path):
+        ffmpeg_path = find_ffmpeg_binaries(emby_path)
+        if not ffmpeg_path:
+            return None, {}
+        ffmpeg_dir = os.path.dirname(ffmpeg_path)
+        binaries = {}
+        for binary in FFMPEG_BINARIES:
+            path = os.path.join(ffmpeg_dir, binary)
+            key = _binary_key(path)
+            if key is not None:
+                binaries[path] = key
+        return ffmpeg_path, binaries
+
+    def sync(self, emby_paths):
+        """Start watching new installs and stop watching ones that are gone."""
+        for emby_path in set(emby_paths) - set(self._installs):
+            ffmpeg_path, binaries = self._snapshot(emby_path)
+            state = {'ffmpeg_path': ffmpeg_path, 'binaries': {}, 'manifest': None, 'incompatible': [],
+                     'last_change': None, 'last_check': None, 'last_fix': None, 'fix_blocked_until': 0}
+            if not self._inotify:
+                state['manifest'] = stat_manifest(get_install_watch_paths(emby_path))
+            with self._lock:
+                self._installs[emby_path] = state
+            if self._inotify:
+                self._watch(emby_path)
+            # The first check probes every binary, so an install that is already broken gets fixed
+            self._mark(emby_path, time.time(), delay=0)
+        for emby_path in set(self._installs) - set(emby_paths):
+            if self._inotify:
+                self._unwatch(emby_path)
+            with self._lock:
+                del self._installs[emby_path]
+                self._due.pop(emby_path, None)
+
+    def _mark(self, emby_path, now, delay=None):
+        """Check an install after a change, or after the given delay."""
+        with self._lock:
+            first, when = self._due.get(emby_path, (now, None))
+            if delay is None:
+                # Each change pushes the check back by the debounce delay, up to max_delay after the first one
+                when = min(now + self.debounce, first + self.max_delay)
+                if emby_path in self._installs:
+                    self._installs[emby_path]['last_change'] = now
+            else:
+                when = min(when or now + delay, now + delay)
+            self._due[emby_path] = (first, when)
+
+    def _collect_inotify(self, now):
+        for wd, mask, name in self._inotify.read_events():
+            self._stats['notifications'] += 1
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check everything
+                for emby_path in list(self._installs):
+                    self._mark(emby_path, now)
+                continue
+            for emby_path, name_filter in list(self._wds.get(wd, {}).items()):
+                if name_filter is None or name_filter == name:
+                    self._mark(emby_path, now)
+            if mask & IN_IGNORED:
+                # The directory is gone; it is watched again when its install is checked
+                self._wds.pop(wd, None)
+
+    def _poll(self, now):
+        for emby_path in list(self._installs):
+            manifest = stat_manifest(get_install_watch_paths(emby_path))
+            with self._lock:
+                state = self._installs.get(emby_path)
+                changed = state is not None and manifest != state['manifest']
+                if changed:
+                    state['manifest'] = manifest
+            if changed:
+                self._mark(emby_path, now)
+
+    def _loop(self, get_installs, rediscover_interval):
+        next_discovery = 0
+        next_poll = time.time() + self.poll_interval
+        while not self._stopping:
+            now = time.time()
+            if now >= next_discovery:
+                try:
+                    self.sync(get_installs())
+                except Exception as e:
+                    logging.warning(f"Install watcher could not list installs: {e}")
+                next_discovery = now + rediscover_interval
+            with self._lock:
+                due = sorted((when, emby_path) for emby_path, (_, when) in self._due.items())
+            for when, emby_path in due:
+                if when > now:
+                    break
+                with self._lock:
+                    self._due.pop(emby_path, None)
+                try:
+                    self.check(emby_path)
+                except Exception as e:
+                    logging.warning(f"Watch check of {emby_path} failed: {e}")
+
+            with self._lock:
+                next_due = min((when for _, when in self._due.values()), default=None)
+            wait_until = min(next_due or next_discovery, next_discovery)
+            if not self._inotify:
+                wait_until = min(wait_until, next_poll)
+            fds = [self._wake_r] + ([self._inotify.fd] if self._inotify else [])
+            try:
+                # Blocks without using any CPU until a change, a deadline or stop()
+                readable, _, _ = select.select(fds, [], [], max(0.0, wait_until - time.time()))
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                readable = []
+            now = time.time()
+            if self._inotify and self._inotify.fd in readable:
+                self._collect_inotify(now)
+            if not self._inotify and now >= next_poll:
+                self._poll(now)
+                next_poll = now + self.poll_interval
+
+    def check(self, emby_path):
+        """Probe the install's binaries that changed, and fix it if they became incompatible.
+
+        Returns:
+            dict: What the check found, as kept in the recent events
+        """
+        with self._lock:
+            state = self._installs.get(emby_path)
+            if state is None:
+                return None
+            known = state['binaries']
+        self._stats['checks'] += 1
+        if self._inotify:
+            # Directories replaced by an update need new watches
+            self._watch(emby_path)
+        ffmpeg_path, binaries = self._snapshot(emby_path)
+        system_arch = get_system_architecture()
+        changed = [path for path, key in binaries.items() if path not in known or known[path][0] != key]
+        probed = {}
+        for path in changed:
+            self._stats['probes'] += 1
+            probed[path] = (binaries[path], get_ffmpeg_architecture(path))
+        checked = {path: probed.get(path) or known[path] for path in binaries}
+        # Unknown architectures are left to the UI, only a known mismatch is fixed
+        incompatible = sorted(path for path, (_, arch) in checked.items() if arch and arch != system_arch)
+        now = time.time()
+        # Probing is slow, so the state is only locked to record the outcome
+        with self._lock:
+            state.update(binaries=checked, ffmpeg_path=ffmpeg_path, incompatible=incompatible, last_check=now)
+            fix_blocked_until = state['fix_blocked_until']
+        event = {'path': emby_path, 'at': now, 'changed': changed,
+                 'architectures': {path: arch for path, (_, arch) in probed.items()},
+                 'incompatible': incompatible, 'fix': None}
+        if incompatible:
+            logging.warning("Watched install {} has incompatible FFMPEG binaries: {}".format(
+                emby_path, ', '.join(incompatible)))
+            if self.auto_fix and now < fix_blocked_until:
+                # The fix's own roll back changes the binaries, so failures are not retried right away
+                event['fix'] = {"success": False, "message": "Last auto-fix failed, retrying in {}s".format(
+                    int(fix_blocked_until - now))}
+            elif self.auto_fix:
+                event['fix'] = self._fix(emby_path, ffmpeg_path)
+        with self._lock:
+            self._events.append(event)
+        return event
+
+    def _fix(self, emby_path, ffmpeg_path):
+        if ffmpeg_path and is_test_mode_active(ffmpeg_path):
+            return {"success": False, "message": "Test mode is active, not fixing"}
+        if emby_process_monitor.get_active_transcodes(emby_path):
+            self._mark(emby_path, time.time(), delay=TRANSCODE_RETRY)
+            return {"success": False, "message": "Emby Server is transcoding, retrying in {}s".format(
+                int(TRANSCODE_RETRY))}
+        started = time.time()
+        with shared_store.lock('install-{}'.format(emby_path)):
+            operation_id = database.start_operation(emby_path, 'auto-fix')
+            try:
+                result = fix_ffmpeg_compatibility(emby_path)
+            finally:
+                response_cache.invalidate(emby_path)
+            database.finish_operation(operation_id, result.get('success'), result.get('message'))
+        health_scheduler.reset(emby_path)
+        self._stats['fixes' if result.get('success') else 'fix_failures'] += 1
+        result = dict(result, elapsed=round(time.time() - started, 3))
+        now = time.time()
+        with self._lock:
+            state = self._installs.get(emby_path)
+            if state is not None:
+                state['last_fix'] = dict(result, at=now)
+                state['fix_blocked_until'] = 0 if result.get('success') else now + FAILED_FIX_BACKOFF
+        if result.get('success'):
+            logging.info(f"Auto-fixed {emby_path} in {result['elapsed']}s")
+            # Probe the new binaries, also when polling misses the swap
+            self._mark(emby_path, now)
+        else:
+            logging.error(f"Auto-fix of {emby_path} failed: {result.get('message')}")
+            self._mark(emby_path, now, delay=FAILED_FIX_BACKOFF)
+        return result
+
+    def count_due(self):
+        """Count the installs waiting for a check after a change."""
+        with self._lock:
+            return len(self._due)
+
+    def get_status(self):
+        """Get the watched installs, the recent checks and the watcher's counts."""
+        now = time.time()
+        with self._lock:
+            installs = []
+            for emby_path, state in sorted(self._installs.items()):
+                due = self._due.get(emby_path)
+                installs.append({
+                    'path': emby_path,
+                    'ffmpeg_path': state['ffmpeg_path'],
+                    'architectures': {path: arch for path, (_, arch) in state['binaries'].items()},
+                    'incompatible': state['incompatible'],
+                    'last_change': state['last_change'],
+                    'last_check': state['last_check'],
+                    'last_fix': state['last_fix'],
+                    'check_in': round(max(0.0, due[1] - now), 3) if due else None
+                })
+            events = list(self._events)
+        return {
+            'running': self.running,
+            'backend': self.backend,
+            'auto_fix': self.auto_fix,
+            'debounce': self.debounce,
+            'watches': len(self._wds),
+            'stats': dict(self._stats),
+            'installs': installs,
+            'events': events
+        }
+
+# Create a global instance
+install_watcher = InstallWatcher()
+
+metrics.callback('install_checks_due', 'Changed installs waiting for their debounced check', (),
+                 lambda: [((), install_watcher.count_due())])
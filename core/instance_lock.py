@@ -0,0 +1,91 @@
+"""
+Instance lock module for Emby FFMPEG Fixer.
+Keeps a single fixer running per data directory with an advisory lock on a
+file that records the owner's pid and port. A second launch finds the live
+instance through the lock file and a quick /health request instead of
+killing processes.
+"""
+import os
+import json
+import time
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock, every launch gets the lock
+    fcntl = None
+
+HANDSHAKE_TIMEOUT = 2  # Seconds to wait for a starting instance to answer /health
+
+class InstanceLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Try to become the running instance, without blocking.
+
+        Returns:
+            bool: True if this process now holds the lock
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self._file = lock_file
+        return True
+
+    def set_port(self, port):
+        """Record our pid and listening port for later launches."""
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(json.dumps({'pid': os.getpid(), 'port': port}))
+        self._file.flush()
+
+    def read_owner(self):
+        """Get the pid and port recorded by the lock holder, if any."""
+        try:
+            with open(self.path) as f:
+                return json.loads(f.read() or 'null')
+        except (OSError, ValueError):
+            return None
+
+    def release(self):
+        """Release the lock."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def is_instance_healthy(port, host='127.0.0.1', timeout=0.5):
+    """Check whether a fixer answers /health on the given port."""
+    import http.client  # Only needed when another instance holds the lock
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', '/health')
+        return conn.getresponse().status == 200
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+def find_running_instance(lock):
+    """Get the port of the live instance holding the lock.
+
+    Waits briefly for an instance that is still starting up.
+
+    Returns:
+        int: The instance's port, or None if it does not answer
+    """
+    deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    while True:
+        owner = lock.read_owner()
+        if owner and owner.get('port') and is_instance_healthy(owner['port']):
+            return owner['port']
+        if time.monotonic() >= deadline:
+            logging.warning(f"Instance lock {lock.path} is held by {owner} but it does not answer")
+            return None
+        time.sleep(0.1)
@@ -0,0 +1,217 @@
+"""
+Inventory module for Emby FFMPEG Fixer.
+Builds a machine-readable inventory of the local installs and of the
+installs fleet agents report: Emby version, FFMPEG path, the architecture
+slices and SHA-256 of each binary, backup status and the last fix. Rows
+are stored with a change sequence number, so an export can be limited to
+the changes since a previous export's token, and they are streamed from
+the database one at a time as CSV or NDJSON.
+"""
+import os
+import io
+import csv
+import json
+import socket
+import struct
+import hashlib
+import logging
+import threading
+from .database import database
+from .discovery import find_emby_servers
+from .utils import FFMPEG_BINARIES, find_ffmpeg_binaries, get_emby_version, hash_file, is_test_mode_active
+
+FORMATS = ('ndjson', 'csv')
+CACHE_SIZE = 1024
+
+# Mach-O CPU types, and ELF and PE machine types, named like get_system_architecture does
+MACHO_CPU_TYPES = {7: 'i386', 0x01000007: 'x86_64', 12: 'arm', 0x0100000c: 'arm64',
+                   18: 'ppc', 0x01000012: 'ppc64'}
+ELF_MACHINES = {0x03: 'i386', 0x28: 'arm', 0x3e: 'x86_64', 0xb7: 'arm64'}
+PE_MACHINES = {0x14c: 'i386', 0x1c4: 'arm', 0x8664: 'x86_64', 0xaa64: 'arm64'}
+
+CSV_FIELDS = (['host_id', 'path', 'emby_version', 'ffmpeg_path'] +
+              ['{}_{}'.format(binary, field) for binary in FFMPEG_BINARIES for field in ('slices', 'sha256')] +
+              ['has_backup', 'backup_path', 'test_mode_active', 'last_fix_at', 'last_fix_success',
+               'last_fix_message', 'removed', 'seq', 'updated_at'])
+
+def read_binary_slices(path):
+    """Get the architectures a Mach-O (thin or universal), ELF or PE binary is built for.
+
+    Only the headers are read, no external tools are run.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(4096)
+    if len(header) < 8:
+        return []
+    magic = header[:4]
+    if magic in (b'\xca\xfe\xba\xbe', b'\xca\xfe\xba\xbf'):
+        # Universal binary: a big-endian table of slices
+        count = struct.unpack('>I', header[4:8])[0]
+        entry_size = 32 if magic == b'\xca\xfe\xba\xbf' else 20
+        if 0 < count < 32:  # Java class files share the magic number
+            slices = []
+            for index in range(count):
+                offset = 8 + index * entry_size
+                if offset + 8 > len(header):
+                    break
+                cpu_type, cpu_subtype = struct.unpack('>Ii', header[offset:offset + 8])
+                name = MACHO_CPU_TYPES.get(cpu_type, hex(cpu_type))
+                slices.append('arm64e' if name == 'arm64' and cpu_subtype & 0xff == 2 else name)
+            return slices
+    if magic in (b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe', b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf'):
+        byte_order = '<' if magic[0] in (0xce, 0xcf) else '>'
+        cpu_type, cpu_subtype = struct.unpack(byte_order + 'Ii', header[4:12])
+        name = MACHO_CPU_TYPES.get(cpu_type, hex(cpu_type))
+        return ['arm64e' if name == 'arm64' and cpu_subtype & 0xff == 2 else name]
+    if magic == b'\x7fELF' and len(header) >= 20:
+        byte_order = '<' if header[5] == 1 else '>'
+        machine = struct.unpack(byte_order + 'H', header[18:20])[0]
+        return [ELF_MACHINES.get(machine, hex(machine))]
+    if magic[:2] == b'MZ' and len(header) >= 64:
+        pe_offset = struct.unpack('<I', header[60:64])[0]
+        if header[pe_offset:pe_offset + 4] == b'PE\0\0':
+            machine = struct.unpack('<H', header[pe_offset + 4:pe_offset + 6])[0]
+            return [PE_MACHINES.get(machine, hex(machine))]
+    return []
+
+def parse_token(token):
+    """Get the sequence number an export token stands for.
+
+    Raises:
+        ValueError: If the token is not one returned by an export
+    """
+    if not token:
+        return 0
+    if not token.isdigit():
+        raise ValueError("Invalid inventory token {}".format(token))
+    return int(token)
+
+class Inventory:
+    def __init__(self):
+        self._binaries = {}  # (path, stat info) -> binary description
+        self._lock = threading.Lock()
+
+    def describe_binary(self, path):
+        """Describe a binary, hashed once per change of its stat info."""
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        with self._lock:
+            described = self._binaries.get(key)
+        if described is None:
+            described = {'name': os.path.basename(path), 'path': path, 'size': st.st_size,
+                         'slices': read_binary_slices(path), 'sha256': hash_file(path)}
+            with self._lock:
+                if len(self._binaries) >= CACHE_SIZE:
+                    self._binaries.clear()
+                self._binaries[key] = described
+        return described
+
+    def describe_install(self, emby_path):
+        """Get the inventory fields of a local install."""
+        ffmpeg_path = find_ffmpeg_binaries(emby_path)
+        binaries, backup_path, test_mode_active = [], None, False
+        if ffmpeg_path:
+            ffmpeg_dir = os.path.dirname(ffmpeg_path)
+            for binary in FFMPEG_BINARIES:
+                binary_path = os.path.join(ffmpeg_dir, binary)
+                if os.path.isfile(binary_path):
+                    binaries.append(self.describe_binary(binary_path))
+            backup_dir = os.path.join(ffmpeg_dir, 'ffmpeg_backup_original')
+            backup_path = backup_dir if os.path.isdir(backup_dir) else None
+            test_mode_active = is_test_mode_active(ffmpeg_path)
+        last_fix = database.get_last_operation(emby_path, ('fix', 'fleet-fix'))
+        return {
+            'emby_version': get_emby_version(emby_path),
+            'ffmpeg_path': ffmpeg_path,
+            'binaries': binaries,
+            'has_backup': backup_path is not None,
+            'backup_path': backup_path,
+            'test_mode_active': test_mode_active,
+            'last_fix': {'at': last_fix['finished_at'], 'success': bool(last_fix['success']),
+                         'message': last_fix['message']} if last_fix else None
+        }
+
+    def _store(self, host_id, emby_path, row):
+        fingerprint = hashlib.sha1(json.dumps(row, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return database.update_inventory(host_id, emby_path, fingerprint, row)
+
+    def refresh(self):
+        """Update the stored inventory from the local installs and the fleet reports.
+
+        Returns:
+            int: Number of rows that changed
+        """
+        changed = 0
+        local_host = socket.gethostname()
+        local_paths = set(find_emby_servers())
+        selected = database.get_setting('emby_path')
+        if selected and os.path.exists(selected):
+            local_paths.add(selected)
+        for emby_path in sorted(local_paths):
+            try:
+                changed += self._store(local_host, emby_path, self.describe_install(emby_path))
+            except OSError as e:
+                logging.warning(f"Could not inventory {emby_path}: {e}")
+        database.remove_inventory(local_host, local_paths)
+
+        # Agents report the same fields; rows carry whatever their agent sent
+        fleet_paths = {}
+        for host_id, emby_path, status in database.iter_fleet_installs():
+            fleet_paths.setdefault(host_id, set()).add(emby_path)
+            row = {field: status.get(field) for field in ('emby_version', 'ffmpeg_path', 'binaries', 'has_backup',
+                                                           'backup_path', 'test_mode_active', 'last_fix')}
+            changed += self._store(host_id, emby_path, row)
+        for host_id in database.get_inventory_hosts():
+            if host_id != local_host:
+                database.remove_inventory(host_id, fleet_paths.get(host_id, set()))
+        return changed
+
+    def export(self, since_token=None, fmt='ndjson', refresh=True):
+        """Export the inventory rows changed since a token.
+
+        Args:
+            since_token (str, optional): Token of a previous export; all rows if not given
+            fmt (str): 'ndjson' or 'csv'
+            refresh (bool): Whether to update the stored inventory first
+
+        Returns:
+            tuple: (token for the next export, iterator of text chunks)
+
+        Raises:
+            ValueError: If the token or format is invalid
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Format must be one of {}".format(', '.join(FORMATS)))
+        since_seq = parse_token(since_token)
+        if refresh:
+            self.refresh()
+        # Rows changed while streaming are left for the next export
+        until_seq = database.get_inventory_seq()
+        rows = database.iter_inventory(since_seq, until_seq)
+        return str(until_seq), (self._to_csv(rows) if fmt == 'csv' else self._to_ndjson(rows))
+
+    def _to_ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(row, default=str) + '\n'
+
+    def _to_csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        yield buffer.getvalue()
+        for row in rows:
+            binaries = {binary['name']: binary for binary in row.get('binaries') or []}
+            flat = dict(row)
+            for binary in FFMPEG_BINARIES:
+                flat[binary + '_slices'] = '+'.join(binaries.get(binary, {}).get('slices', []))
+                flat[binary + '_sha256'] = binaries.get(binary, {}).get('sha256')
+            last_fix = row.get('last_fix') or {}
+            flat.update(last_fix_at=last_fix.get('at'), last_fix_success=last_fix.get('success'),
+                        last_fix_message=last_fix.get('message'))
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(flat)
+            yield buffer.getvalue()
+
+# Create a global instance
+inventory = Inventory()
@@ -0,0 +1,345 @@
+"""
+Journal module for Emby FFMPEG Fixer.
+Write-ahead journal for operations that modify an install. Every step of an
+operation is recorded (synchronously, in SQLite) before it runs and marked
+done after it completes, and every step is idempotent, so an operation
+interrupted by a crash can be rolled forward on the next start by redoing
+only the steps that did not complete. If that fails, the operation's undo
+steps roll it back instead, and an operation without undo steps (a
+restore) is left failed. An operation that already failed at runtime is
+marked as rolling back first, so recovery only ever rolls it back.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from .metrics import JOURNAL_OPERATIONS, JOURNAL_OPERATION_SECONDS, JOURNAL_STEP_SECONDS, record_copy
+from .shared_store import connect_sqlite
+from .utils import hash_file
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS journal_operations (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    emby_path TEXT,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS journal_operations_state ON journal_operations (state);
+CREATE TABLE IF NOT EXISTS journal_steps (
+    operation_id INTEGER NOT NULL REFERENCES journal_operations(id),
+    phase TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    args TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (operation_id, phase, seq)
+) WITHOUT ROWID;
+'''
+
+TEMP_SUFFIX = '.journal-tmp'
+
+def _fsync_dir(path):
+    # Make a rename or unlink durable; not supported on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _copy_file(src, dst, mode=None, keep_existing=False, missing_ok=False):
+    """Atomically replace dst with a copy of src."""
+    if (keep_existing and os.path.exists(dst)) or (missing_ok and not os.path.exists(src)):
+        return
+    tmp = dst + TEMP_SUFFIX
+    started = time.perf_counter()
+    shutil.copy2(src, tmp)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    record_copy('copy_file', os.path.getsize(tmp), time.perf_counter() - started)
+    os.replace(tmp, dst)
+    _fsync_dir(os.path.dirname(dst))
+
+def _link_file(src, dst, keep_existing=False):
+    """Atomically make dst another name of src, copying where hard links are not supported."""
+    if keep_existing and os.path.exists(dst):
+        return
+    tmp = dst + TEMP_SUFFIX
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        started = time.perf_counter()
+        shutil.copy2(src, tmp)
+        record_copy('link_file', os.path.getsize(tmp), time.perf_counter() - started)
+    os.replace(tmp, dst)
+    _fsync_dir(os.path.dirname(dst))
+
+def _rename_file(src, dst):
+    """Move src over dst; both must be on the same filesystem."""
+    if not os.path.exists(src):
+        return  # Already moved
+    os.replace(src, dst)
+    _fsync_dir(os.path.dirname(dst))
+
+def _write_file(path, content):
+    """Atomically replace a file with the given text."""
+    tmp = path + TEMP_SUFFIX
+    with open(tmp, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(path))
+
+def _remove_file(path):
+    """Remove a file if it exists."""
+    if os.path.lexists(path):
+        os.remove(path)
+        _fsync_dir(os.path.dirname(path))
+
+def _check_file(path, sha256):
+    """Fail unless a file has the expected SHA-256, e.g. to verify a copy."""
+    actual = hash_file(path)
+    if actual != sha256:
+        raise ValueError("{} has SHA-256 {}, expected {}".format(path, actual, sha256))
+
+def _make_dir(path):
+    os.makedirs(path, mode=0o755, exist_ok=True)
+
+def _copy_if_changed(src, dst):
+    # Files copied before an interruption keep their size and mtime (copy2),
+    # so a resumed tree copy only copies what is missing or partial
+    try:
+        src_st, dst_st = os.stat(src), os.stat(dst)
+        if src_st.st_size == dst_st.st_size and src_st.st_mtime_ns == dst_st.st_mtime_ns:
+            return dst
+    except OSError:
+        pass
+    started = time.perf_counter()
+    dst = shutil.copy2(src, dst)
+    record_copy('copy_tree', os.path.getsize(dst), time.perf_counter() - started)
+    return dst
+
+def _copy_tree(src, dst):
+    """Copy a directory tree, resuming a previous partial copy."""
+    shutil.copytree(src, dst, symlinks=True, copy_function=_copy_if_changed, dirs_exist_ok=True)
+
+def _swap_dir(staging, target, old):
+    """Move target aside to old and staging into its place."""
+    if not os.path.exists(staging):
+        return  # Already swapped
+    if os.path.exists(target):
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(target, old)
+    os.rename(staging, target)
+    _fsync_dir(os.path.dirname(target))
+
+def _unswap_dir(staging, target, old):
+    """Put old back in place of target after an interrupted swap."""
+    if os.path.exists(old):
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.rename(old, target)
+        _fsync_dir(os.path.dirname(target))
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+
+def _remove_tree(path):
+    """Remove a directory tree if it exists."""
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+# Step actions; each one must be safe to run again after it completed
+ACTIONS = {
+    'copy_file': _copy_file,
+    'link_file': _link_file,
+    'rename_file': _rename_file,
+    'write_file': _write_file,
+    'remove_file': _remove_file,
+    'check_file': _check_file,
+    'make_dir': _make_dir,
+    'copy_tree': _copy_tree,
+    'swap_dir': _swap_dir,
+    'unswap_dir': _unswap_dir,
+    'remove_tree': _remove_tree
+}
+
+def step(action, **args):
+    """Describe a journal step."""
+    if action not in ACTIONS:
+        raise ValueError("Unknown journal action: {}".format(action))
+    return (action, args)
+
+class Journal:
+    def __init__(self):
+        self._path = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        """Whether steps are journaled to disk."""
+        return self._path is not None
+
+    def open(self, path):
+        """Open (creating if needed) the journal database at the given path."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._connection().executescript(SCHEMA)
+        logging.info(f"Journal opened at {path}")
+
+    def _connection(self):
+        # SQLite connections must not cross threads or survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Journal entries must reach the disk before the steps they describe run
+            conn = connect_sqlite(self._path, synchronous='FULL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _begin(self, kind, emby_path, steps, undo):
+        conn = self._connection()
+        with self._transaction(conn):
+            operation_id = conn.execute(
+                "INSERT INTO journal_operations (kind, emby_path, state, created_at) VALUES (?, ?, 'pending', ?)",
+                (kind, emby_path, time.time())).lastrowid
+            for phase, phase_steps in (('do', steps), ('undo', undo)):
+                conn.executemany(
+                    'INSERT INTO journal_steps (operation_id, phase, seq, action, args) VALUES (?, ?, ?, ?, ?)',
+                    [(operation_id, phase, seq, action, json.dumps(args))
+                     for seq, (action, args) in enumerate(phase_steps)])
+        return operation_id
+
+    def _finish(self, operation_id, state):
+        self._connection().execute('UPDATE journal_operations SET state = ?, finished_at = ? WHERE id = ?',
+                                   (state, time.time(), operation_id))
+
+    def _run_phase(self, operation_id, kind, phase, steps=None):
+        if steps is None:
+            steps = [(seq, action, json.loads(args)) for seq, action, args in self._connection().execute(
+                'SELECT seq, action, args FROM journal_steps WHERE operation_id = ? AND phase = ? AND done = 0 '
+                'ORDER BY seq', (operation_id, phase))]
+        for seq, action, args in steps:
+            with JOURNAL_STEP_SECONDS.time(kind=kind, phase=phase, action=action):
+                ACTIONS[action](**args)
+            if operation_id is not None:
+                self._connection().execute('UPDATE journal_steps SET done = 1 WHERE operation_id = ? AND phase = ? AND seq = ?',
+                             (operation_id, phase, seq))
+
+    def run(self, kind, emby_path, steps, undo=()):
+        """Journal and run the steps of an operation.
+
+        Args:
+            kind (str): Name of the operation, e.g. 'fix'
+            emby_path (str): Install the operation modifies
+            steps (list): Steps created with step(), run in order
+            undo (list, optional): Steps that roll the operation back if it fails
+
+        Raises:
+            Exception: The error of the failed step, after the undo steps ran
+        """
+        steps, undo = list(steps), list(undo)
+        started = time.perf_counter()
+        operation_id = self._begin(kind, emby_path, steps, undo) if self.enabled else None
+        try:
+            self._run_phase(operation_id, kind, 'do', [(seq, action, args) for seq, (action, args) in enumerate(steps)])
+        except Exception:
+            logging.error(f"Journaled {kind} operation on {emby_path} failed, rolling back", exc_info=True)
+            if operation_id is not None:
+                # Recorded before undoing, so a crash during the roll back never rolls the change forward
+                self._connection().execute("UPDATE journal_operations SET state = 'rolling_back' WHERE id = ?",
+                                           (operation_id,))
+            try:
+                self._run_phase(operation_id, kind, 'undo',
+                                [(seq, action, args) for seq, (action, args) in enumerate(undo)])
+                if operation_id is not None:
+                    # Without undo steps nothing was rolled back, the install may be half changed
+                    self._finish(operation_id, 'rolled_back' if undo else 'failed')
+            except Exception:
+                # Left rolling back, recovery runs every undo step again
+                logging.error(f"Rolling back {kind} operation on {emby_path} failed", exc_info=True)
+            JOURNAL_OPERATIONS.inc(kind=kind, outcome='failed')
+            JOURNAL_OPERATION_SECONDS.observe(time.perf_counter() - started, kind=kind)
+            raise
+        if operation_id is not None:
+            self._finish(operation_id, 'done')
+        JOURNAL_OPERATIONS.inc(kind=kind, outcome='done')
+        JOURNAL_OPERATION_SECONDS.observe(time.perf_counter() - started, kind=kind)
+
+    def _recover_undo(self, operation_id, kind, emby_path):
+        try:
+            # Undo steps are idempotent, so run all of them
+            self._connection().execute(
+                "UPDATE journal_steps SET done = 0 WHERE operation_id = ? AND phase = 'undo'",
+                (operation_id,))
+            self._run_phase(operation_id, kind, 'undo')
+            return 'rolled_back'
+        except Exception as e:
+            logging.error(f"Could not roll back {kind} operation on {emby_path}: {e}")
+            return 'failed'
+
+    def recover(self):
+        """Roll forward, or else back, every operation interrupted by a crash.
+
+        Returns:
+            list: One dict per interrupted operation with its 'kind', 'emby_path' and final 'state'
+        """
+        if not self.enabled:
+            return []
+        recovered = []
+        pending = self._connection().execute(
+            "SELECT id, kind, emby_path, state FROM journal_operations WHERE state IN ('pending', 'rolling_back') "
+            "ORDER BY id").fetchall()
+        for operation_id, kind, emby_path, state in pending:
+            started = time.time()
+            try:
+                if state == 'rolling_back':
+                    # It failed before the interruption, redoing it would apply the failed change again
+                    raise RuntimeError("it failed before being interrupted")
+                self._run_phase(operation_id, kind, 'do')
+                state = 'done'
+            except Exception as e:
+                has_undo = self._connection().execute(
+                    "SELECT COUNT(*) FROM journal_steps WHERE operation_id = ? AND phase = 'undo'",
+                    (operation_id,)).fetchone()[0]
+                if not has_undo:
+                    # e.g. a restore: nothing to roll back to, so it must not be reported as clean
+                    logging.error(f"Could not roll {kind} operation on {emby_path} forward ({e}) "
+                                  "and it has no undo steps, leaving it failed")
+                    state = 'failed'
+                else:
+                    logging.warning(f"Could not roll {kind} operation on {emby_path} forward ({e}), rolling back")
+                    state = self._recover_undo(operation_id, kind, emby_path)
+            self._finish(operation_id, state)
+            JOURNAL_OPERATIONS.inc(kind=kind, outcome='recovered_' + state)
+            logging.info("Recovered interrupted {} operation on {}: {} in {:.2f}s".format(
+                kind, emby_path, state, time.time() - started))
+            recovered.append({'kind': kind, 'emby_path': emby_path, 'state': state})
+        return recovered
+
+# Create a global instance
+journal = Journal()
@@ -0,0 +1,270 @@
+"""
+Log analyzer module for Emby FFMPEG Fixer.
+Finds FFMPEG failures, such as "Bad CPU type in executable", in Emby
+Server's own logs and transcode logs. Each pass only reads what was
+appended since the last one: the offset and inode of every log file are
+kept in the database, so a rotated file carries on under its new name, a
+truncated one is read again from the start, and old logs are never re-read,
+also across restarts. Failures are
+classified with one precompiled pattern, run only on the lines holding one
+of its keywords, and counted per install, kind and hour; counts older than
+the retention period are deleted.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime
+from collections import Counter
+from .database import database
+from .emby_config import get_log_dirs
+from .health_scheduler import health_scheduler
+
+LOG_PREFIXES = ('ffmpeg', 'embyserver')  # Transcode logs and the server log
+BUCKET_SECONDS = 3600
+CHUNK_SIZE = 1024 * 1024
+BACKFILL_DAYS = 7  # Logs first seen older than this are skipped instead of read
+RETENTION_DAYS = 30  # Failure counts of older buckets are deleted
+IDLE_FILE_SECONDS = 60  # A last line without a newline counts once its file is this old
+SCAN_INTERVAL = 10  # Seconds between passes in the background
+ARCHITECTURE_FAILURES = ('bad_cpu_type', 'exit_code_8')
+
+# Failure kinds are the names of the alternatives; each alternative contains
+# one of the keywords, which are searched for first since that is far faster
+FAILURE_PATTERN = re.compile(
+    rb'(?P<bad_cpu_type>Bad CPU type in executable)'
+    rb'|(?P<exit_code_8>[Ee]xit(?:ed)?(?: with)? code:? 8\b|Exec format error)'
+    rb'|(?P<missing_library>Library not loaded|error while loading shared libraries|image not found)'
+    rb'|(?P<permission_denied>Permission denied)')
+FAILURE_KEYWORDS = (b'Bad CPU type', b'xit', b'Exec format', b'Library not loaded', b'shared libraries',
+                    b'image not found', b'Permission denied')
+TIMESTAMP_PATTERN = re.compile(rb'(\d{4}-\d{2}-\d{2}[ T]\d{2}):\d{2}:\d{2}')
+
+def get_bucket(timestamp):
+    """Get the start of the time bucket holding a timestamp."""
+    return int(timestamp // BUCKET_SECONDS * BUCKET_SECONDS)
+
+def classify(data, default_bucket):
+    """Find the failures in a block of complete log lines.
+
+    Args:
+        data (bytes): The lines
+        default_bucket (int): Bucket of failures on lines without a timestamp
+
+    Yields:
+        tuple: (kind, bucket, line) for each failure
+    """
+    lines = set()
+    for keyword in FAILURE_KEYWORDS:
+        index = data.find(keyword)
+        while index >= 0:
+            start = data.rfind(b'\n', 0, index) + 1
+            end = data.find(b'\n', index)
+            end = end if end >= 0 else len(data)
+            lines.add((start, end))
+            index = data.find(keyword, end)
+    for start, end in sorted(lines):
+        line = data[start:end]
+        bucket = default_bucket
+        stamp = TIMESTAMP_PATTERN.match(line)
+        if stamp:
+            try:
+                bucket = get_bucket(datetime.strptime(stamp.group(1).decode('ascii').replace('T', ' '),
+                                                      '%Y-%m-%d %H').timestamp())
+            except ValueError:
+                pass
+        for match in FAILURE_PATTERN.finditer(line):
+            yield match.lastgroup, bucket, line
+
+class LogAnalyzer:
+    def __init__(self, interval=SCAN_INTERVAL, retention_days=RETENTION_DAYS):
+        self.interval = interval
+        self.retention_days = retention_days
+        self._pruned_before = None  # Oldest bucket kept by the last pruning
+        self._lock = threading.Lock()  # One pass at a time
+        self._offsets = None  # path -> (inode, offset), loaded from the database on the first pass
+        self._counts = Counter()  # (install path, bucket, kind) -> count, when there is no database
+        self._last_pass = None
+        self._stats = {'passes': 0, 'files_read': 0, 'bytes_read': 0, 'failures': 0}
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _read(self, path, offset, st, install_path, emby_paths, counts):
+        # Only complete lines are consumed, a partial last line is read again next pass
+        default_bucket = get_bucket(st.st_mtime)
+        idle = time.time() - st.st_mtime > IDLE_FILE_SECONDS
+        carry = b''
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                data = carry + chunk
+                if not chunk:
+                    cut = len(data) if idle or len(data) > CHUNK_SIZE else 0
+                else:
+                    cut = data.rfind(b'\n') + 1
+                    if not cut and len(data) > CHUNK_SIZE:
+                        cut = len(data)  # A huge line is classified as it is
+                block, carry = data[:cut], data[cut:]
+                for kind, bucket, line in classify(block, default_bucket):
+                    # A line naming an install is counted for it, others for the install the logs belong to
+                    owner = next((emby_path for emby_path in emby_paths if os.fsencode(emby_path) in line),
+                                 install_path)
+                    counts[(owner, bucket, kind)] += 1
+                offset += len(block)
+                self._stats['bytes_read'] += len(block)
+                if not chunk:
+                    return offset
+
+    def analyze(self, emby_paths):
+        """Read what was appended to the installs' logs since the last pass.
+
+        Args:
+            emby_paths (list): Installs whose logs are read; a log directory shared
+                by several installs is counted for the first one
+
+        Returns:
+            dict: The pass's files read, failures found by kind, and duration
+        """
+        started = time.time()
+        log_dirs = {}
+        for emby_path in emby_paths:
+            for log_dir in get_log_dirs(emby_path):
+                if os.path.isdir(log_dir):
+                    log_dirs.setdefault(os.path.realpath(log_dir), emby_path)
+        backfill_cutoff = started - BACKFILL_DAYS * 86400
+
+        with self._lock:
+            if self._offsets is None:
+                self._offsets = database.get_log_offsets()
+            offsets, counts, seen, files_read = {}, Counter(), set(), 0
+            by_inode = {inode: offset for inode, offset in self._offsets.values()}
+            for log_dir, install_path in log_dirs.items():
+                try:
+                    entries = list(os.scandir(log_dir))
+                except OSError as e:
+                    logging.warning(f"Could not list Emby logs in {log_dir}: {e}")
+                    continue
+                for entry in entries:
+                    if not entry.name.startswith(LOG_PREFIXES) or not entry.is_file():
+                        continue
+                    seen.add(entry.path)
+                    st = entry.stat()
+                    inode, offset = self._offsets.get(entry.path, (None, None))
+                    if inode != st.st_ino and by_inode.get(st.st_ino, st.st_size + 1) <= st.st_size:
+                        # Renamed by log rotation, carry on where its old name left off
+                        inode, offset = st.st_ino, by_inode[st.st_ino]
+                    if inode is None and st.st_mtime < backfill_cutoff:
+                        # Too old to tell anything about the install's current state
+                        offsets[entry.path] = (st.st_ino, st.st_size)
+                        continue
+                    if inode != st.st_ino or st.st_size < offset:
+                        offset = 0  # New, or replaced or truncated
+                    if st.st_size == offset:
+                        continue
+                    try:
+                        offsets[entry.path] = (st.st_ino, self._read(entry.path, offset, st, install_path,
+                                                                     emby_paths, counts))
+                        files_read += 1
+                    except OSError as e:
+                        logging.warning(f"Could not read Emby log {entry.path}: {e}")
+            removed = [path for path in self._offsets
+                       if path not in seen and os.path.dirname(path) in log_dirs]
+            database.save_log_progress(offsets, removed, counts)
+            self._offsets.update(offsets)
+            for path in removed:
+                del self._offsets[path]
+            if not database.enabled:
+                self._counts.update(counts)
+            oldest = get_bucket(started - self.retention_days * 86400)
+            if oldest != self._pruned_before:
+                # Buckets only age by the hour, so pruning once per bucket is enough
+                pruned = database.prune_log_failures(oldest)
+                for key in [key for key in self._counts if key[1] < oldest]:
+                    del self._counts[key]
+                if pruned:
+                    logging.info(f"Deleted {pruned} log failure counts older than {self.retention_days} days")
+                self._pruned_before = oldest
+            self._stats['passes'] += 1
+            self._stats['files_read'] += files_read
+            self._stats['failures'] += sum(counts.values())
+            self._last_pass = started
+
+        broken = {install_path for (install_path, _, kind) in counts if kind in ARCHITECTURE_FAILURES}
+        for install_path in sorted(broken):
+            logging.warning(f"Emby logs show FFMPEG architecture failures for {install_path}")
+            # Inspect the install now rather than on its backed-off schedule
+            health_scheduler.reset(install_path)
+        by_kind = Counter()
+        for (_, _, kind), count in counts.items():
+            by_kind[kind] += count
+        return {'files_read': files_read, 'failures': dict(by_kind), 'broken': sorted(broken),
+                'elapsed': round(time.time() - started, 3)}
+
+    def get_summary(self, hours=24):
+        """Get the failure counts of the last hours per install, with the installs failing now.
+
+        Returns:
+            dict: 'installs' maps each install to its totals by kind and its
+                per-bucket counts; 'broken' lists installs with architecture
+                failures in the current or previous hour
+        """
+        now = time.time()
+        since = get_bucket(now - hours * 3600)
+        if database.enabled:
+            rows = database.get_log_failures(since)
+        else:
+            with self._lock:
+                rows = [{'path': path, 'bucket': bucket, 'kind': kind, 'count': count, 'last_seen': None}
+                        for (path, bucket, kind), count in self._counts.items() if bucket >= since]
+            rows.sort(key=lambda row: (-row['bucket'], row['path'], row['kind']))
+        installs, broken = {}, set()
+        for row in rows:
+            install = installs.setdefault(row['path'], {'totals': Counter(), 'buckets': []})
+            install['totals'][row['kind']] += row['count']
+            install['buckets'].append({key: row[key] for key in ('bucket', 'kind', 'count')})
+            if row['kind'] in ARCHITECTURE_FAILURES and row['bucket'] >= get_bucket(now) - BUCKET_SECONDS:
+                broken.add(row['path'])
+        for install in installs.values():
+            install['totals'] = dict(install['totals'])
+        with self._lock:
+            stats = dict(self._stats)
+            last_pass = self._last_pass
+        return {'hours': hours, 'bucket_seconds': BUCKET_SECONDS, 'installs': installs, 'broken': sorted(broken),
+                'running': self.running, 'last_pass': last_pass, 'stats': stats}
+
+    def start(self, get_installs):
+        """Analyze the logs in the background every interval.
+
+        Args:
+            get_installs (callable): Returns the install paths whose logs are read
+        """
+        if self.running or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, args=(get_installs,), daemon=True, name='log-analyzer')
+        self._thread.start()
+        logging.info(f"Log analyzer started, reading new log lines every {self.interval}s")
+
+    def stop(self):
+        """Stop after the current pass."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self, get_installs):
+        while not self._stop.is_set():
+            try:
+                self.analyze(sorted(get_installs()))
+            except Exception as e:
+                logging.warning(f"Log analysis pass failed: {e}")
+            self._stop.wait(self.interval)
+
+# Create a global instance
+log_analyzer = LogAnalyzer()
@@ -0,0 +1,262 @@
+"""
+Metrics module for Emby FFMPEG Fixer.
+A small in-process registry of counters, gauges and latency histograms,
+exposed at /metrics in the Prometheus text format. Recording a sample is a
+dict lookup and an addition under a lock, so it costs about a microsecond;
+gauges such as queue depths are read from their owners only when scraped.
+With several worker processes, each one publishes its samples to the
+shared store and a scrape adds them up.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+PREFIX = 'emby_fixer_'
+# Seconds, from a cached response to copying a whole bundle
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PUBLISH_INTERVAL = 5  # Seconds between publications of a worker's samples
+STALE_SECONDS = 600  # Samples of a worker not published for this long are dropped
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def collect(self):
+        """Get a copy of the samples, as label values -> value."""
+        with self._lock:
+            return dict(self._values)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        with self._lock:
+            return {key: [list(state[0]), state[1], state[2]] for key, state in self._values.items()}
+
+class CallbackMetric(Metric):
+    """A gauge or counter whose samples are read from their owner when scraped."""
+
+    def __init__(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self._callback = callback
+
+    def collect(self):
+        try:
+            return {tuple(str(value) for value in key): value for key, value in self._callback()}
+        except Exception as e:
+            logging.warning(f"Could not collect metric {self.name}: {e}")
+            return {}
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._store = None
+        self._publisher = None
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing  # Modules imported twice share their metrics
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        """Register samples read from their owner at scrape time.
+
+        Args:
+            callback (callable): Returns (label values tuple, value) pairs
+        """
+        return self._register(CallbackMetric(name, documentation, labelnames, callback, metric_type))
+
+    def snapshot(self):
+        """Get every metric's samples in a JSON-serializable form."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                for metric in metrics}
+
+    def start_publishing(self, store, interval=PUBLISH_INTERVAL):
+        """Publish this process's samples to a shared store, so scrapes of any worker see every worker."""
+        if self._publisher is not None:
+            return
+        self._store = store
+
+        def publish():
+            while True:
+                try:
+                    store.set('metrics', str(os.getpid()), {'at': time.time(), 'samples': self.snapshot()})
+                except Exception as e:
+                    logging.warning(f"Could not publish metrics: {e}")
+                time.sleep(interval)
+
+        self._publisher = threading.Thread(target=publish, daemon=True, name='metrics-publisher')
+        self._publisher.start()
+
+    def _merged(self):
+        # This process's live samples plus the last ones published by the other workers
+        merged = {name: {tuple(key): value for key, value in samples} for name, samples in self.snapshot().items()}
+        if self._store is None:
+            return merged
+        now = time.time()
+        for pid, published in self._store.items('metrics'):
+            if pid == str(os.getpid()):
+                continue
+            if now - published['at'] > STALE_SECONDS:
+                self._store.delete('metrics', pid)
+                continue
+            for name, samples in published['samples'].items():
+                target = merged.setdefault(name, {})
+                for key, value in samples:
+                    key = tuple(key)
+                    current = target.get(key)
+                    if current is None:
+                        target[key] = value
+                    elif isinstance(self._metrics.get(name), Gauge):
+                        target[key] = max(current, value)  # e.g. the last throughput, not a total
+                    elif isinstance(value, list):
+                        # Histograms: add bucket counts, sums and counts
+                        target[key] = [[a + b for a, b in zip(current[0], value[0])],
+                                       current[1] + value[1], current[2] + value[2]]
+                    else:
+                        target[key] = current + value
+        return merged
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        merged = self._merged()
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for key, value in sorted(merged.get(metric.name, {}).items()):
+                if metric.type == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), value[0]):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(
+                            metric.name, _format_labels(metric.labelnames, key, [('le', _format_value(bound))]),
+                            cumulative))
+                    labels = _format_labels(metric.labelnames, key)
+                    lines.append('{}_sum{} {}'.format(metric.name, labels, _format_value(value[1])))
+                    lines.append('{}_count{} {}'.format(metric.name, labels, value[2]))
+                else:
+                    lines.append('{}{} {}'.format(metric.name, _format_labels(metric.labelnames, key),
+                                                  _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+# Create a global instance
+metrics = Registry()
+
+# Metrics recorded by several modules
+HTTP_REQUESTS = metrics.counter('http_requests_total', 'HTTP requests by route, method and status',
+                                ('route', 'method', 'status'))
+HTTP_REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'Time to build each response, by route',
+                                         ('route', 'method'))
+JOURNAL_OPERATIONS = metrics.counter('journal_operations_total', 'Journaled operations by kind and outcome',
+                                     ('kind', 'outcome'))
+JOURNAL_OPERATION_SECONDS = metrics.histogram('journal_operation_duration_seconds',
+                                              'Duration of journaled operations (fix, restore, test mode)', ('kind',))
+JOURNAL_STEP_SECONDS = metrics.histogram('journal_step_duration_seconds', 'Duration of each journaled step',
+                                         ('kind', 'phase', 'action'))
+BACKUP_SECONDS = metrics.histogram('backup_duration_seconds', 'Duration of full install backups')
+COPIED_BYTES = metrics.counter('copied_bytes_total', 'Bytes copied, by what copied them', ('action',))
+COPY_SECONDS = metrics.counter('copy_seconds_total', 'Seconds spent copying, by what copied them; '
+                               'copied bytes over these seconds is the copy throughput', ('action',))
+COPY_THROUGHPUT = metrics.gauge('copy_throughput_bytes_per_second', 'Throughput of the last copy, by what copied it',
+                                ('action',))
+SUBPROCESSES = metrics.counter('subprocess_invocations_total', 'Subprocesses started, by command and outcome',
+                               ('command', 'outcome'))
+SUBPROCESS_SECONDS = metrics.histogram('subprocess_duration_seconds', 'Duration of subprocesses, by command',
+                                       ('command',))
+CACHE_REQUESTS = metrics.counter('cache_requests_total', 'Cache lookups by cache and result (hit or miss)',
+                                 ('cache', 'result'))
+LOCK_WAIT_SECONDS = metrics.histogram('lock_wait_seconds', 'Time spent waiting for named locks', ('lock',))
+
+def record_copy(action, size, seconds):
+    """Record a copy's bytes and duration."""
+    COPIED_BYTES.inc(size, action=action)
+    COPY_SECONDS.inc(seconds, action=action)
+    if seconds > 0:
+        COPY_THROUGHPUT.set(size / seconds, action=action)
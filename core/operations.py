@@ -0,0 +1,266 @@
+"""
+Operations module for Emby FFMPEG Fixer.
+Fix, restore and test-mode operations on an install, planned as journaled
+steps: files are replaced atomically through a temporary copy and whole
+bundles through a staging directory that is swapped in by rename, so an
+interrupted operation never leaves a half-written install behind. Fixes
+are verified against the replacements' hashes and cached as recipes.
+"""
+import os
+import logging
+from datetime import datetime
+from .journal import journal, step
+from .fix_recipes import fix_recipes
+from .fix_staging import fix_staging
+from .emby_processes import emby_process_monitor
+from .utils import (
+    FFMPEG_BINARIES,
+    find_ffmpeg_binaries,
+    get_emby_version,
+    get_external_ffmpeg,
+    get_resource_path,
+    get_system_architecture,
+    is_inside_install
+)
+
+BACKUP_VERSION_FILE = 'emby_version'  # Emby Server version a backup of the originals was taken from
+
+def _present(directory, binaries=FFMPEG_BINARIES):
+    return [binary for binary in binaries if os.path.exists(os.path.join(directory, binary))]
+
+def _backup_version(backup_dir):
+    try:
+        with open(os.path.join(backup_dir, BACKUP_VERSION_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _is_stale_backup(emby_path, backup_dir):
+    # A backup from before an in-place update holds the previous version's binaries;
+    # one without a recorded version (or of an install without one) cannot be told apart
+    version, backed_up = get_emby_version(emby_path), _backup_version(backup_dir)
+    return bool(version and backed_up and version != backed_up)
+
+def _backup_steps(emby_path, ffmpeg_dir, backup_dir, link=False):
+    # An existing backup holds the original binaries and is kept, unless it is from another Emby version
+    version = get_emby_version(emby_path)
+    backed_up = _present(backup_dir)
+    stale = bool(backed_up) and _is_stale_backup(emby_path, backup_dir)
+    if stale:
+        logging.info(f"Replacing the FFMPEG backup in {backup_dir}, it is from Emby {_backup_version(backup_dir)}")
+    present = _present(ffmpeg_dir)
+    if link:
+        # Hard links: the binaries are about to be replaced by rename, not overwritten
+        copies = [step('link_file', src=os.path.join(ffmpeg_dir, binary), dst=os.path.join(backup_dir, binary),
+                       keep_existing=not stale) for binary in present]
+    else:
+        copies = [step('copy_file', src=os.path.join(ffmpeg_dir, binary), dst=os.path.join(backup_dir, binary),
+                       mode=0o755, keep_existing=not stale) for binary in present]
+    steps = [step('make_dir', path=backup_dir)] + copies
+    if stale:
+        steps += [step('remove_file', path=os.path.join(backup_dir, binary))
+                  for binary in backed_up if binary not in present]
+    if version and (stale or not backed_up):
+        steps.append(step('write_file', path=os.path.join(backup_dir, BACKUP_VERSION_FILE), content=version))
+    return steps
+
+def _install_steps(source_dir, ffmpeg_dir, binaries, missing_ok=False):
+    return [step('copy_file', src=os.path.join(source_dir, binary), dst=os.path.join(ffmpeg_dir, binary),
+                 mode=0o755, missing_ok=missing_ok)
+            for binary in binaries]
+
+def _find_ffmpeg(emby_path, confirm_external=False):
+    # Prefer the binary a running Emby Server is executing over the guessed location
+    ffmpeg_path = emby_process_monitor.get_running_ffmpeg_path(emby_path) or find_ffmpeg_binaries(emby_path)
+    if ffmpeg_path and not is_inside_install(ffmpeg_path, emby_path):
+        if not confirm_external:
+            raise ValueError("Emby Server is configured to use the FFMPEG at {}, outside the install; "
+                             "it is only modified when confirm_external is set".format(ffmpeg_path))
+        # Replace the file a symlink points to, so the link itself stays in place
+        ffmpeg_path = os.path.realpath(ffmpeg_path)
+    return ffmpeg_path
+
+def _get_dirs(ffmpeg_path):
+    ffmpeg_dir = os.path.dirname(ffmpeg_path)
+    return (ffmpeg_dir, os.path.join(ffmpeg_dir, "ffmpeg_backup_original"),
+            os.path.join(ffmpeg_dir, "ffmpeg_test_mode"))
+
+def _apply_recipe(emby_path, recipe):
+    ffmpeg_dir = os.path.join(emby_path, recipe['ffmpeg_dir'])
+    backup_dir = os.path.join(ffmpeg_dir, "ffmpeg_backup_original")
+    replacement_dir = get_resource_path(recipe['replacement_dir'])
+    binaries = recipe['binaries']
+    # The copies are verified before the test marker goes, a mismatch rolls the swap back
+    journal.run(
+        'fix', emby_path,
+        _backup_steps(emby_path, ffmpeg_dir, backup_dir) +
+        _install_steps(replacement_dir, ffmpeg_dir, binaries) +
+        [step('check_file', path=os.path.join(ffmpeg_dir, binary), sha256=recipe['replacements'][binary]['sha256'])
+         for binary in binaries] +
+        [step('remove_file', path=os.path.join(ffmpeg_dir, "ffmpeg_test_mode"))],
+        undo=_install_steps(backup_dir, ffmpeg_dir, binaries, missing_ok=True))
+    logging.info("Replaced FFMPEG binaries with {} versions in {}".format(recipe['system_architecture'], ffmpeg_dir))
+    return {"success": True,
+            "message": "FFMPEG binaries replaced with {} versions".format(recipe['system_architecture'])}
+
+def _apply_staged(emby_path, recipe, staging_dir):
+    ffmpeg_dir = os.path.join(emby_path, recipe['ffmpeg_dir'])
+    backup_dir = os.path.join(ffmpeg_dir, "ffmpeg_backup_original")
+    binaries = recipe['binaries']
+    # The staged copies were verified when staged, so the swap is only renames:
+    # the originals are backed up as hard links and the copies moved over them
+    journal.run(
+        'fix', emby_path,
+        _backup_steps(emby_path, ffmpeg_dir, backup_dir, link=True) +
+        [step('rename_file', src=os.path.join(staging_dir, binary), dst=os.path.join(ffmpeg_dir, binary))
+         for binary in binaries] +
+        [step('remove_file', path=os.path.join(ffmpeg_dir, "ffmpeg_test_mode"))],
+        undo=_install_steps(backup_dir, ffmpeg_dir, binaries, missing_ok=True))
+    logging.info("Swapped in staged {} FFMPEG binaries in {}".format(recipe['system_architecture'], ffmpeg_dir))
+    return {"success": True,
+            "message": "FFMPEG binaries replaced with {} versions".format(recipe['system_architecture'])}
+
+def fix_ffmpeg_compatibility(emby_path, backup=None, confirm_external=False):
+    """Replace the install's FFMPEG binaries with ones built for this system.
+
+    Replacements staged in the background are swapped in by rename. Else a
+    known Emby version is fixed from its cached recipe without looking for
+    FFMPEG; otherwise the fix is detected and its recipe cached.
+
+    Args:
+        emby_path (str): The install to fix
+        backup (callable, optional): Backs the install up before a fix that has
+            to be detected, returning a result dict that stops the fix if it
+            failed. Staged and recipe fixes skip it, their journal keeps the originals
+        confirm_external (bool): Also modify a custom FFMPEG configured outside the install
+    """
+    try:
+        system_arch = get_system_architecture()
+        # Staged copies and recipes fix the bundled binaries, not a custom FFMPEG Emby runs instead
+        external = get_external_ffmpeg(emby_path)
+        staged = None if external else fix_staging.take(emby_path, system_arch)
+        if staged:
+            try:
+                result = _apply_staged(emby_path, *staged)
+                fix_recipes.save(staged[0])
+                return result
+            except Exception as e:
+                logging.warning(f"Swapping in staged replacements failed ({e}), copying them instead")
+            finally:
+                # The staged copies are used up either way
+                fix_staging.request()
+        recipe = None if external else fix_recipes.get(emby_path, system_arch)
+        if recipe:
+            try:
+                result = _apply_recipe(emby_path, recipe)
+                fix_recipes.record_use(recipe)
+                return result
+            except Exception as e:
+                logging.warning(f"Fix from cached recipe failed ({e}), detecting the fix again")
+                fix_recipes.forget(recipe)
+
+        ffmpeg_path = _find_ffmpeg(emby_path, confirm_external)
+        if ffmpeg_path and backup is not None:
+            backup_result = backup()
+            if not backup_result["success"]:
+                return backup_result
+
+        if not ffmpeg_path:
+            return {"success": False, "message": "FFMPEG binaries not found in Emby Server"}
+        ffmpeg_dir = os.path.dirname(ffmpeg_path)
+
+        replacement_dir = os.path.join('ffmpeg_binaries', system_arch)
+        binaries = _present(ffmpeg_dir)
+        missing = [binary for binary in binaries
+                   if not os.path.exists(os.path.join(get_resource_path(replacement_dir), binary))]
+        if missing:
+            return {"success": False,
+                    "message": "No replacement {} found for {}".format(', '.join(missing), system_arch)}
+
+        recipe = fix_recipes.build(emby_path, ffmpeg_dir, binaries, system_arch, replacement_dir)
+        result = _apply_recipe(emby_path, recipe)
+        fix_recipes.save(recipe)
+        return result
+    except Exception as e:
+        logging.error(f"Error fixing FFMPEG compatibility: {e}")
+        return {"success": False, "message": "Error fixing FFMPEG compatibility: {}".format(str(e))}
+
+def restore_original_ffmpeg(emby_path, confirm_external=False):
+    """Restore the original FFMPEG binaries from backup and leave test mode.
+
+    Returns:
+        tuple: (success, message)
+    """
+    try:
+        ffmpeg_path = _find_ffmpeg(emby_path, confirm_external)
+        if not ffmpeg_path:
+            return False, "FFMPEG binaries not found"
+        ffmpeg_dir, backup_dir, test_marker = _get_dirs(ffmpeg_path)
+
+        binaries = _present(backup_dir)
+        if not binaries:
+            return False, "No backup found to restore"
+        if _is_stale_backup(emby_path, backup_dir):
+            # It would put the previous version's binaries back into the updated install
+            return False, "The backup is from Emby Server {}, not the installed {}".format(
+                _backup_version(backup_dir), get_emby_version(emby_path))
+
+        # Restoring only ever rolls forward, the backup is left in place
+        journal.run(
+            'restore', emby_path,
+            _install_steps(backup_dir, ffmpeg_dir, binaries) + [step('remove_file', path=test_marker)])
+        return True, "Successfully restored original FFMPEG binaries"
+    except Exception as e:
+        logging.error(f"Error restoring FFMPEG: {e}")
+        return False, str(e)
+
+def enter_test_mode(emby_path, target_arch, confirm_external=False):
+    """Install single-architecture test binaries to simulate an incompatible FFMPEG.
+
+    Returns:
+        str: Message starting with 'Success:' or 'Error:'
+    """
+    try:
+        ffmpeg_path = _find_ffmpeg(emby_path, confirm_external)
+        if not ffmpeg_path:
+            return "Error: FFMPEG binaries not found in Emby Server"
+        ffmpeg_dir, backup_dir, test_marker = _get_dirs(ffmpeg_path)
+
+        test_resources = get_resource_path(os.path.join('test_resources', target_arch))
+        binaries = _present(ffmpeg_dir)
+        missing = [binary for binary in binaries if not os.path.exists(os.path.join(test_resources, binary))]
+        if missing:
+            return "Error: Test binaries {} not found in {}".format(', '.join(missing), test_resources)
+
+        journal.run(
+            'test-mode', emby_path,
+            _backup_steps(emby_path, ffmpeg_dir, backup_dir) +
+            _install_steps(test_resources, ffmpeg_dir, binaries) +
+            [step('write_file', path=test_marker,
+                  content="Architecture: {}\nTimestamp: {}".format(target_arch, datetime.now()))],
+            undo=_install_steps(backup_dir, ffmpeg_dir, binaries, missing_ok=True) +
+                 [step('remove_file', path=test_marker)])
+        return "Success: Test binaries installed. Emby Server should now show compatibility issues."
+    except Exception as e:
+        logging.error(f"Error setting up test mode: {e}")
+        return "Error setting up test environment: {}".format(str(e))
+
+def restore_from_backup(backup_dir, emby_path):
+    """Restore Emby Server from a full bundle backup.
+
+    The backup is copied to a staging directory next to the install and
+    swapped in by rename, so the install is never left half-copied.
+    """
+    try:
+        emby_path = emby_path.rstrip(os.sep)
+        staging = emby_path + '.journal-staging'
+        old = emby_path + '.journal-old'
+        journal.run(
+            'restore-bundle', emby_path,
+            [step('copy_tree', src=backup_dir, dst=staging),
+             step('swap_dir', staging=staging, target=emby_path, old=old),
+             step('remove_tree', path=old)],
+            undo=[step('unswap_dir', staging=staging, target=emby_path, old=old)])
+        return {"success": True}
+    except Exception as e:
+        return {"success": False, "message": str(e)}
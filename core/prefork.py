@@ -0,0 +1,83 @@
+"""
+Pre-fork server module for Emby FFMPEG Fixer.
+Binds the listening socket once, then forks worker processes that all accept
+on it, restarting any worker that dies until the supervisor is stopped.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+
+RESTART_DELAY = 1  # Seconds to wait before restarting a crashed worker
+
+def create_listen_socket(host, port, backlog=1024):
+    """Create a bound, listening TCP socket with SO_REUSEADDR set."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def run_prefork(serve_worker, workers):
+    """Fork worker processes running serve_worker() and supervise them.
+
+    Must be called before any threads are started, since only the calling
+    thread survives fork().
+
+    Args:
+        serve_worker (callable): Serves requests in a worker until it exits
+        workers (int): Number of worker processes to keep running
+    """
+    children = {}
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            # Worker: default signal handling, serve, never return to the supervisor
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                serve_worker()
+            except Exception as e:
+                logging.error(f"Worker {os.getpid()} failed: {e}", exc_info=True)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = slot
+        logging.info(f"Started worker {slot} with pid {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if slot is None:
+            continue
+        if not stopping:
+            logging.warning(f"Worker {slot} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(RESTART_DELAY)
+            spawn(slot)
+    logging.info("All workers stopped")
+    sys.exit(0)
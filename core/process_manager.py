@@ -2,10 +2,24 @@
 Process management module for Emby FFMPEG Fixer.
 Handles all subprocess creation, monitoring, and termination.
 """
+import os
+import time
+import signal
 import subprocess
 import logging
 import threading
 from datetime import datetime
+from .metrics import SUBPROCESSES
+from .shared_store import shared_store
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
 
 class ProcessManager:
     def __init__(self):
@@ -13,6 +27,15 @@ class ProcessManager:
         self._is_running = False
         self._lock = threading.Lock()
 
+    def _get_shared_job(self):
+        """Get the job started by another worker process, if it is still alive."""
+        if not shared_store.enabled:
+            return None
+        job = shared_store.get('jobs', 'current')
+        if job and job['worker'] != os.getpid() and _pid_alive(job['pid']):
+            return job
+        return None
+
     @property
     def is_running(self):
         """Check if a process is running."""
@@ -22,25 +45,43 @@ class ProcessManager:
                 if self._current_process.poll() is not None:
                     self._is_running = False
                     self._current_process = None
-            return self._is_running
+            return self._is_running or self._get_shared_job() is not None
 
     def run_process(self, cmd, shell=False):
         """Run a subprocess and track it."""
         with self._lock:
-            if self._is_running:
+            if self._is_running or self._get_shared_job():
                 return None  # Don't start a new process if one is running
             
+            command = os.path.basename(cmd.split()[0] if isinstance(cmd, str) else cmd[0])
             try:
                 self._current_process = subprocess.Popen(cmd, shell=shell)
                 self._is_running = True
-                return_code = self._current_process.wait()
-                self._current_process = None
-                self._is_running = False
-                return return_code
+                SUBPROCESSES.inc(command=command, outcome='started')
             except Exception as e:
+                SUBPROCESSES.inc(command=command, outcome='error')
                 self._current_process = None
                 self._is_running = False
                 raise e
+            process = self._current_process
+            if shared_store.enabled:
+                shared_store.set('jobs', 'current', {
+                    'pid': process.pid,
+                    'worker': os.getpid(),
+                    'cmd': cmd if isinstance(cmd, str) else ' '.join(cmd),
+                    'started': datetime.now().isoformat()
+                })
+
+        # Wait outside the lock so state queries and stop requests are not blocked
+        try:
+            return process.wait()
+        finally:
+            with self._lock:
+                if self._current_process is process:
+                    self._current_process = None
+                    self._is_running = False
+                if shared_store.enabled:
+                    shared_store.delete('jobs', 'current')
 
     def stop_process(self):
         """Stop the current process if any."""
@@ -59,12 +100,29 @@ class ProcessManager:
                         self._current_process = None
                         self._is_running = False
                         logging.info("Process state cleared")
+                else:
+                    job = self._get_shared_job()
+                    if job:
+                        self._stop_shared_job(job)
                 return True
             except Exception as e:
                 logging.error(f"Error stopping process: {e}")
                 self._is_running = False
                 return False
 
+    def _stop_shared_job(self, job):
+        """Stop a process started by another worker process."""
+        logging.info(f"Attempting to stop process {job['pid']} started by worker {job['worker']}...")
+        os.kill(job['pid'], signal.SIGTERM)
+        deadline = time.monotonic() + 5
+        while _pid_alive(job['pid']) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if _pid_alive(job['pid']):
+            logging.warning("Process did not terminate, forcing kill")
+            os.kill(job['pid'], signal.SIGKILL)
+        shared_store.delete('jobs', 'current')
+        logging.info("Process state cleared")
+
     def get_state(self):
         """Get the current process state."""
         with self._lock:
@@ -78,9 +136,11 @@ class ProcessManager:
                     # Process is still running
                     self._is_running = True
             
+            shared_job = self._get_shared_job()
             state = {
-                "is_running": self._is_running,
-                "process": self._current_process
+                "is_running": self._is_running or shared_job is not None,
+                "process": self._current_process,
+                "job": shared_job
             }
             logging.debug(f"Current process state: {state}")
             return state
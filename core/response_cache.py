@@ -0,0 +1,162 @@
+"""
+Response cache module for Emby FFMPEG Fixer.
+Caches status endpoint responses per endpoint and install, with strong ETags
+and invalidation driven by filesystem changes and our own fix/restore operations.
+With several worker processes, entries and invalidations go through the shared store.
+"""
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from .metrics import CACHE_REQUESTS
+from .shared_store import shared_store
+from .utils import get_install_watch_paths, stat_manifest
+from .discovery import discovery
+
+class CachedResponse:
+    def __init__(self, body, status, etag, manifest, generation, created=None):
+        self.body = body
+        self.status = status
+        self.etag = etag
+        self.manifest = manifest
+        self.generation = generation
+        self.created = created or time.time()
+
+    def to_dict(self):
+        return {
+            'body': self.body.decode('utf-8'),
+            'status': self.status,
+            'etag': self.etag,
+            'manifest': self.manifest,
+            'generation': self.generation,
+            'created': self.created
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['body'].encode('utf-8'), data['status'], data['etag'],
+                   data['manifest'], data['generation'], data['created'])
+
+class ResponseCache:
+    def __init__(self, max_entries=256, max_age=300):
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._max_entries = max_entries
+        self._max_age = max_age  # Safety net for bundles with non-standard layouts
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get_manifest(self, emby_path):
+        """Get the current filesystem fingerprint for an install (or the search roots)."""
+        if emby_path is None:
+            return stat_manifest(discovery.get_watch_paths())
+        return stat_manifest(get_install_watch_paths(emby_path))
+
+    def _get_generation(self, emby_path):
+        # Entries are valid only for the generation they were computed in;
+        # invalidate() bumps the per-install or global counter
+        if shared_store.enabled:
+            return [shared_store.get('cache_generation', '*', 0),
+                    shared_store.get('cache_generation', emby_path or '', 0)]
+        return [self._generations.get('*', 0), self._generations.get(emby_path or '', 0)]
+
+    def _is_fresh(self, entry, manifest, generation):
+        return entry is not None and entry.manifest == manifest and entry.generation == generation and \
+            time.time() - entry.created < self._max_age
+
+    def get_or_compute(self, endpoint, emby_path, compute, variant=None, extra_paths=None):
+        """Return a cached response, recomputing it if the install changed.
+
+        Args:
+            endpoint (str): Name of the endpoint being cached
+            emby_path (str): Install the response describes, or None for global responses
+            compute (callable): Returns (payload, status) when the cache misses
+            variant (hashable, optional): Extra key component for request-dependent answers
+            extra_paths (list, optional): Additional paths the response depends on
+
+        Returns:
+            CachedResponse: The cached or freshly computed response
+        """
+        key = (endpoint, emby_path, variant)
+        paths_manifest = self.get_manifest(emby_path)
+        if extra_paths:
+            paths_manifest += stat_manifest(extra_paths)
+        manifest = hashlib.sha1(repr(paths_manifest).encode('utf-8')).hexdigest()
+        generation = self._get_generation(emby_path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._is_fresh(entry, manifest, generation):
+                self._entries.move_to_end(key)
+                self._hits += 1
+                CACHE_REQUESTS.inc(cache='response', result='hit')
+                return entry
+
+        if shared_store.enabled:
+            # Another worker may already have computed it
+            data = shared_store.get('response_cache', repr(key))
+            entry = CachedResponse.from_dict(data) if data else None
+            if self._is_fresh(entry, manifest, generation):
+                with self._lock:
+                    self._store_local(key, entry)
+                    self._hits += 1
+                CACHE_REQUESTS.inc(cache='response', result='hit')
+                return entry
+
+        with self._lock:
+            self._misses += 1
+        CACHE_REQUESTS.inc(cache='response', result='miss')
+
+        payload, status = compute()
+        body = json.dumps(payload, sort_keys=True).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        entry = CachedResponse(body, status, etag, manifest, generation)
+
+        # Server errors are transient, never serve them from the cache
+        if status < 500 and self._get_generation(emby_path) == generation:
+            with self._lock:
+                self._store_local(key, entry)
+            if shared_store.enabled:
+                shared_store.set('response_cache', repr(key), entry.to_dict())
+                if shared_store.count('response_cache') > self._max_entries:
+                    shared_store.prune('response_cache', self._max_entries)
+        return entry
+
+    def _store_local(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, emby_path=None):
+        """Drop cached responses for an install, or for everything if no path is given."""
+        # The server list (keyed without an install) depends on which installs exist,
+        # so it goes stale along with any install
+        generation_keys = ['*'] if emby_path is None else [emby_path, '']
+        with self._lock:
+            for generation_key in generation_keys:
+                self._generations[generation_key] = self._generations.get(generation_key, 0) + 1
+            if emby_path is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[1] in (emby_path, None)]:
+                    del self._entries[key]
+        if shared_store.enabled:
+            for generation_key in generation_keys:
+                shared_store.increment('cache_generation', generation_key)
+        logging.info("Response cache invalidated for {}".format(emby_path or 'all installs'))
+
+    def get_stats(self):
+        """Get cache hit/miss statistics."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses
+            }
+
+# Create a global instance
+response_cache = ResponseCache()
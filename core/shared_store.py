@@ -0,0 +1,213 @@
+"""
+Shared store module for Emby FFMPEG Fixer.
+Keeps application state, job metadata and caches in a local SQLite database
+(WAL mode) guarded by file locks, so every worker process of a multi-process
+server sees the same state. When the store is not opened, state stays in
+process memory and locks are plain thread locks.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from .metrics import LOCK_WAIT_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock, fall back to in-process locks
+    fcntl = None
+
+def connect_sqlite(path, synchronous='NORMAL'):
+    """Open a SQLite connection in WAL mode with autocommit and a statement cache."""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False,
+                           cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous={}'.format(synchronous))
+    return conn
+
+class SharedStore:
+    def __init__(self):
+        self._path = None
+        self._lock_dir = None
+        self._local = threading.local()
+        self._thread_locks = {}  # name -> [lock, holders and waiters]
+        self._thread_locks_lock = threading.Lock()
+        self._thread_semaphores = {}
+
+    @property
+    def enabled(self):
+        """Whether state is shared through the database."""
+        return self._path is not None
+
+    def open(self, path):
+        """Open (creating if needed) the shared database at the given path."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._lock_dir = os.path.join(os.path.dirname(path), 'locks')
+        os.makedirs(self._lock_dir, exist_ok=True)
+        conn = self._connection()
+        conn.execute('''CREATE TABLE IF NOT EXISTS kv (
+                            namespace TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            value TEXT NOT NULL,
+                            updated REAL NOT NULL,
+                            PRIMARY KEY (namespace, key)
+                        ) WITHOUT ROWID''')
+        conn.commit()
+        logging.info(f"Shared store opened at {path}")
+
+    def _connection(self):
+        # SQLite connections must not cross threads or survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self._path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key, default=None):
+        """Get a JSON value from the store."""
+        row = self._connection().execute(
+            'SELECT value FROM kv WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace, key, value):
+        """Set a JSON value in the store."""
+        self._connection().execute(
+            'INSERT OR REPLACE INTO kv (namespace, key, value, updated) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), time.time()))
+
+    def increment(self, namespace, key):
+        """Atomically increment an integer value, returning the new value."""
+        conn = self._connection()
+        with self._transaction(conn):
+            value = self.get(namespace, key, 0) + 1
+            self.set(namespace, key, value)
+        return value
+
+    def update(self, namespace, key, update, default=None):
+        """Atomically replace a JSON value, across worker processes.
+
+        Args:
+            update (callable): Called with the current value (or default),
+                returns (new value, result)
+
+        Returns:
+            The result returned by update
+        """
+        conn = self._connection()
+        with self._transaction(conn):
+            value, result = update(self.get(namespace, key, default))
+            self.set(namespace, key, value)
+        return result
+
+    def delete(self, namespace, key=None):
+        """Delete one key, or a whole namespace if no key is given."""
+        if key is None:
+            self._connection().execute('DELETE FROM kv WHERE namespace = ?', (namespace,))
+        else:
+            self._connection().execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def count(self, namespace):
+        """Count the keys in a namespace."""
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM kv WHERE namespace = ?', (namespace,)).fetchone()[0]
+
+    def items(self, namespace):
+        """Get the (key, value) pairs of a namespace."""
+        rows = self._connection().execute(
+            'SELECT key, value FROM kv WHERE namespace = ? ORDER BY key', (namespace,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def prune(self, namespace, keep):
+        """Delete all but the most recently updated keys of a namespace."""
+        self._connection().execute(
+            '''DELETE FROM kv WHERE namespace = ? AND key NOT IN (
+                   SELECT key FROM kv WHERE namespace = ? ORDER BY updated DESC LIMIT ?)''',
+            (namespace, namespace, keep))
+
+    def expire(self, namespace, max_age):
+        """Delete the keys of a namespace not updated for max_age seconds."""
+        self._connection().execute('DELETE FROM kv WHERE namespace = ? AND updated < ?',
+                                   (namespace, time.time() - max_age))
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _lock_file_path(self, name):
+        # Keep lock file names readable but unique for arbitrary install paths
+        safe_name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)[:64]
+        safe_name += '-' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+        return os.path.join(self._lock_dir, safe_name + '.lock')
+
+    @contextmanager
+    def semaphore(self, name, count, poll_interval=0.1):
+        """Hold one of count slots of a named semaphore, across threads and, when shared, worker processes."""
+        started = time.perf_counter()
+        with self._thread_locks_lock:
+            thread_slots = self._thread_semaphores.setdefault(name, threading.BoundedSemaphore(count))
+        with thread_slots:
+            if not self.enabled or fcntl is None:
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=name.split('-')[0])
+                yield
+                return
+            # One lock file per slot; a process that dies releases its slot with its file
+            while True:
+                for index in range(count):
+                    with open(self._lock_file_path('{}-{}'.format(name, index)), 'a') as lock_file:
+                        try:
+                            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=name.split('-')[0])
+                        try:
+                            yield
+                        finally:
+                            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                        return
+                time.sleep(poll_interval)
+
+    @contextmanager
+    def _thread_lock(self, name):
+        # Dropped once nobody holds or waits for it, names include install paths
+        with self._thread_locks_lock:
+            entry = self._thread_locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._thread_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._thread_locks[name]
+
+    @contextmanager
+    def lock(self, name):
+        """Hold a named lock across threads and, when shared, across worker processes."""
+        started = time.perf_counter()
+        with self._thread_lock(name):
+            if not self.enabled or fcntl is None:
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=name.split('-')[0])
+                yield
+                return
+            with open(self._lock_file_path(name), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=name.split('-')[0])
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# Create a global instance
+shared_store = SharedStore()
@@ -6,10 +6,42 @@ import os
 import sys
 import platform
 import shutil
+import hashlib
+import ipaddress
 import logging
+import plistlib
+import functools
 import subprocess
+from time import perf_counter
 from datetime import datetime
-import glob
+from .emby_config import emby_config, get_config_dirs, CONFIG_FILE
+from .metrics import BACKUP_SECONDS, CACHE_REQUESTS, SUBPROCESSES, SUBPROCESS_SECONDS, record_copy
+
+# Directories, relative to an install, that may hold the FFMPEG binaries
+APP_BUNDLE_FFMPEG_DIRS = [
+    os.path.join('Contents', 'MacOS'),
+    os.path.join('Contents', 'Resources'),
+    os.path.join('Contents', 'Frameworks'),
+    os.path.join('Contents', 'MacOS', 'Emby Server'),
+    os.path.join('Contents', 'Resources', 'Emby Server'),
+    os.path.join('Contents', 'Frameworks', 'Emby Server')
+]
+INSTALL_FFMPEG_DIRS = ['bin', 'system', 'ffmpeg', os.path.join('system', 'ffmpeg'), '']
+
+# Binaries an install's FFMPEG directory may hold, all replaced together
+FFMPEG_BINARIES = ('ffmpeg', 'ffprobe', 'ffdetect')
+
+# Last FFMPEG binary found in each install
+_ffmpeg_path_cache = {}
+
+# Architecture probes keyed by the binary's stat info, so a replaced binary is probed again
+_ffmpeg_architecture_cache = {}
+FFMPEG_ARCHITECTURE_CACHE_SIZE = 256
+
+# Emby versions keyed by Info.plist path, with the plist's (mtime_ns, size)
+_emby_version_cache = {}
+
+HASH_CHUNK_SIZE = 1024 * 1024
 
 def setup_logging():
     """Configure logging for the application"""
@@ -52,23 +84,7 @@ def get_system_architecture(target_system=None):
         # When checking from a remote system, we need to get the architecture
         # of the system where Emby Server is installed
         try:
-            # Use system_profiler to get the architecture of the remote system
-            result = subprocess.run(['system_profiler', 'SPHardwareDataType'], 
-                                 capture_output=True, text=True)
-            output = result.stdout.lower()
-            
-            if 'chip' in output and 'apple' in output:
-                return 'arm64'
-            elif 'intel' in output:
-                return 'x86_64'
-            else:
-                # Fallback to platform.machine()
-                arch = platform.machine()
-                if arch == 'x86_64':
-                    return 'x86_64'
-                elif arch == 'arm64':
-                    return 'arm64'
-                return arch
+            return _get_hardware_architecture()
         except Exception as e:
             logging.error("Error getting remote system architecture: {}".format(e))
             # Fallback to platform.machine()
@@ -77,6 +93,48 @@ def get_system_architecture(target_system=None):
         # For local system check
         return platform.machine()
 
+def run_command(cmd, **kwargs):
+    """Run a command with subprocess.run, counting it and timing it by the command's name."""
+    command = os.path.basename(cmd[0])
+    started = perf_counter()
+    try:
+        result = subprocess.run(cmd, **kwargs)
+    except subprocess.CalledProcessError:
+        SUBPROCESSES.inc(command=command, outcome='failed')
+        raise
+    except Exception:
+        SUBPROCESSES.inc(command=command, outcome='error')
+        raise
+    finally:
+        SUBPROCESS_SECONDS.observe(perf_counter() - started, command=command)
+    SUBPROCESSES.inc(command=command, outcome='ok' if result.returncode == 0 else 'failed')
+    return result
+
+@functools.lru_cache(maxsize=None)
+def _get_hardware_architecture():
+    """Get the host's hardware architecture from system_profiler.
+
+    system_profiler takes seconds and the hardware cannot change while we run,
+    so the answer is computed once.
+    """
+    # Use system_profiler to get the architecture of the remote system
+    result = run_command(['system_profiler', 'SPHardwareDataType'], 
+                         capture_output=True, text=True)
+    output = result.stdout.lower()
+    
+    if 'chip' in output and 'apple' in output:
+        return 'arm64'
+    elif 'intel' in output:
+        return 'x86_64'
+    else:
+        # Fallback to platform.machine()
+        arch = platform.machine()
+        if arch == 'x86_64':
+            return 'x86_64'
+        elif arch == 'arm64':
+            return 'arm64'
+        return arch
+
 def get_default_emby_path():
     """Get the default Emby Server installation path."""
     if platform.system() == 'Darwin':  # macOS
@@ -84,11 +142,31 @@ def get_default_emby_path():
             "/Applications/EmbyServer.app",
             "/Applications/Emby Server.app"
         ]
-        for path in default_paths:
-            if os.path.exists(path):
-                return path
+    elif platform.system() == 'Windows':
+        default_paths = [
+            os.path.join(os.environ.get('APPDATA', ''), 'Emby-Server'),
+            "C:\\Program Files\\Emby Server"
+        ]
+    else:  # Linux packages
+        default_paths = [
+            "/opt/emby-server",
+            "/usr/lib/emby-server"
+        ]
+    for path in default_paths:
+        if os.path.exists(path):
+            return path
     return None
 
+def get_ffmpeg_dirs(emby_path):
+    """Get the directories of an install that may hold its FFMPEG binaries."""
+    if emby_path.endswith('.app'):
+        return [os.path.join(emby_path, subdir) for subdir in APP_BUNDLE_FFMPEG_DIRS]
+    return [os.path.join(emby_path, subdir) if subdir else emby_path for subdir in INSTALL_FFMPEG_DIRS]
+
+def get_ffmpeg_name():
+    """Get the file name of the FFMPEG binary on this platform."""
+    return 'ffmpeg.exe' if platform.system() == 'Windows' else 'ffmpeg'
+
 def get_resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
     try:
@@ -99,6 +177,23 @@ def get_resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
+def get_data_dir():
+    """Get the per-user directory for the fixer's databases and runtime files.
+
+    Can be overridden with the EMBY_FIXER_DATA_DIR environment variable.
+    """
+    data_dir = os.environ.get('EMBY_FIXER_DATA_DIR')
+    if not data_dir:
+        if platform.system() == 'Darwin':
+            data_dir = os.path.expanduser('~/Library/Application Support/EmbyFFMPEGFixer')
+        elif platform.system() == 'Windows':
+            data_dir = os.path.join(os.environ.get('APPDATA', os.path.expanduser('~')), 'EmbyFFMPEGFixer')
+        else:
+            data_dir = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
+                                    'emby-ffmpeg-fixer')
+    os.makedirs(data_dir, exist_ok=True)
+    return data_dir
+
 def find_ffmpeg_binaries(emby_path):
     """Find FFMPEG binaries in the Emby Server application"""
     try:
@@ -106,53 +201,92 @@ def find_ffmpeg_binaries(emby_path):
             logging.error("No Emby Server path provided")
             return None
             
+        # A custom ffmpeg configured in Emby Server is the one it runs
+        custom_path = emby_config.get_custom_ffmpeg_paths(emby_path)[0]
+        if custom_path and os.access(custom_path, os.X_OK):
+            logging.debug(f"Using FFMPEG configured in Emby Server: {custom_path}")
+            return custom_path
+
+        # The last location found is checked first, which avoids searching on every lookup
+        cached_path = _ffmpeg_path_cache.get(emby_path)
+        if cached_path and os.path.isfile(cached_path) and os.access(cached_path, os.X_OK):
+            return cached_path
+
         logging.info("Searching for FFMPEG in Emby Server at: {}".format(emby_path))
         
-        # For macOS, check in the app bundle
-        if emby_path.endswith('.app'):
-            # Define possible locations for FFMPEG
-            possible_paths = [
-                os.path.join(emby_path, 'Contents', 'MacOS', 'ffmpeg'),
-                os.path.join(emby_path, 'Contents', 'Resources', 'ffmpeg'),
-                os.path.join(emby_path, 'Contents', 'Frameworks', 'ffmpeg'),
-                os.path.join(emby_path, 'Contents', 'MacOS', 'Emby Server', 'ffmpeg'),
-                os.path.join(emby_path, 'Contents', 'Resources', 'Emby Server', 'ffmpeg'),
-                os.path.join(emby_path, 'Contents', 'Frameworks', 'Emby Server', 'ffmpeg')
-            ]
-            
-            # Log the paths we're checking
-            logging.info("Checking for FFMPEG in standard locations:")
-            for path in possible_paths:
-                logging.info("Checking: {}".format(path))
-                if os.path.exists(path):
-                    if os.access(path, os.X_OK):
-                        logging.info(f"Found executable FFMPEG at: {path}")
-                        return path
-                    else:
-                        logging.warning(f"Found FFMPEG at {path} but it's not executable")
-                        
-            # If not found in standard locations, search the entire app bundle
-            logging.info("FFMPEG not found in standard locations, searching entire app bundle...")
-            for root, dirs, files in os.walk(emby_path):
-                if 'ffmpeg' in files:
-                    ffmpeg_path = os.path.join(root, 'ffmpeg')
-                    if os.access(ffmpeg_path, os.X_OK):
-                        logging.info(f"Found executable FFMPEG at: {ffmpeg_path}")
-                        return ffmpeg_path
-                    else:
-                        logging.warning(f"Found FFMPEG at {ffmpeg_path} but it's not executable")
-                        
-            logging.error(f"FFMPEG not found in Emby Server application bundle: {emby_path}")
-            return None
-            
-        logging.error("Unsupported Emby Server path format")
+        # macOS app bundles and Linux/Windows install directories have different layouts
+        ffmpeg_name = get_ffmpeg_name()
+        possible_paths = [os.path.join(ffmpeg_dir, ffmpeg_name) for ffmpeg_dir in get_ffmpeg_dirs(emby_path)]
+        
+        # Log the paths we're checking
+        logging.info("Checking for FFMPEG in standard locations:")
+        for path in possible_paths:
+            logging.info("Checking: {}".format(path))
+            if os.path.isfile(path):
+                if os.access(path, os.X_OK):
+                    logging.info(f"Found executable FFMPEG at: {path}")
+                    _ffmpeg_path_cache[emby_path] = path
+                    return path
+                else:
+                    logging.warning(f"Found FFMPEG at {path} but it's not executable")
+                    
+        # If not found in standard locations, search the entire install
+        logging.info("FFMPEG not found in standard locations, searching entire install...")
+        for root, dirs, files in os.walk(emby_path):
+            if ffmpeg_name in files:
+                ffmpeg_path = os.path.join(root, ffmpeg_name)
+                if os.access(ffmpeg_path, os.X_OK):
+                    logging.info(f"Found executable FFMPEG at: {ffmpeg_path}")
+                    _ffmpeg_path_cache[emby_path] = ffmpeg_path
+                    return ffmpeg_path
+                else:
+                    logging.warning(f"Found FFMPEG at {ffmpeg_path} but it's not executable")
+                    
+        logging.error(f"FFMPEG not found in Emby Server install: {emby_path}")
         return None
     except Exception as e:
         logging.error(f"Error finding FFMPEG binaries: {str(e)}")
         return None
 
+def is_inside_install(path, emby_path):
+    """Whether a path, with symlinks resolved, lies inside an install."""
+    install = os.path.realpath(emby_path)
+    return os.path.commonpath([os.path.realpath(path), install]) == install
+
+def get_external_ffmpeg(emby_path):
+    """Get the custom FFMPEG Emby Server is configured to run, if it lies outside the install.
+
+    Such a binary may be shared with other installs or programs, e.g.
+    /usr/local/bin/ffmpeg, so it is inspected but only modified when confirmed.
+    """
+    custom_path = emby_config.get_custom_ffmpeg_paths(emby_path)[0]
+    if custom_path and not is_inside_install(custom_path, emby_path):
+        return custom_path
+    return None
+
 def get_ffmpeg_architecture(ffmpeg_path):
-    """Get the architecture of FFMPEG binary."""
+    """Get the architecture of FFMPEG binary.
+
+    Probing runs external commands, so results are reused until the binary changes.
+    """
+    try:
+        st = os.stat(ffmpeg_path)
+    except OSError:
+        logging.error(f"FFMPEG binary not found at: {ffmpeg_path}")
+        return None
+    key = (ffmpeg_path, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    arch = _ffmpeg_architecture_cache.get(key)
+    CACHE_REQUESTS.inc(cache='ffmpeg_architecture', result='miss' if arch is None else 'hit')
+    if arch is None:
+        arch = _probe_ffmpeg_architecture(ffmpeg_path)
+        if arch is not None:
+            if len(_ffmpeg_architecture_cache) >= FFMPEG_ARCHITECTURE_CACHE_SIZE:
+                _ffmpeg_architecture_cache.clear()
+            _ffmpeg_architecture_cache[key] = arch
+    return arch
+
+def _probe_ffmpeg_architecture(ffmpeg_path):
+    """Determine the architecture of an FFMPEG binary with file, lipo or ffmpeg -version."""
     try:
         if not os.path.exists(ffmpeg_path):
             logging.error(f"FFMPEG binary not found at: {ffmpeg_path}")
@@ -160,7 +294,7 @@ def get_ffmpeg_architecture(ffmpeg_path):
 
         if platform.system() == 'Darwin':  # macOS
             # Use file command to check architecture
-            result = subprocess.run(['file', ffmpeg_path], capture_output=True, text=True)
+            result = run_command(['file', ffmpeg_path], capture_output=True, text=True)
             output = result.stdout.lower()
             
             logging.info(f"File command output: {output}")
@@ -172,7 +306,7 @@ def get_ffmpeg_architecture(ffmpeg_path):
             
             # If architecture not found in file output, try lipo
             try:
-                result = subprocess.run(['lipo', '-info', ffmpeg_path], capture_output=True, text=True)
+                result = run_command(['lipo', '-info', ffmpeg_path], capture_output=True, text=True)
                 output = result.stdout.lower()
                 logging.info(f"Lipo command output: {output}")
                 
@@ -185,7 +319,7 @@ def get_ffmpeg_architecture(ffmpeg_path):
         
         # Fallback to running ffmpeg -version
         try:
-            result = subprocess.run([ffmpeg_path, '-version'], capture_output=True, text=True)
+            result = run_command([ffmpeg_path, '-version'], capture_output=True, text=True)
             output = result.stdout.lower()
             logging.info(f"FFMPEG version output: {output}")
             
@@ -240,7 +374,7 @@ def force_single_architecture(ffmpeg_path, target_arch):
     try:
         if platform.system() == 'Darwin':
             cmd = ['lipo', '-thin', target_arch, ffmpeg_path, '-output', f"{ffmpeg_path}.tmp"]
-            subprocess.run(cmd, check=True)
+            run_command(cmd, check=True)
             os.replace(f"{ffmpeg_path}.tmp", ffmpeg_path)
             return True
         return False
@@ -253,21 +387,17 @@ def create_backup(emby_path):
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         backup_dir = os.path.join(os.path.dirname(emby_path), f"emby_backup_{timestamp}")
-        shutil.copytree(emby_path, backup_dir)
+        started = perf_counter()
+        copied = []
+        shutil.copytree(emby_path, backup_dir,
+                        copy_function=lambda src, dst: copied.append(os.path.getsize(src)) or shutil.copy2(src, dst))
+        elapsed = perf_counter() - started
+        BACKUP_SECONDS.observe(elapsed)
+        record_copy('backup', sum(copied), elapsed)
         return {"success": True, "backup_dir": backup_dir}
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-def restore_from_backup(backup_dir, emby_path):
-    """Restore Emby Server from backup."""
-    try:
-        if os.path.exists(emby_path):
-            shutil.rmtree(emby_path)
-        shutil.copytree(backup_dir, emby_path)
-        return {"success": True}
-    except Exception as e:
-        return {"success": False, "message": str(e)}
-
 def force_architecture_incompatibility(ffmpeg_path):
     """Force FFMPEG to use incompatible architecture."""
     try:
@@ -306,25 +436,111 @@ def restore_initial_state(emby_path):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-def find_emby_servers():
-    """Scan the Applications directory for Emby Server installations."""
-    if platform.system() != 'Darwin':
-        return []
-    
-    # Search patterns for Emby Server
-    patterns = [
-        "/Applications/*[Ee]mby*[Ss]erver*.app",
-        "/Applications/Emby*.app"
-    ]
-    
-    found_servers = set()
-    for pattern in patterns:
-        matches = glob.glob(pattern)
-        for match in matches:
-            if os.path.isdir(match):
-                found_servers.add(match)
-    
-    return sorted(list(found_servers))
+def is_test_mode_active(ffmpeg_path):
+    """Check if test mode is currently active"""
+    try:
+        test_marker = os.path.join(os.path.dirname(ffmpeg_path), "ffmpeg_test_mode")
+        return os.path.exists(test_marker)
+    except Exception:
+        return False
+
+def get_test_mode_info(ffmpeg_path):
+    """Get information about the current test mode"""
+    try:
+        test_marker = os.path.join(os.path.dirname(ffmpeg_path), "ffmpeg_test_mode")
+        if os.path.exists(test_marker):
+            with open(test_marker, 'r') as f:
+                return f.read().strip()
+        return None
+    except Exception:
+        return None
+
+def get_emby_version(emby_path):
+    """Get an install's Emby Server version from its Info.plist, if it has one."""
+    plist_path = os.path.join(emby_path, 'Contents', 'Info.plist')
+    try:
+        st = os.stat(plist_path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _emby_version_cache.get(plist_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    try:
+        with open(plist_path, 'rb') as f:
+            info = plistlib.load(f)
+        version = info.get('CFBundleShortVersionString') or info.get('CFBundleVersion')
+    except Exception as e:
+        logging.warning(f"Could not read {plist_path}: {e}")
+        version = None
+    _emby_version_cache[plist_path] = (key, version)
+    return version
+
+def hash_file(path):
+    """Get the SHA-256 of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_install_watch_paths(emby_path):
+    """Get the paths whose metadata changes whenever an install's FFMPEG state changes.
+
+    Covers the bundle itself, the standard FFMPEG directories, the binaries in
+    them and the backup directory and test marker stored next to the binaries,
+    the encoding.xml files that may configure a custom FFMPEG and, for a custom
+    FFMPEG outside the install, the same paths next to it.
+    """
+    paths = [emby_path, os.path.join(emby_path, 'Contents')]
+    ffmpeg_dirs = list(get_ffmpeg_dirs(emby_path))
+    external_ffmpeg = get_external_ffmpeg(emby_path)
+    if external_ffmpeg:
+        # Fixes of a symlinked binary change the file it points to
+        ffmpeg_dirs += sorted({os.path.dirname(external_ffmpeg),
+                               os.path.dirname(os.path.realpath(external_ffmpeg))})
+    for ffmpeg_dir in ffmpeg_dirs:
+        paths.extend([
+            ffmpeg_dir,
+            os.path.join(ffmpeg_dir, get_ffmpeg_name()),
+            os.path.join(ffmpeg_dir, 'ffmpeg_backup_original'),
+            os.path.join(ffmpeg_dir, 'ffmpeg_test_mode')
+        ])
+    if external_ffmpeg:
+        paths.append(external_ffmpeg)
+    paths.extend(os.path.join(config_dir, CONFIG_FILE) for config_dir in get_config_dirs(emby_path))
+    return paths
+
+def stat_manifest(paths):
+    """Build a cheap change-detection fingerprint from the stat info of the given paths.
+
+    Directory mtimes change when entries are added, removed or renamed, and
+    ctimes change when a file is rewritten in place (copy2 preserves mtime).
+    """
+    manifest = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            manifest.append((path, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns))
+        except OSError:
+            manifest.append((path, None))
+    return tuple(manifest)
+
+def is_remote_address(address):
+    """Whether a client address is remote, i.e. not a loopback address.
+
+    127.0.0.0/8, ::1 and IPv4-mapped loopback addresses are local, as are
+    clients without an address (e.g. on a Unix socket).
+    """
+    if not address or address == 'localhost':
+        return False
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return True
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+    return not ip.is_loopback
 
 def check_ffmpeg_compatibility(emby_path, is_remote_access=False):
     """Check if FFMPEG is compatible with the system.
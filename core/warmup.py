@@ -0,0 +1,84 @@
+"""
+Warm-up module for Emby FFMPEG Fixer.
+Runs install discovery and inspection in a background thread pool right
+after startup, so the caches are filled before the first page load.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Warmup:
+    def __init__(self, max_workers=4):
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._total = 0
+        self._completed = 0
+        self._failed = 0
+        self._running = set()
+        self._started = None
+        self._finished = None
+
+    def start(self, tasks):
+        """Run warm-up tasks in the background.
+
+        Args:
+            tasks (list): (name, callable) pairs. A callable may return more
+                (name, callable) pairs, which are run as follow-up tasks.
+        """
+        with self._lock:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='warmup')
+            self._started = time.time()
+            self._finished = None
+            self._submit(tasks)
+
+    def _submit(self, tasks):
+        # Called with the lock held
+        for name, func in tasks:
+            self._total += 1
+            self._executor.submit(self._run, name, func)
+
+    def _run(self, name, func):
+        with self._lock:
+            self._running.add(name)
+        started = time.time()
+        follow_ups, failed = None, False
+        try:
+            follow_ups = func()
+            logging.debug("Warm-up task {} finished in {:.2f}s".format(name, time.time() - started))
+        except Exception as e:
+            failed = True
+            logging.warning(f"Warm-up task {name} failed: {e}")
+        with self._lock:
+            self._running.discard(name)
+            self._completed += 1
+            self._failed += failed
+            if follow_ups:
+                self._submit(follow_ups)
+            if self._completed == self._total:
+                self._finished = time.time()
+                self._executor.shutdown(wait=False)
+                logging.info("Warm-up finished: {} tasks in {:.2f}s".format(
+                    self._total, self._finished - self._started))
+
+    def get_progress(self):
+        """Get warm-up progress for the health endpoint."""
+        with self._lock:
+            if self._started is None:
+                state = 'idle'
+            elif self._finished is None:
+                state = 'running'
+            else:
+                state = 'done'
+            return {
+                'state': state,
+                'completed': self._completed,
+                'total': self._total,
+                'failed': self._failed,
+                'running': sorted(self._running),
+                'elapsed': round((self._finished or time.time()) - self._started, 3) if self._started else 0
+            }
+
+# Create a global instance
+warmup = Warmup()
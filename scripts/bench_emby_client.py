@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Emby client against local stand-in servers.
+
+Queries the transcoding state of every stand-in a few times and reports the
+time per round and the TCP connections each server accepted, which should
+stay at one per server after the first round.
+
+Usage: python scripts/bench_emby_client.py [--servers 100] [--rounds 3]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.emby_client import EmbyClients
+from core.emby_standin import EmbyStandIn
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Emby client')
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    standins = [EmbyStandIn(api_key='bench').start() for _ in range(args.servers)]
+    clients = EmbyClients()
+    servers = [(standin.url, 'bench') for standin in standins]
+    try:
+        for round_number in range(1, args.rounds + 1):
+            for standin in standins:
+                clients.get_client(standin.url, 'bench').invalidate()
+            started = time.perf_counter()
+            states = clients.fetch_transcoding_states(servers)
+            elapsed = time.perf_counter() - started
+            errors = sum(1 for state in states.values() if 'error' in state)
+            print("Round {}: {} servers in {:.1f} ms, {} errors".format(
+                round_number, len(states), elapsed * 1000, errors))
+        requests = sum(standin.requests for standin in standins)
+        connections = sum(standin.connections for standin in standins)
+        print("{} requests over {} connections ({:.2f} connections per server)".format(
+            requests, connections, connections / len(standins)))
+        return 0 if connections == len(standins) else 1
+    finally:
+        clients.close()
+        for standin in standins:
+            standin.stop()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,6 +30,18 @@ document.addEventListener('DOMContentLoaded', function() {
     let isProcessing = false;
 
     let serverList;
+    let detectedServers = null;
+
+    // Directory picker state
+    const directoryBrowser = document.getElementById('directory-browser');
+    const directoryEntries = document.getElementById('directory-entries');
+    const directoryCurrent = document.getElementById('directory-current');
+    const directoryFilter = document.getElementById('directory-filter');
+    const directoryMoreButton = document.getElementById('directory-more');
+    let directoryPath = '';
+    let directoryParent = null;
+    let directoryNextOffset = null;
+    let directoryFilterTimer = null;
 
     // Add log monitoring state
     let lastLogTimestamp = null;
@@ -239,33 +251,51 @@ document.addEventListener('DOMContentLoaded', function() {
             fixButton.classList.remove('pulsating');
         }
         
-        // If there's a pre-populated path, trigger the path selection
-        if (embyPathInput && embyPathInput.value) {
-            selectedEmbyPath = embyPathInput.value;
-            updateSelectedPath(embyPathInput.value);
-            addLogEntry(`Selected Emby Server path: ${embyPathInput.value}`, 'complete');
-        } else {
-            // Try to get default path from server
-            fetch('/api/get-default-path')
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success && data.path) {
-                        selectedEmbyPath = data.path;
-                        embyPathInput.value = data.path;
-                        updateSelectedPath(data.path);
-                        addLogEntry(`Found default Emby Server path: ${data.path}`, 'complete');
-                    }
-                })
-                .catch(error => {
-                    console.error('Error getting default path:', error);
-                });
-        }
-
         serverList = document.createElement('select');
         serverList.id = 'server-list';
         serverList.className = 'server-list';
         serverList.style.display = 'none';
         embyPathInput.parentNode.insertBefore(serverList, embyPathInput.nextSibling);
+
+        // Load default path, server list and the install's status in a single request
+        const prefilledPath = embyPathInput && embyPathInput.value ? embyPathInput.value : '';
+        if (prefilledPath) {
+            selectedEmbyPath = prefilledPath;
+            updateSelectedPath(prefilledPath);
+            addLogEntry(`Selected Emby Server path: ${prefilledPath}`, 'complete');
+        }
+
+        const params = new URLSearchParams();
+        if (prefilledPath) params.set('path', prefilledPath);
+        fetch(`/api/install-status?${params.toString()}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message || 'Failed to load install status');
+                }
+
+                if (!prefilledPath && data.path) {
+                    selectedEmbyPath = data.path;
+                    embyPathInput.value = data.path;
+                    updateSelectedPath(data.path);
+                    addLogEntry(`Found default Emby Server path: ${data.path}`, 'complete');
+                }
+
+                detectedServers = data.servers || null;
+
+                if (data.path && data.compatibility && data.compatibility.success) {
+                    renderCompatibility(data.compatibility);
+                }
+                if (data.path && data.backup) {
+                    renderBackupStatus(data.backup);
+                }
+                if (data.process_state) {
+                    updateAppState({ processRunning: data.process_state.is_processing });
+                }
+            })
+            .catch(error => {
+                console.error('Error loading install status:', error);
+            });
     }
 
     // Functions
@@ -351,25 +381,13 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(data => {
             if (data.success) {
-                // Update architecture information
-                document.getElementById('system-architecture').textContent = data.system_architecture || 'Unknown';
-                document.getElementById('ffmpeg-architecture').textContent = data.ffmpeg_architecture || 'Unknown';
-                document.getElementById('compatibility-status').textContent = data.is_compatible ? 'Compatible ✅' : 'Incompatible ❌';
+                renderCompatibility(data);
                 
                 // Update progress and log
                 updateProgress('check-compatibility', 100, 'complete');
                 addLogEntry(`System Architecture: ${data.system_architecture}`, 'info', true);
                 addLogEntry(`FFMPEG Architecture: ${data.ffmpeg_architecture}`, 'info', true);
                 addLogEntry(`Compatibility Status: ${data.is_compatible ? 'Compatible' : 'Incompatible'}`, data.is_compatible ? 'success' : 'error', true);
-                
-                // Update button states based on compatibility
-                isCompatible = data.is_compatible;
-                updateButtonStatesAfterCheck(data.is_compatible);
-                
-                // Show fix section if incompatible
-                if (!data.is_compatible) {
-                    document.getElementById('fix-section').classList.remove('hidden');
-                }
             } else {
                 throw new Error(data.message || 'Failed to check compatibility');
             }
@@ -388,6 +406,23 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    function renderCompatibility(data) {
+        // Update architecture information
+        document.getElementById('system-architecture').textContent = data.system_architecture || 'Unknown';
+        document.getElementById('ffmpeg-architecture').textContent = data.ffmpeg_architecture || 'Unknown';
+        document.getElementById('compatibility-status').textContent = data.is_compatible ? 'Compatible ✅' : 'Incompatible ❌';
+        document.getElementById('compatibility-results').classList.remove('hidden');
+        
+        // Update button states based on compatibility
+        isCompatible = data.is_compatible;
+        updateButtonStatesAfterCheck(data.is_compatible);
+        
+        // Show fix section if incompatible
+        if (!data.is_compatible) {
+            document.getElementById('fix-section').classList.remove('hidden');
+        }
+    }
+
     function fixFFMPEG() {
         if (!selectedEmbyPath) {
             alert('Please select Emby Server path first');
@@ -456,29 +491,14 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => response.json())
         .then(data => {
+            renderBackupStatus(data);
             if (data.success) {
-                if (data.has_backup) {
-                    backupStatusElement.textContent = '✅ Original FFMPEG backup found';
-                    backupStatusElement.className = 'status-message success';
-                    restoreButton.classList.remove('hidden');
-                    addLogEntry('Original FFMPEG backup found');
-                } else {
-                    backupStatusElement.textContent = 'ℹ️ No original FFMPEG backup found';
-                    backupStatusElement.className = 'status-message info';
-                    restoreButton.classList.add('hidden');
-                    addLogEntry('No original FFMPEG backup found');
-                }
-                
+                addLogEntry(data.has_backup ? 'Original FFMPEG backup found' : 'No original FFMPEG backup found');
                 addLogEntry('Checking for FFMPEG backup...', 'complete');
             } else {
-                backupStatusElement.textContent = '❌ ' + data.message;
-                backupStatusElement.className = 'status-message error';
-                restoreButton.classList.add('hidden');
                 addLogEntry('Checking for FFMPEG backup...', 'error');
                 addLogEntry(data.message, 'error');
             }
-            
-            backupStatusElement.classList.remove('hidden');
         })
         .catch(error => {
             console.error('Error:', error);
@@ -490,6 +510,26 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    function renderBackupStatus(data) {
+        if (data.success) {
+            if (data.has_backup) {
+                backupStatusElement.textContent = '✅ Original FFMPEG backup found';
+                backupStatusElement.className = 'status-message success';
+                restoreButton.classList.remove('hidden');
+            } else {
+                backupStatusElement.textContent = 'ℹ️ No original FFMPEG backup found';
+                backupStatusElement.className = 'status-message info';
+                restoreButton.classList.add('hidden');
+            }
+        } else {
+            backupStatusElement.textContent = '❌ ' + data.message;
+            backupStatusElement.className = 'status-message error';
+            restoreButton.classList.add('hidden');
+        }
+        
+        backupStatusElement.classList.remove('hidden');
+    }
+
     function restoreFFMPEG() {
         if (!selectedEmbyPath) {
             alert('Please select Emby Server path first');
@@ -786,9 +826,11 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Event listeners
     browseButton.addEventListener('click', function() {
-        // First try to get list of servers
-        fetch('/api/list-emby-servers')
-            .then(response => response.json())
+        // First try to get list of servers, reusing the one loaded with the page
+        const serversRequest = detectedServers
+            ? Promise.resolve({ success: true, servers: detectedServers })
+            : fetch('/api/list-emby-servers').then(response => response.json());
+        serversRequest
             .then(data => {
                 if (data.success && data.servers && data.servers.length > 0) {
                     // Clear and populate server list
@@ -797,22 +839,14 @@ document.addEventListener('DOMContentLoaded', function() {
                     data.servers.forEach(server => {
                         serverList.appendChild(new Option(server, server));
                     });
+                    serverList.appendChild(new Option('Browse folders...', '__browse__'));
                     
                     // Show server list
                     serverList.style.display = 'block';
                     serverList.focus();
                 } else {
-                    // If no servers found, fall back to file dialog
-                    fetch('/api/browse-emby')
-                        .then(response => response.json())
-                        .then(data => {
-                            if (data.success && data.path) {
-                                embyPathInput.value = data.path;
-                            } else {
-                                console.error('Error selecting path:', data.message);
-                            }
-                        })
-                        .catch(error => console.error('Error browsing:', error));
+                    // If no servers found, fall back to the directory picker
+                    openDirectoryBrowser('');
                 }
             })
             .catch(error => console.error('Error listing servers:', error));
@@ -820,12 +854,80 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Handle server selection
     serverList.addEventListener('change', function() {
-        if (this.value) {
+        if (this.value === '__browse__') {
+            this.style.display = 'none';
+            openDirectoryBrowser('');
+        } else if (this.value) {
             embyPathInput.value = this.value;
             this.style.display = 'none';
         }
     });
 
+    // Directory picker, listing one page at a time from the server
+    function openDirectoryBrowser(path) {
+        directoryPath = path;
+        directoryFilter.value = '';
+        directoryBrowser.classList.remove('hidden');
+        loadDirectoryPage(0);
+    }
+
+    function loadDirectoryPage(offset) {
+        const params = new URLSearchParams({ offset: offset, limit: 200 });
+        if (directoryPath) params.set('path', directoryPath);
+        if (directoryFilter.value) params.set('filter', directoryFilter.value);
+        fetch(`/api/browse-emby?${params.toString()}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    addLogEntry(`Error browsing: ${data.message}`, 'error');
+                    return;
+                }
+                directoryPath = data.path;
+                directoryParent = data.parent;
+                directoryNextOffset = data.next_offset;
+                directoryCurrent.textContent = data.path;
+                // Highlights the current directory when it is an install itself
+                directoryCurrent.classList.toggle('emby-bundle', data.is_emby);
+                if (offset === 0) directoryEntries.innerHTML = '';
+                data.entries.forEach(entry => {
+                    const item = document.createElement('li');
+                    item.textContent = entry.name;
+                    item.title = entry.path;
+                    if (entry.is_emby) {
+                        // Emby installs are selected, everything else is opened
+                        item.className = 'emby-bundle';
+                        item.addEventListener('click', () => {
+                            embyPathInput.value = entry.path;
+                            directoryBrowser.classList.add('hidden');
+                        });
+                    } else {
+                        item.addEventListener('click', () => openDirectoryBrowser(entry.path));
+                    }
+                    directoryEntries.appendChild(item);
+                });
+                directoryMoreButton.classList.toggle('hidden', directoryNextOffset === null);
+            })
+            .catch(error => console.error('Error browsing:', error));
+    }
+
+    document.getElementById('directory-up').addEventListener('click', () => {
+        if (directoryParent) openDirectoryBrowser(directoryParent);
+    });
+    document.getElementById('directory-select').addEventListener('click', () => {
+        // Any directory can be picked, e.g. an install the layout check does not recognise
+        if (!directoryPath) return;
+        embyPathInput.value = directoryPath;
+        directoryBrowser.classList.add('hidden');
+    });
+    document.getElementById('directory-close').addEventListener('click', () => {
+        directoryBrowser.classList.add('hidden');
+    });
+    directoryMoreButton.addEventListener('click', () => loadDirectoryPage(directoryNextOffset));
+    directoryFilter.addEventListener('input', () => {
+        clearTimeout(directoryFilterTimer);
+        directoryFilterTimer = setTimeout(() => loadDirectoryPage(0), 200);
+    });
+
     usePathButton.addEventListener('click', function() {
         const path = embyPathInput.value.trim();
         if (!path) {
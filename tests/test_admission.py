@@ -0,0 +1,94 @@
+import os
+import pickle
+import app as fixer_app
+from core import batch
+from core.admission import AdmissionController, admission_controller
+from core.shared_store import SharedStore
+
+def in_flight(endpoint):
+    return admission_controller.get_stats()[endpoint]['in_flight']
+
+def test_streamed_batch_holds_its_slot_until_sent(monkeypatch):
+    seen = []
+
+    def check_install(emby_path):
+        seen.append(in_flight('batch'))
+        return {'success': True}
+
+    monkeypatch.setattr(batch, 'check_install', check_install)
+    client = fixer_app.app.test_client()
+    # One at a time, so the later targets run while the body is streamed
+    response = client.post('/api/batch/check', json={'paths': ['/a', '/b', '/c'], 'parallelism': 1},
+                           buffered=False)
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert in_flight('batch') == 1
+    response.close()
+    assert len(lines) == 4  # One result per target and the summary
+    assert seen == [1, 1, 1]
+    assert in_flight('batch') == 0
+
+def test_plain_response_releases_its_slot():
+    client = fixer_app.app.test_client()
+    response = client.post('/api/batch/check', json={})
+    assert response.status_code == 400
+    assert in_flight('batch') == 0
+
+def test_inventory_export_holds_its_slot_until_sent(monkeypatch):
+    seen = []
+
+    def export(since_token=None, fmt='ndjson'):
+        def chunks():
+            for index in range(3):
+                seen.append(in_flight('inventory'))
+                yield '{}\n'.format(index)
+        return '7', chunks()
+
+    monkeypatch.setattr(fixer_app.inventory, 'export', export)
+    client = fixer_app.app.test_client()
+    response = client.get('/api/inventory', buffered=False)
+    assert response.headers['X-Inventory-Token'] == '7'
+    assert response.get_data(as_text=True) == '0\n1\n2\n'
+    response.close()
+    assert seen == [1, 1, 1]
+    assert in_flight('inventory') == 0
+
+def run_in_worker(func):
+    """Run func in a forked process, as another worker, returning its result."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            os.write(write_end, pickle.dumps(func()))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as result:
+        data = result.read()
+    os.waitpid(pid, 0)
+    return pickle.loads(data)
+
+def test_limits_hold_across_workers(tmp_path):
+    store = SharedStore()
+    store.open(str(tmp_path / 'shared_state.db'))
+    controller = AdmissionController({
+        'fix': {'max_concurrent': 1, 'max_queue': 0, 'queue_timeout': 1, 'rate': 100, 'burst': 100},
+        'status': {'max_concurrent': 8, 'max_queue': 0, 'queue_timeout': 1, 'rate': 0.001, 'burst': 1},
+    }, store)
+
+    def acquire(endpoint, client_id):
+        admission = controller.try_acquire(endpoint, client_id)
+        return admission.granted, admission.reason
+
+    admission = controller.try_acquire('fix', 'a')
+    assert admission.granted
+    assert run_in_worker(lambda: acquire('fix', 'b')) == (False, 'queue_full')
+    admission.release()
+    # A worker that dies holding a slot gives it back
+    assert run_in_worker(lambda: acquire('fix', 'b')) == (True, None)
+    assert controller.get_stats()['fix']['in_flight'] == 0
+    assert acquire('fix', 'a') == (True, None)
+
+    assert acquire('status', 'c') == (True, None)
+    assert run_in_worker(lambda: acquire('status', 'c')) == (False, 'rate_limited')
@@ -0,0 +1,105 @@
+import socket
+import time
+import threading
+import http.client
+import pytest
+import app as fixer_app
+from core import async_server
+from core.async_server import AsyncServer
+from core.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS
+from core.response_cache import response_cache
+from core.utils import is_remote_address
+
+ROUTE = '/api/install-status'
+
+@pytest.fixture(scope='module')
+def server():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    instance = AsyncServer(fixer_app.app, '127.0.0.1', sock.getsockname()[1])
+    threading.Thread(target=instance.serve_forever, args=(sock,), daemon=True).start()
+    yield instance
+
+def get(server, path, headers=None):
+    conn = http.client.HTTPConnection(server.host, server.port, timeout=10)
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+def requests_counted(status):
+    return HTTP_REQUESTS.collect().get((ROUTE, 'GET', str(status)), 0)
+
+def test_locality_matches_for_ipv4_and_ipv6():
+    for address in ('127.0.0.1', '127.0.1.1', '::1', '::ffff:127.0.0.1', 'localhost', None, ''):
+        assert not is_remote_address(address)
+    for address in ('192.168.1.20', '::ffff:192.168.1.20', 'fe80::1%en0', 'example.com'):
+        assert is_remote_address(address)
+
+def test_install_status_records_request_metrics(server, monkeypatch):
+    calls = []
+
+    def collect_install_status(emby_path, fields, is_remote_access):
+        calls.append(is_remote_access)
+        return {'success': True, 'fields': list(fields)}
+
+    monkeypatch.setattr(async_server, 'collect_install_status', collect_install_status)
+    response_cache.invalidate('/metrics-test')
+    timed = HTTP_REQUEST_SECONDS.collect().get((ROUTE, 'GET'), [None, 0, 0])[2]
+    ok, not_modified, bad = requests_counted(200), requests_counted(304), requests_counted(400)
+
+    response = get(server, ROUTE + '?path=/metrics-test&fields=process_state')
+    assert response.status == 200
+    etag = response.getheader('ETag')
+    assert get(server, ROUTE + '?path=/metrics-test&fields=process_state&wait=1',
+               {'If-None-Match': etag}).status == 304
+    assert get(server, ROUTE + '?fields=nonsense').status == 400
+
+    assert calls == [False]  # A loopback client is local, as in the Flask route
+    assert requests_counted(200) == ok + 1
+    assert requests_counted(304) == not_modified + 1
+    assert requests_counted(400) == bad + 1
+    samples = HTTP_REQUEST_SECONDS.collect()[(ROUTE, 'GET')]
+    assert samples[2] == timed + 3
+
+def test_long_polls_share_one_status_poll(server, monkeypatch):
+    status = {'version': 1}
+    polls = []
+    get_install_status = server._get_install_status
+
+    async def counting_get_install_status(*args):
+        polls.append(args)
+        return await get_install_status(*args)
+
+    monkeypatch.setattr(async_server, 'collect_install_status',
+                        lambda emby_path, fields, is_remote_access: dict(status, success=True))
+    monkeypatch.setattr(async_server, 'STATUS_POLL_INTERVAL', 0.1)
+    monkeypatch.setattr(server, '_get_install_status', counting_get_install_status)
+    response_cache.invalidate('/long-poll-test')
+    path = ROUTE + '?path=/long-poll-test&fields=process_state'
+    etag = get(server, path).getheader('ETag')
+
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(
+        get(server, path + '&wait=5', {'If-None-Match': etag}))) for _ in range(5)]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.6)
+    status['version'] = 2
+    response_cache.invalidate('/long-poll-test')
+    for waiter in waiters:
+        waiter.join()
+
+    assert [response.status for response in results] == [200] * 5
+    assert all(response.getheader('ETag') != etag for response in results)
+    # One lookup per request, then one per poll interval for all of them
+    assert len(polls) <= 1 + 5 + 10
+
+def test_invalid_content_length_is_rejected(server):
+    for length in ('abc', '-5'):
+        with socket.create_connection((server.host, server.port), timeout=5) as sock:
+            sock.sendall('POST /api/fix-ffmpeg HTTP/1.1\r\nHost: x\r\nContent-Length: {}\r\n\r\n'.format(
+                length).encode('latin-1'))
+            assert sock.recv(1024).startswith(b'HTTP/1.1 400')
@@ -0,0 +1,23 @@
+import time
+import app as fixer_app
+from core.shared_store import SharedStore
+
+def test_status_routes_report_the_worker_running_the_services(monkeypatch, tmp_path):
+    store = SharedStore()
+    store.open(str(tmp_path / 'shared_state.db'))
+    monkeypatch.setattr(fixer_app, 'shared_store', store)
+    client = fixer_app.app.test_client()
+    assert client.get('/api/watch-status').get_json()['running'] is False
+
+    # As published by the worker that won the background lock
+    services = fixer_app.get_background_status()
+    services['watch-status'] = dict(services['watch-status'], running=True, watches=3)
+    services['log-analyzer'] = dict(services['log-analyzer'], running=True)
+    store.set('background_status', 'status', {'at': time.time(), 'services': services})
+    watch_status = client.get('/api/watch-status').get_json()
+    assert watch_status['running'] is True and watch_status['watches'] == 3
+    assert client.get('/api/log-failures').get_json()['running'] is True
+
+    # Not published for long: that worker is gone
+    store.set('background_status', 'status', {'at': time.time() - 600, 'services': services})
+    assert client.get('/api/watch-status').get_json()['running'] is False
@@ -0,0 +1,39 @@
+import threading
+import time
+from core import batch
+
+def test_batch_fixes_share_the_fix_slots(monkeypatch, tmp_path):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def fix_ffmpeg_compatibility(emby_path, backup=None):
+        with lock:
+            running.append(emby_path)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(emby_path)
+        return {'success': True, 'message': None}
+
+    monkeypatch.setattr(batch, 'fix_ffmpeg_compatibility', fix_ffmpeg_compatibility)
+    paths = []
+    for index in range(8):
+        path = tmp_path / 'emby{}'.format(index)
+        path.mkdir()
+        paths.append(str(path))
+
+    # Two batches asking for more parallelism than allowed
+    targets = [('path', path) for path in paths]
+    results = []
+    threads = [threading.Thread(target=lambda part=part: results.extend(batch.run_batch(
+        part, lambda kind, value: batch.fix_install(value, force=True), 32, batch.MAX_FIX_PARALLELISM)))
+        for part in (targets[:4], targets[4:])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(1 for result in results if result.get('success')) == 8
+    assert max(peak) <= batch.MAX_CONCURRENT_FIXES
+    assert all(result['parallelism'] <= batch.MAX_FIX_PARALLELISM for result in results if result.get('done'))
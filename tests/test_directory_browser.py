@@ -0,0 +1,14 @@
+from core.directory_browser import DirectoryBrowser
+from core.utils import get_ffmpeg_name
+
+def test_installs_are_recognised_by_layout(tmp_path):
+    (tmp_path / 'emby-server' / 'system').mkdir(parents=True)
+    (tmp_path / 'emby-server' / 'system' / get_ffmpeg_name()).touch()
+    (tmp_path / 'Emby Server.app').mkdir()
+    (tmp_path / 'emby-notes').mkdir()
+    browser = DirectoryBrowser()
+    listing = browser.list_directory(str(tmp_path))
+    assert [(e['name'], e['is_emby']) for e in listing['entries']] == [
+        ('Emby Server.app', True), ('emby-server', True), ('emby-notes', False)]
+    assert not listing['is_emby']
+    assert browser.list_directory(str(tmp_path / 'emby-server'))['is_emby']
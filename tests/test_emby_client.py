@@ -0,0 +1,72 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from core.emby_client import EmbyClient, EmbyClients, EmbyClientError
+from core.emby_standin import EmbyStandIn
+
+@pytest.fixture
+def standins():
+    servers = [EmbyStandIn(api_key='secret', transcodes=i).start() for i in range(5)]
+    yield servers
+    with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+        list(executor.map(EmbyStandIn.stop, servers))
+
+def test_one_connection_per_server_across_rounds(standins):
+    clients = EmbyClients()
+    servers = [(standin.url, 'secret') for standin in standins]
+    try:
+        for _ in range(3):
+            for standin in standins:
+                clients.get_client(standin.url, 'secret').invalidate()
+            states = clients.fetch_transcoding_states(servers)
+            assert [states[standin.url]['transcoding'] for standin in standins] == [0, 1, 2, 3, 4]
+    finally:
+        clients.close()
+    assert [standin.connections for standin in standins] == [1] * 5
+    assert [standin.requests for standin in standins] == [3] * 5
+
+def test_transcoding_state_is_parsed(standins):
+    client = EmbyClient(standins[2].url + '/emby', 'secret')
+    state = client.get_transcoding_state()
+    client.close()
+    assert state['transcoding'] == 2
+    assert state['sessions'][0] == {
+        'session_id': 'session-0', 'user': 'user0', 'client': 'Emby Web', 'item': 'Item 0',
+        'video_codec': 'h264', 'audio_codec': 'aac', 'is_video_direct': False, 'progress': 12.5,
+        'reasons': ['VideoCodecNotSupported']
+    }
+
+def test_responses_are_cached_for_their_ttl(standins):
+    standin = standins[1]
+    client = EmbyClient(standin.url, 'secret')
+    assert client.get_system_info()['Version'] == '4.8.0.0'
+    client.get_system_info()
+    client.get_sessions()
+    client.get_sessions()
+    assert standin.requests == 2
+    client.invalidate()
+    client.get_system_info()
+    client.get('/System/Info/Public', ttl=0)
+    client.get('/System/Info/Public', ttl=0)
+    client.close()
+    assert standin.requests == 5
+
+def test_concurrent_requests_are_limited_per_server(standins):
+    standin = standins[0]
+    standin.delay = 0.05
+    client = EmbyClient(standin.url, 'secret', max_connections=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: client.get('/Sessions', ttl=0), range(8)))
+    client.close()
+    assert len(results) == 8
+    # Requests beyond the limit waited for a pooled connection instead of opening their own
+    assert client.connections_opened == 2
+    assert standin.connections == 2
+
+def test_errors_are_reported_per_server(standins):
+    clients = EmbyClients()
+    states = clients.fetch_transcoding_states([(standins[0].url, 'wrong'), (standins[1].url, 'secret')])
+    clients.close()
+    assert '401' in states[standins[0].url]['error']
+    assert states[standins[1].url]['transcoding'] == 1
+    with pytest.raises(EmbyClientError):
+        EmbyClient(standins[0].url, 'wrong').get_sessions()
@@ -0,0 +1,76 @@
+import time
+from core.emby_processes import EmbyProcessMonitor
+
+class NoSuchProcess(Exception):
+    pass
+
+class AccessDenied(Exception):
+    pass
+
+class ZombieProcess(NoSuchProcess):
+    pass
+
+class FakePsutil:
+    """Processes as pid -> dict of readable attributes; missing ones are denied."""
+    NoSuchProcess = NoSuchProcess
+    AccessDenied = AccessDenied
+    ZombieProcess = ZombieProcess
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.reads = []
+
+    def pids(self):
+        return list(self.processes)
+
+    def Process(self, pid):
+        psutil = self
+
+        class Process:
+            def __init__(self):
+                self.pid = pid
+
+            def __getattr__(self, attr):
+                def read():
+                    psutil.reads.append((pid, attr))
+                    try:
+                        return psutil.processes[pid][attr]
+                    except KeyError:
+                        raise AccessDenied(attr)
+                return read
+        return Process()
+
+def scan(monitor, psutil):
+    monitor._snapshot = monitor._scan(psutil)
+    monitor._scanned_at = time.time()
+    return monitor._snapshot
+
+def test_transcodes_of_an_inaccessible_server_block_every_install():
+    psutil = FakePsutil({
+        10: {'name': 'EmbyServer', 'exe': '/opt/emby-a/system/EmbyServer', 'cmdline': [], 'create_time': 1},
+        11: {'name': 'ffmpeg', 'exe': '/opt/emby-a/system/ffmpeg', 'cmdline': ['ffmpeg'], 'ppid': 10,
+             'create_time': 2},
+        # Another user's server: name and parent are readable, the executable is not
+        20: {'name': 'EmbyServer', 'create_time': 3},
+        21: {'name': 'ffmpeg', 'ppid': 20, 'create_time': 4},
+    })
+    monitor = EmbyProcessMonitor()
+    snapshot = scan(monitor, psutil)
+    assert snapshot['unattributed_transcodes'] == 1
+    assert [p['pid'] for p in monitor.get_active_transcodes('/opt/emby-a')] == [11, 21]
+    assert [p['pid'] for p in monitor.get_active_transcodes('/opt/emby-b')] == [21]
+
+def test_inaccessible_processes_are_not_probed_again():
+    psutil = FakePsutil({
+        30: {},  # Not even its name can be read
+        31: {'name': 'bash', 'create_time': 5},
+        32: {'name': 'ffmpeg', 'ppid': 30, 'create_time': 6},
+    })
+    monitor = EmbyProcessMonitor()
+    snapshot = scan(monitor, psutil)
+    assert snapshot['inaccessible_processes'] == 1
+    # A transcode started by an unidentifiable process may be Emby's
+    assert [p['pid'] for p in monitor.get_active_transcodes('/opt/emby-a')] == [32]
+    psutil.reads.clear()
+    scan(monitor, psutil)
+    assert not any(pid in (30, 31) for pid, _ in psutil.reads)
@@ -0,0 +1,41 @@
+import threading
+import pytest
+import app as fixer_app
+from core import fix_orchestrator as orchestrator_module
+from core.database import Database
+from core.fix_orchestrator import FixOrchestrator, MAX_RUNNING_ROLLOUTS
+
+@pytest.fixture
+def blocked_fixes(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(orchestrator_module, 'fix_install', lambda value, force: release.wait(5) and
+                        {'success': False, 'message': 'Not fixed'})
+    yield release
+    release.set()
+
+def test_running_rollouts_are_capped(blocked_fixes):
+    orchestrator = FixOrchestrator()
+    for _ in range(MAX_RUNNING_ROLLOUTS):
+        orchestrator.start([('path', '/emby')])
+    with pytest.raises(RuntimeError):
+        orchestrator.start([('path', '/emby')])
+
+def test_rollout_over_the_cap_is_rejected(blocked_fixes, monkeypatch):
+    monkeypatch.setattr(fixer_app, 'fix_orchestrator', FixOrchestrator())
+    client = fixer_app.app.test_client()
+    codes = [client.post('/api/fix-rollouts', json={'paths': ['/emby']}).status_code
+             for _ in range(MAX_RUNNING_ROLLOUTS + 1)]
+    assert codes == [202] * MAX_RUNNING_ROLLOUTS + [409]
+
+def test_unfinished_rollouts_are_interrupted_on_startup(tmp_path):
+    database = Database()
+    database.open(str(tmp_path / 'fixer.db'))
+    running = database.create_rollout({}, {})
+    database.update_rollout(running, 'running')
+    finished = database.create_rollout({}, {})
+    database.update_rollout(finished, 'done')
+    assert database.count_running_rollouts() == 1
+    assert database.interrupt_rollouts() == 1
+    assert database.get_rollout(running)['state'] == 'interrupted'
+    assert database.get_rollout(finished)['state'] == 'done'
+    assert database.count_running_rollouts() == 0
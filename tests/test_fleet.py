@@ -0,0 +1,36 @@
+import time
+import pytest
+import app as fixer_app
+from core import fleet as fleet_module
+from core.database import Database
+from core.fleet import FleetCoordinator, COMMAND_TIMEOUT
+
+@pytest.fixture
+def coordinator(tmp_path, monkeypatch):
+    database = Database()
+    database.open(str(tmp_path / 'fixer.db'))
+    monkeypatch.setattr(fleet_module, 'database', database)
+    return FleetCoordinator()
+
+def test_fleet_routes_require_a_token(monkeypatch):
+    client = fixer_app.app.test_client()
+    monkeypatch.delenv('EMBY_FIXER_FLEET_TOKEN', raising=False)
+    assert client.get('/api/fleet/status').status_code == 403
+    assert client.post('/api/fleet/command', json={'host_id': 'nas', 'command': 'rescan'}).status_code == 403
+
+    monkeypatch.setenv('EMBY_FIXER_FLEET_TOKEN', 'secret')
+    assert client.get('/api/fleet/status', headers={'X-Fleet-Token': 'wrong'}).status_code == 403
+    assert client.get('/api/fleet/status', headers={'X-Fleet-Token': 'secret'}).status_code == 200
+
+def test_sent_commands_without_an_outcome_expire(coordinator, monkeypatch):
+    queued = coordinator.queue_command('nas', 'fix', '/emby')['id']
+    reply = coordinator.receive_report({'host_id': 'nas', 'seq': 1, 'full': True, 'installs': {}})
+    assert [command['id'] for command in reply['commands']] == [queued]
+
+    # The agent died before reporting the outcome
+    assert coordinator.expire_commands() == 0
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + COMMAND_TIMEOUT + 1)
+    assert coordinator.expire_commands() == 1
+    command = fleet_module.database.get_fleet_commands('nas')[0]
+    assert (command['state'], command['success']) == ('expired', 0)
@@ -0,0 +1,53 @@
+import threading
+import time
+from core import health_scheduler as scheduler_module
+from core.health_scheduler import HealthScheduler
+from core.shared_store import SharedStore
+
+def test_concurrency_set_after_construction_is_used(monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def stat_manifest(paths):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.2)
+        with lock:
+            running.pop()
+        return ()
+
+    monkeypatch.setattr(scheduler_module, 'stat_manifest', stat_manifest)
+    monkeypatch.setattr(scheduler_module, 'get_install_watch_paths', lambda path: [])
+    scheduler = HealthScheduler(min_interval=0.01, max_interval=60)
+    # As start_health_scheduler configures --health-concurrency
+    scheduler.max_concurrent = 4
+    scheduler.start(lambda: ['/emby{}'.format(index) for index in range(8)])
+    try:
+        time.sleep(0.5)
+    finally:
+        scheduler.stop()
+    assert max(peak) == 4
+
+def test_reset_in_another_worker_reaches_the_scheduler(monkeypatch, tmp_path):
+    store = SharedStore()
+    store.open(str(tmp_path / 'shared_state.db'))
+    monkeypatch.setattr(scheduler_module, 'shared_store', store)
+    monkeypatch.setattr(scheduler_module, 'SHARED_RESET_INTERVAL', 0.05)
+    monkeypatch.setattr(scheduler_module, 'stat_manifest', lambda paths: ())
+    monkeypatch.setattr(scheduler_module, 'get_install_watch_paths', lambda path: [])
+    scheduler = HealthScheduler(min_interval=1000, max_interval=1000, jitter=0)
+    scheduler.start(lambda: ['/emby'])
+    try:
+        time.sleep(0.1)
+        assert scheduler.get_schedule()['installs'][0]['next_run_in'] > 100
+        scheduler.min_interval = 0.5
+        # The scheduler of a worker that does not run the checks
+        HealthScheduler().reset('/emby')
+        assert store.count('health_resets') == 1
+        time.sleep(0.3)
+        assert scheduler.get_schedule()['installs'][0]['next_run_in'] < 1
+        assert store.count('health_resets') == 0
+    finally:
+        scheduler.stop()
@@ -0,0 +1,69 @@
+import time
+import threading
+from core import install_watcher as watcher_module
+from core.install_watcher import InstallWatcher
+from core.shared_store import SharedStore
+
+def test_changes_are_debounced_up_to_max_delay():
+    watcher = InstallWatcher(debounce=2, max_delay=5)
+    watcher._mark('/emby', 100)
+    assert watcher._due['/emby'] == (100, 102)
+    # Each change pushes the check back, but not past max_delay after the first one
+    watcher._mark('/emby', 101)
+    assert watcher._due['/emby'] == (100, 103)
+    watcher._mark('/emby', 104)
+    assert watcher._due['/emby'] == (100, 105)
+    # A retry delay never postpones a check that is already due sooner
+    watcher._mark('/emby', 104, delay=30)
+    assert watcher._due['/emby'] == (100, 105)
+
+def test_only_changed_binaries_are_probed(tmp_path, monkeypatch):
+    for binary in ('ffmpeg', 'ffprobe'):
+        (tmp_path / binary).write_text('arm64')
+    probes = []
+
+    def get_ffmpeg_architecture(path):
+        probes.append(path)
+        with open(path) as f:
+            return f.read()
+
+    monkeypatch.setattr(watcher_module, 'find_ffmpeg_binaries', lambda emby_path: str(tmp_path / 'ffmpeg'))
+    monkeypatch.setattr(watcher_module, 'get_ffmpeg_architecture', get_ffmpeg_architecture)
+    monkeypatch.setattr(watcher_module, 'get_system_architecture', lambda: 'arm64')
+    watcher = InstallWatcher()
+    watcher.sync([str(tmp_path)])
+
+    assert watcher.check(str(tmp_path))['incompatible'] == []
+    assert len(probes) == 2
+    assert watcher.check(str(tmp_path))['changed'] == []
+    assert len(probes) == 2
+
+    # An update puts back one binary for another architecture
+    (tmp_path / 'ffprobe').write_text('x86_64')
+    event = watcher.check(str(tmp_path))
+    assert event['changed'] == [str(tmp_path / 'ffprobe')]
+    assert event['incompatible'] == [str(tmp_path / 'ffprobe')]
+    assert probes[2:] == [str(tmp_path / 'ffprobe')]
+    assert watcher.get_status()['installs'][0]['architectures'][str(tmp_path / 'ffmpeg')] == 'arm64'
+
+def test_named_locks_are_dropped_once_released():
+    store = SharedStore()
+    inside, release = [], threading.Event()
+
+    def hold(name):
+        with store.lock('install-/emby'):
+            inside.append(name)
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold, args=(name,)) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+    while not store._thread_locks or store._thread_locks['install-/emby'][1] < 2:
+        time.sleep(0.01)
+    # The waiter shares the held lock, it is not dropped under it
+    assert len(inside) == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(inside) == ['first', 'second']
+    assert store._thread_locks == {}
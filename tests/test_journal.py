@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+from core import journal as journal_module
+from core.journal import Journal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs an operation in a child process that is killed between two steps
+CHILD = '''
+import os, sys, json
+sys.path.insert(0, sys.argv[1])
+from core import journal as journal_module
+from core.journal import journal
+
+def crash():
+    os._exit(9)
+
+def fail():
+    raise OSError("disk full")
+
+journal_module.ACTIONS.update(crash=crash, fail=fail)
+journal.open(sys.argv[2])
+operation = json.loads(sys.argv[3])
+journal.run('fix', operation['emby_path'], [tuple(s) for s in operation['steps']],
+            undo=[tuple(s) for s in operation['undo']])
+'''
+
+@pytest.fixture
+def install(tmp_path, monkeypatch):
+    # In the test process the injected actions complete, as they would after a restart
+    monkeypatch.setitem(journal_module.ACTIONS, 'crash', lambda: None)
+    monkeypatch.setitem(journal_module.ACTIONS, 'fail', lambda: None)
+    for name, content in (('ffmpeg', b'original'), ('new', b'replacement')):
+        (tmp_path / name).write_bytes(content)
+    (tmp_path / 'backup').mkdir()
+    return tmp_path
+
+def run_killed(install, steps, undo):
+    db = str(install / 'journal.db')
+    operation = {'emby_path': str(install), 'steps': steps, 'undo': undo}
+    result = subprocess.run([sys.executable, '-c', CHILD, ROOT, db, json.dumps(operation)], capture_output=True)
+    assert result.returncode == 9, result.stderr.decode()
+    journal = Journal()
+    journal.open(db)
+    return journal
+
+def copy(src, dst):
+    return ['copy_file', {'src': str(src), 'dst': str(dst)}]
+
+def test_interrupted_operation_is_rolled_forward(install):
+    journal = run_killed(install, [copy(install / 'ffmpeg', install / 'backup' / 'ffmpeg'),
+                                   copy(install / 'new', install / 'ffmpeg'),
+                                   ['crash', {}],
+                                   ['write_file', {'path': str(install / 'marker'), 'content': 'fixed'}]],
+                         undo=[copy(install / 'backup' / 'ffmpeg', install / 'ffmpeg')])
+    assert not (install / 'marker').exists()
+    assert journal.recover() == [{'kind': 'fix', 'emby_path': str(install), 'state': 'done'}]
+    assert (install / 'ffmpeg').read_bytes() == b'replacement'
+    assert (install / 'marker').read_text() == 'fixed'
+    assert journal.recover() == []
+
+def test_operation_killed_while_rolling_back_is_only_rolled_back(install):
+    # The replacement went in, the next step failed and the roll back was killed halfway
+    journal = run_killed(install, [copy(install / 'ffmpeg', install / 'backup' / 'ffmpeg'),
+                                   copy(install / 'new', install / 'ffmpeg'),
+                                   ['fail', {}]],
+                         undo=[['crash', {}],
+                               copy(install / 'backup' / 'ffmpeg', install / 'ffmpeg')])
+    assert (install / 'ffmpeg').read_bytes() == b'replacement'
+    assert journal.recover() == [{'kind': 'fix', 'emby_path': str(install), 'state': 'rolled_back'}]
+    assert (install / 'ffmpeg').read_bytes() == b'original'
+    assert not os.path.exists(str(install / 'ffmpeg') + journal_module.TEMP_SUFFIX)
+
+def test_operation_without_undo_steps_that_cannot_roll_forward_is_failed(install):
+    # A restore has no undo steps; here its source vanished before recovery
+    journal = run_killed(install, [copy(install / 'new', install / 'ffmpeg'),
+                                   ['crash', {}],
+                                   copy(install / 'backup' / 'missing', install / 'ffmpeg')],
+                         undo=[])
+    assert journal.recover() == [{'kind': 'fix', 'emby_path': str(install), 'state': 'failed'}]
+    assert journal.recover() == []
+
+def test_failed_operation_without_undo_steps_is_not_rolled_back(install, tmp_path):
+    journal = Journal()
+    journal.open(str(tmp_path / 'run.db'))
+    with pytest.raises(OSError):
+        journal.run('restore', str(install), [copy(install / 'backup' / 'missing', install / 'ffmpeg')])
+    state = journal._connection().execute('SELECT state FROM journal_operations').fetchone()[0]
+    assert state == 'failed'
@@ -0,0 +1,78 @@
+import os
+import time
+import pytest
+from core import log_analyzer as analyzer_module
+from core.database import Database
+from core.log_analyzer import LogAnalyzer, classify, get_bucket, BACKFILL_DAYS
+
+FAILURE = b'2026-10-19 10:15:02.120 Error App: ffmpeg: Bad CPU type in executable\n'
+INFO = b'2026-10-19 10:15:03.000 Info App: Transcoding finished\n'
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    database = Database()
+    database.open(str(tmp_path / 'fixer.db'))
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+    monkeypatch.setattr(analyzer_module, 'database', database)
+    monkeypatch.setattr(analyzer_module, 'get_log_dirs', lambda emby_path: [str(log_dir)])
+    monkeypatch.setattr(analyzer_module.health_scheduler, 'reset', lambda emby_path: None)
+    return log_dir
+
+def failures(analyzer):
+    return analyzer.analyze(['/emby'])['failures'].get('bad_cpu_type', 0)
+
+def test_classify_only_matches_lines_with_a_keyword():
+    data = (INFO +
+            b'2026-10-19 11:00:00.000 Info App: Process exited with code 8\n' +
+            b'Info App: Server exiting normally\n' +
+            FAILURE +
+            b'dyld: Library not loaded: libavcodec.dylib\n')
+    found = [(kind, bucket, line) for kind, bucket, line in classify(data, 0)]
+    assert [kind for kind, _, _ in found] == ['exit_code_8', 'bad_cpu_type', 'missing_library']
+    # A line without a timestamp is counted in the default bucket
+    assert found[2][1] == 0
+    assert found[0][1] - found[1][1] == 3600
+
+def test_rotated_log_carries_on_where_it_left_off(logs):
+    analyzer = LogAnalyzer()
+    (logs / 'embyserver.txt').write_bytes(FAILURE)
+    assert failures(analyzer) == 1
+
+    # Rotation renames the file, the server still appends to it before opening a new one
+    os.rename(str(logs / 'embyserver.txt'), str(logs / 'embyserver-1.txt'))
+    with open(str(logs / 'embyserver-1.txt'), 'ab') as f:
+        f.write(FAILURE)
+    (logs / 'embyserver.txt').write_bytes(INFO + FAILURE)
+    assert failures(analyzer) == 2
+
+    # A restarted analyzer resumes from the stored offsets
+    assert failures(LogAnalyzer()) == 0
+
+def test_truncated_log_is_read_again(logs):
+    analyzer = LogAnalyzer()
+    log = logs / 'ffmpeg-transcode-1.txt'
+    log.write_bytes(INFO + FAILURE + FAILURE)
+    assert failures(analyzer) == 2
+    log.write_bytes(FAILURE)
+    assert failures(analyzer) == 1
+
+def test_logs_older_than_the_backfill_are_skipped(logs):
+    log = logs / 'embyserver-old.txt'
+    log.write_bytes(FAILURE)
+    old = time.time() - (BACKFILL_DAYS + 1) * 86400
+    os.utime(str(log), (old, old))
+    analyzer = LogAnalyzer()
+    assert failures(analyzer) == 0
+    # Only what is appended later is read
+    with open(str(log), 'ab') as f:
+        f.write(FAILURE)
+    assert failures(analyzer) == 1
+
+def test_old_failure_counts_are_pruned(logs):
+    database = analyzer_module.database
+    now = time.time()
+    database.save_log_progress({}, [], {('/emby', get_bucket(now - 40 * 86400), 'bad_cpu_type'): 3,
+                                        ('/emby', get_bucket(now - 86400), 'bad_cpu_type'): 1})
+    LogAnalyzer(retention_days=30).analyze(['/emby'])
+    assert [row['count'] for row in database.get_log_failures()] == [1]
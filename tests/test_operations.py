@@ -0,0 +1,127 @@
+import os
+import plistlib
+import pytest
+from core import operations
+from core import journal as journal_module
+from core.fix_recipes import FixRecipes
+from core.fix_staging import FixStaging, get_staging_dir
+
+ARCH = 'arm64'
+
+def set_version(emby_path, version):
+    with open(os.path.join(emby_path, 'Contents', 'Info.plist'), 'wb') as f:
+        plistlib.dump({'CFBundleShortVersionString': version}, f)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def install(tmp_path, monkeypatch):
+    # Replacements are resources relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    replacements = tmp_path / 'ffmpeg_binaries' / ARCH
+    replacements.mkdir(parents=True)
+    for binary in ('ffmpeg', 'ffprobe'):
+        (replacements / binary).write_bytes(b'arm64 ' + binary.encode())
+
+    emby_path = tmp_path / 'Emby Server.app'
+    (emby_path / 'Contents' / 'MacOS').mkdir(parents=True)
+    set_version(str(emby_path), '4.8.0')
+    for binary in ('ffmpeg', 'ffprobe'):
+        path = emby_path / 'Contents' / 'MacOS' / binary
+        path.write_bytes(b'x86_64 ' + binary.encode())
+        path.chmod(0o755)
+
+    monkeypatch.setenv('EMBY_FIXER_EMBY_DATA_DIR', str(tmp_path / 'data'))
+    monkeypatch.setattr(operations, 'get_system_architecture', lambda: ARCH)
+    monkeypatch.setattr(operations.emby_process_monitor, 'get_running_ffmpeg_path', lambda emby_path: None)
+    monkeypatch.setattr(operations, 'fix_recipes', FixRecipes())
+    monkeypatch.setattr(operations, 'fix_staging', FixStaging())
+    return str(emby_path)
+
+def binary_path(emby_path, binary='ffmpeg', backup=False):
+    ffmpeg_dir = os.path.join(emby_path, 'Contents', 'MacOS')
+    if backup:
+        ffmpeg_dir = os.path.join(ffmpeg_dir, 'ffmpeg_backup_original')
+    return os.path.join(ffmpeg_dir, binary)
+
+def test_staged_replacements_are_fresh_until_something_changes(install, tmp_path):
+    staging = operations.fix_staging
+    assert staging.prepare(install, ARCH, 1024 * 1024) > 0
+    assert staging.take(install, ARCH) is not None
+    assert staging.take(install, 'x86_64') is None
+
+    # A new build of the bundled replacements
+    (tmp_path / 'ffmpeg_binaries' / ARCH / 'ffprobe').write_bytes(b'arm64 ffprobe, rebuilt')
+    assert staging.take(install, ARCH) is None
+    staging.prepare(install, ARCH, 1024 * 1024)
+    assert staging.take(install, ARCH) is not None
+
+    # The install no longer has a binary where the recipe expects it
+    os.remove(binary_path(install, 'ffprobe'))
+    assert staging.take(install, ARCH) is None
+
+def test_staged_fix_only_renames(install):
+    operations.fix_staging.prepare(install, ARCH, 1024 * 1024)
+    original = os.stat(binary_path(install))
+
+    assert operations.fix_ffmpeg_compatibility(install)['success']
+    assert read(binary_path(install)) == b'arm64 ffmpeg'
+    # The staged copies were moved in, and the originals kept as hard links
+    assert not os.path.exists(os.path.join(get_staging_dir(install), 'ffmpeg'))
+    backup = os.stat(binary_path(install, backup=True))
+    assert (backup.st_ino, backup.st_dev) == (original.st_ino, original.st_dev)
+    assert read(binary_path(install, 'ffprobe', backup=True)) == b'x86_64 ffprobe'
+    assert operations.fix_staging.take(install, ARCH) is None
+
+def test_fix_from_recipe_is_verified_and_rolled_back_on_mismatch(install):
+    recipes = operations.fix_recipes
+    assert operations.fix_ffmpeg_compatibility(install)['success']
+    assert operations.restore_original_ffmpeg(install) == (True, "Successfully restored original FFMPEG binaries")
+    assert read(binary_path(install)) == b'x86_64 ffmpeg'
+
+    recipe = recipes.get(install, ARCH)
+    assert recipe['binaries'] == ['ffmpeg', 'ffprobe']
+    assert operations.fix_ffmpeg_compatibility(install)['success']
+    assert recipes.get_recipes()['stats']['hits'] == 2
+    operations.restore_original_ffmpeg(install)
+
+    recipe['replacements']['ffprobe']['sha256'] = '0' * 64
+    with pytest.raises(ValueError):
+        operations._apply_recipe(install, recipe)
+    assert read(binary_path(install)) == b'x86_64 ffmpeg'
+    assert read(binary_path(install, 'ffprobe')) == b'x86_64 ffprobe'
+
+def test_backup_from_another_emby_version_is_replaced(install):
+    assert operations.fix_ffmpeg_compatibility(install)['success']
+    assert read(binary_path(install, operations.BACKUP_VERSION_FILE, backup=True)) == b'4.8.0'
+
+    # An in-place update brings new binaries, without ffprobe
+    set_version(install, '4.9.1.0')
+    with open(binary_path(install), 'wb') as f:
+        f.write(b'x86_64 ffmpeg 4.9')
+    os.remove(binary_path(install, 'ffprobe'))
+    success, message = operations.restore_original_ffmpeg(install)
+    assert not success and '4.8.0' in message
+
+    assert operations.fix_ffmpeg_compatibility(install)['success']
+    assert read(binary_path(install, backup=True)) == b'x86_64 ffmpeg 4.9'
+    assert not os.path.exists(binary_path(install, 'ffprobe', backup=True))
+    assert read(binary_path(install, operations.BACKUP_VERSION_FILE, backup=True)) == b'4.9.1.0'
+    assert operations.restore_original_ffmpeg(install)[0]
+    assert read(binary_path(install)) == b'x86_64 ffmpeg 4.9'
+
+def test_link_and_rename_steps_can_run_again(tmp_path):
+    src, dst, moved = tmp_path / 'src', tmp_path / 'dst', tmp_path / 'moved'
+    src.write_bytes(b'new')
+    dst.write_bytes(b'original')
+    journal_module.ACTIONS['link_file'](str(src), str(dst), keep_existing=True)
+    assert dst.read_bytes() == b'original'
+    journal_module.ACTIONS['link_file'](str(src), str(dst))
+    assert os.path.samefile(str(src), str(dst))
+
+    # A rename finished before an interruption is not redone
+    for _ in range(2):
+        journal_module.ACTIONS['rename_file'](str(src), str(moved))
+    assert moved.read_bytes() == b'new' and not src.exists()
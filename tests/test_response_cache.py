@@ -0,0 +1,40 @@
+from core.response_cache import ResponseCache
+
+CONFIG = '''<?xml version="1.0"?>
+<EncodingOptions>
+  <EncoderAppPath>{}</EncoderAppPath>
+  <EncoderLocationType>Custom</EncoderLocationType>
+</EncodingOptions>
+'''
+
+def test_custom_ffmpeg_changes_invalidate_responses(tmp_path, monkeypatch):
+    emby_path = tmp_path / 'emby-server'
+    emby_path.mkdir()
+    external = tmp_path / 'bin' / 'ffmpeg'
+    external.parent.mkdir()
+    external.write_bytes(b'x86_64')
+    config = tmp_path / 'data' / 'config' / 'encoding.xml'
+    config.parent.mkdir(parents=True)
+    config.write_text(CONFIG.format(external))
+    monkeypatch.setenv('EMBY_FIXER_EMBY_DATA_DIR', str(tmp_path / 'data'))
+
+    computed = []
+    cache = ResponseCache()
+
+    def get():
+        return cache.get_or_compute('install-status', str(emby_path),
+                                    lambda: (computed.append(1) or {'n': len(computed)}, 200))
+
+    get()
+    get()
+    assert len(computed) == 1
+    # Fixing the custom FFMPEG outside the install
+    external.write_bytes(b'arm64-binary')
+    get()
+    assert len(computed) == 2
+    # Pointing Emby at another FFMPEG
+    other = tmp_path / 'bin' / 'ffmpeg-6'
+    other.write_bytes(b'arm64')
+    config.write_text(CONFIG.format(other) + '\n')
+    get()
+    assert len(computed) == 3